@@ -10,6 +10,10 @@ CREATE TABLE nodes (
   description     TEXT NULL
 ) ;
 
+-- backs the bbox filter on the status endpoints
+CREATE INDEX idx_nodes_lon_lat
+ON nodes USING GIST ( point(lon, lat) ) ;
+
 
 CREATE TABLE projects_nodes (
   node_id         TEXT NOT NULL ,
@@ -27,32 +31,73 @@ CREATE INDEX idx_projects_nodes_project_id
 ON projects_nodes (project_id) ;
 
 
-CREATE TABLE observations (
+-- content hash of each node's last loaded nodes.csv row, so unchanged rows
+-- can be skipped instead of rewritten every ingest
+CREATE TABLE node_hashes (
   node_id         TEXT NOT NULL ,
-  timestamp       TIMESTAMP NOT NULL ,
+  project_id      TEXT NOT NULL ,
+  hash            TEXT NOT NULL ,
+
+  PRIMARY KEY ( node_id, project_id )
+) ;
+
+
+-- every distinct (subsystem, sensor, parameter) gets a small id so observations
+-- don't repeat the names on every row
+CREATE TABLE sensors (
+  sensor_id       SERIAL PRIMARY KEY ,
   subsystem       TEXT NOT NULL ,
   sensor          TEXT NOT NULL ,
   parameter       TEXT NOT NULL ,
-  value_raw       TEXT NULL ,
-  value_hrf       TEXT NULL ,
 
-  UNIQUE ( node_id, timestamp, subsystem, sensor, parameter )
+  UNIQUE ( subsystem, sensor, parameter )
 ) ;
 
-CREATE INDEX idx_observations_node_id
-ON observations ( node_id ) ;
 
-CREATE INDEX idx_observations_timestamp
-ON observations ( timestamp ) ;
+-- columns are ordered fixed width first so rows pack without alignment padding.
+-- the unique index leads with node_id, which covers the per node lookups, and
+-- partition pruning covers the time ranges, so no other indexes are needed.
+-- value_hrf_text keeps the hrf as reported, but only when the export couldn't
+-- write it back out the same from value_hrf (e.g. 'NA' or '23.40').
+CREATE TABLE observations (
+  timestamp       TIMESTAMP NOT NULL ,
+  value_hrf       DOUBLE PRECISION NULL ,
+  sensor_id       INTEGER NOT NULL ,
+  node_id         TEXT NOT NULL ,
+  value_raw       TEXT NULL ,
+  value_hrf_text  TEXT NULL ,
+
+  UNIQUE ( node_id, timestamp, sensor_id )
+) PARTITION BY RANGE ( timestamp ) ;
+
+-- hourly partitions are created ahead of time and dropped once they age out by
+-- the expire_observations task; the default partition only catches strays
+CREATE TABLE observations_default
+PARTITION OF observations DEFAULT ;
+
 
-CREATE INDEX idx_observations_subsystem
-ON observations ( subsystem ) ;
+-- maintained by the loader as part of each ingest so the status queries never
+-- have to aggregate observations. observations_ingested is a running total of
+-- the rows loaded for the node; expiry doesn't lower it, so it isn't the number
+-- of rows currently in observations.
+CREATE TABLE node_latest_observation (
+  node_id                       TEXT PRIMARY KEY ,
+  latest_observation_timestamp  TIMESTAMP NOT NULL ,
+  observations_ingested         BIGINT NOT NULL
+) ;
 
-CREATE INDEX idx_observations_sensor
-ON observations ( sensor ) ;
 
-CREATE INDEX idx_observations_parameter
-ON observations ( parameter ) ;
+-- the most recent reading of every sensor on a node, kept up to date by the
+-- ingest so node details never have to scan observations
+CREATE TABLE node_latest_values (
+  node_id         TEXT NOT NULL ,
+  sensor_id       INTEGER NOT NULL ,
+  timestamp       TIMESTAMP NOT NULL ,
+  value_raw       TEXT NULL ,
+  value_hrf       DOUBLE PRECISION NULL ,
+
+  PRIMARY KEY ( node_id, sensor_id )
+) ;
 
 
 CREATE TABLE boot_events (
@@ -74,3 +119,86 @@ CREATE TABLE rssh_ports (
 
 CREATE INDEX idx_rssh_ports_node_id
 ON rssh_ports ( node_id ) ;
+
+
+CREATE TABLE ingest_state (
+  project_id                    TEXT PRIMARY KEY ,
+  etag                          TEXT NULL ,
+  last_modified                 TEXT NULL ,
+  content_length                BIGINT NULL ,
+  latest_observation_timestamp  TIMESTAMP NULL ,
+  updated_at                    TIMESTAMP NOT NULL
+) ;
+
+
+-- the status rules, in one place: the web tier's status queries and the
+-- snapshot_statuses task both call this, so the recorded history always agrees
+-- with what the api reports. only what happened in the 24 hours up to as_of
+-- (utc, like every timestamp here) counts; start_timestamp and end_timestamp
+-- are the node's project membership.
+CREATE FUNCTION node_status (
+  start_timestamp               TIMESTAMP ,
+  end_timestamp                 TIMESTAMP ,
+  latest_observation_timestamp  TIMESTAMP ,
+  latest_boot_timestamp         TIMESTAMP ,
+  latest_rssh_timestamp         TIMESTAMP ,
+  as_of                         TIMESTAMP
+) RETURNS TEXT
+LANGUAGE SQL IMMUTABLE
+AS $$
+SELECT CASE
+    WHEN end_timestamp IS NOT NULL
+        THEN 'black'
+    WHEN start_timestamp IS NULL AND latest_observation_timestamp IS NOT NULL
+        THEN 'gray'
+    WHEN latest_observation_timestamp >= (as_of - interval '24 hours')
+        THEN 'green'
+    WHEN latest_boot_timestamp >= (as_of - interval '24 hours')
+        AND latest_rssh_timestamp >= (as_of - interval '24 hours')
+        THEN 'blue'
+    WHEN latest_rssh_timestamp >= (as_of - interval '24 hours')
+        THEN 'yellow'
+    WHEN latest_boot_timestamp >= (as_of - interval '24 hours')
+        THEN 'orange'
+    ELSE 'red'
+END
+$$ ;
+
+
+-- each node's computed status over time, run length encoded: a row per change
+-- of status, with end_timestamp left NULL on the run that is still going
+CREATE TABLE status_transitions (
+  node_id         TEXT NOT NULL ,
+  start_timestamp TIMESTAMP NOT NULL ,
+  end_timestamp   TIMESTAMP NULL ,
+  status          TEXT NOT NULL ,
+
+  PRIMARY KEY ( node_id, start_timestamp )
+) ;
+
+CREATE UNIQUE INDEX idx_status_transitions_open
+ON status_transitions ( node_id ) WHERE end_timestamp IS NULL ;
+
+CREATE INDEX idx_status_transitions_end_timestamp
+ON status_transitions ( end_timestamp ) ;
+
+
+-- seconds spent in each status per node per hour and per (utc) day
+CREATE TABLE status_hourly (
+  bucket          TIMESTAMP NOT NULL ,
+  node_id         TEXT NOT NULL ,
+  status          TEXT NOT NULL ,
+  seconds         DOUBLE PRECISION NOT NULL ,
+
+  PRIMARY KEY ( bucket, node_id, status )
+) ;
+
+
+CREATE TABLE status_daily (
+  bucket          TIMESTAMP NOT NULL ,
+  node_id         TEXT NOT NULL ,
+  status          TEXT NOT NULL ,
+  seconds         DOUBLE PRECISION NOT NULL ,
+
+  PRIMARY KEY ( bucket, node_id, status )
+) ;
@@ -4,9 +4,11 @@ from datetime import timedelta
 
 _cfg = Config()
 app = Celery('tasks', broker=_cfg.get_rmq_dsn(), include=[
-    'expire_observations', 'load_nodes_and_data', 'load_boot_events', 'load_rssh_ports'])
+    'expire_observations', 'load_nodes_and_data', 'load_boot_events', 'load_rssh_ports', 'snapshot_statuses'])
 
 app.conf.timezone = 'UTC'
+app.conf.worker_concurrency = _cfg.worker_concurrency
+app.conf.worker_prefetch_multiplier = 1
 app.conf.beat_schedule = {
     'expire_observations': {
         'task': 'expire_observations.run',
@@ -23,5 +25,9 @@ app.conf.beat_schedule = {
     'load_rssh_ports': {
         'task': 'load_rssh_ports.run',
         'schedule': timedelta(minutes=5)
+    },
+    'snapshot_statuses': {
+        'task': 'snapshot_statuses.run',
+        'schedule': timedelta(minutes=5)
     }
 }
\ No newline at end of file
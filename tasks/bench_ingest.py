@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+
+"""
+Times the ingest tasks end to end against a local Postgres without touching
+the ANL servers. A synthetic `*.complete.recent.tar` (nodes.csv plus
+data.csv.gz), a boot events csv and a live nodes list are generated, served
+from a stub HTTP server on localhost, and run through `process_tarball`,
+`load_boot_events.run` and `load_rssh_ports.run`.
+
+Each run happens in a forked child so peak RSS is per task. Time spent inside
+cursor calls and commits is counted as DB time; the rest of the wall clock is
+Python time. Everything the benchmark loads belongs to a synthetic project
+and is deleted again at the end, along with whatever the scheduled tasks
+recorded for its nodes in the meantime and the sensors it added.
+
+    $ POSTGRES_HOST=localhost python bench_ingest.py --nodes 100 --sensors 60 --steps 144
+    $ python bench_ingest.py --output results.json
+    $ python bench_ingest.py --baseline results.json --tolerance 0.2
+"""
+
+import argparse
+import csv
+import gzip
+import http.server
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import partial
+
+import psycopg2
+import psycopg2.extensions
+from dateutil import tz
+
+import load_boot_events
+import load_nodes_and_data
+import load_rssh_ports
+import utils
+from config import Config
+
+
+PROJECT_ID = 'Bench_Synthetic'
+NODE_ID_PREFIX = '001e06be'
+
+# (subsystem, sensor, parameter, value_raw range, value_hrf scale) -- a slice of what the real nodes report
+SENSORS = [
+    ('metsense', 'bmp180', 'temperature', (0, 4000), 0.01),
+    ('metsense', 'bmp180', 'pressure', (90000, 110000), 0.01),
+    ('metsense', 'htu21d', 'humidity', (0, 10000), 0.01),
+    ('metsense', 'htu21d', 'temperature', (0, 4000), 0.01),
+    ('metsense', 'tsys01', 'temperature', (0, 4000), 0.01),
+    ('metsense', 'spv1840lr5h_b', 'intensity', (0, 2000), 0.1),
+    ('chemsense', 'co', 'concentration', (0, 500), 0.01),
+    ('chemsense', 'no2', 'concentration', (0, 500), 0.01),
+    ('chemsense', 'o3', 'concentration', (0, 500), 0.01),
+    ('chemsense', 'so2', 'concentration', (0, 500), 0.01),
+    ('chemsense', 'h2s', 'concentration', (0, 500), 0.01),
+    ('lightsense', 'tsl260rd', 'intensity', (0, 60000), 0.001),
+    ('lightsense', 'apds_9006_020', 'intensity', (0, 60000), 0.001),
+    ('alphasense', 'opc_n2', 'pm1', (0, 100), 1.0),
+    ('alphasense', 'opc_n2', 'pm2_5', (0, 100), 1.0),
+    ('alphasense', 'opc_n2', 'pm10', (0, 100), 1.0),
+]
+
+TARBALL_NAME = f'{PROJECT_ID}.complete.recent.tar'
+BOOT_EVENTS_NAME = load_boot_events.DOWNLOAD_SOURCE.split('/')[-1]
+RSSH_PORTS_NAME = load_rssh_ports.DOWNLOAD_SOURCE.split('/')[-1]
+
+SELECT_LAST_SENSOR_ID = "SELECT coalesce(max(sensor_id), 0) FROM sensors"
+
+# sensors are shared, so only those added since the benchmark started and no
+# longer referenced once its nodes' rows are gone are deleted
+DELETE_BENCH_ROWS = [
+    "DELETE FROM observations WHERE node_id LIKE %(prefix)s",
+    "DELETE FROM node_latest_observation WHERE node_id LIKE %(prefix)s",
+    "DELETE FROM node_latest_values WHERE node_id LIKE %(prefix)s",
+    """
+    DELETE FROM sensors s
+    WHERE s.sensor_id > %(last_sensor_id)s
+        AND NOT EXISTS (SELECT 1 FROM observations o WHERE o.sensor_id = s.sensor_id)
+        AND NOT EXISTS (SELECT 1 FROM node_latest_values v WHERE v.sensor_id = s.sensor_id)
+    """,
+    "DELETE FROM status_transitions WHERE node_id LIKE %(prefix)s",
+    "DELETE FROM status_hourly WHERE node_id LIKE %(prefix)s",
+    "DELETE FROM status_daily WHERE node_id LIKE %(prefix)s",
+    "DELETE FROM boot_events WHERE node_id LIKE %(prefix)s",
+    "DELETE FROM rssh_ports WHERE node_id LIKE %(prefix)s",
+    "DELETE FROM node_hashes WHERE node_id LIKE %(prefix)s",
+    "DELETE FROM projects_nodes WHERE node_id LIKE %(prefix)s",
+    "DELETE FROM nodes WHERE node_id LIKE %(prefix)s",
+    "DELETE FROM ingest_state WHERE project_id = %(project_id)s",
+]
+
+
+def node_id(i):
+    return f'{NODE_ID_PREFIX}{i:06x}'
+
+
+def sensor_specs(count):
+    """
+    Cycles through the sensor list, numbering the parameters once it runs
+    out, so any number of readings per node and timestamp can be made.
+    """
+    specs = []
+    for i in range(count):
+        (subsystem, sensor, parameter, raw_range, scale) = SENSORS[i % len(SENSORS)]
+        if i >= len(SENSORS):
+            parameter = f'{parameter}_{i // len(SENSORS)}'
+        specs.append((subsystem, sensor, parameter, raw_range, scale))
+
+    return specs
+
+
+def write_nodes_csv(fh, nodes):
+    writer = csv.writer(fh)
+    writer.writerow(['node_id', 'project_id', 'vsn', 'address', 'lat', 'lon', 'description',
+                     'start_timestamp', 'end_timestamp'])
+    for i in range(nodes):
+        writer.writerow([
+            node_id(i), PROJECT_ID, f'{i:03X}', f'{i} W Synthetic St Chicago IL',
+            f'{41.65 + random.random() * 0.35:.6f}', f'{-87.85 + random.random() * 0.3:.6f}',
+            'AoT Chicago (S) [C]', '2018/01/01 00:00:00', ''])
+
+
+def write_data_csv(fh, nodes, sensors, steps, start):
+    """
+    Writes one reading per node, sensor and 25 second step, with timestamps in
+    local Chicago time like the real data.csv.
+    """
+    specs = sensor_specs(sensors)
+    chicago = tz.gettz('America/Chicago')
+    writer = csv.writer(fh)
+    writer.writerow(['timestamp', 'node_id', 'subsystem', 'sensor', 'parameter', 'value_raw', 'value_hrf'])
+
+    for step in range(steps):
+        utc = start + timedelta(seconds=25 * step)
+        local = utc.replace(tzinfo=tz.UTC).astimezone(chicago).strftime('%Y/%m/%d %H:%M:%S')
+        for i in range(nodes):
+            nid = node_id(i)
+            for (subsystem, sensor, parameter, (low, high), scale) in specs:
+                raw = random.randint(low, high)
+                writer.writerow([local, nid, subsystem, sensor, parameter, raw, f'{raw * scale:.2f}'])
+
+
+def make_tarball(path, nodes, sensors, steps, start):
+    data = tempfile.TemporaryFile()
+    with gzip.GzipFile(fileobj=data, mode='wb') as gz:
+        write_data_csv(io.TextIOWrapper(gz, encoding='utf8', newline=''), nodes, sensors, steps, start)
+    data.seek(0, os.SEEK_END)
+    data_size = data.tell()
+    data.seek(0)
+
+    nodes_csv = io.StringIO()
+    write_nodes_csv(nodes_csv, nodes)
+    nodes_bytes = nodes_csv.getvalue().encode('utf8')
+
+    prefix = f'{PROJECT_ID}.complete.{start:%Y-%m-%d}'
+    with tarfile.open(path, mode='w') as tarball:
+        member = tarfile.TarInfo(f'{prefix}/nodes.csv')
+        member.size = len(nodes_bytes)
+        tarball.addfile(member, io.BytesIO(nodes_bytes))
+
+        member = tarfile.TarInfo(f'{prefix}/data.csv.gz')
+        member.size = data_size
+        tarball.addfile(member, data)
+
+    data.close()
+
+
+def make_boot_events(path, nodes, boots_per_node, start):
+    with open(path, mode='w', newline='') as fh:
+        writer = csv.writer(fh)
+        writer.writerow(['node_id', 'timestamp', 'boot_id', 'boot_media'])
+        for b in range(boots_per_node):
+            timestamp = (start + timedelta(hours=b)).strftime('%Y/%m/%d %H:%M:%S')
+            for i in range(nodes):
+                writer.writerow([node_id(i), timestamp, f'{random.getrandbits(64):016x}', random.choice(['SD', 'eMMC'])])
+
+
+def make_rssh_ports(path, nodes):
+    with open(path, mode='w') as fh:
+        fh.write(f'Updated on {datetime.now():%a %b %d %H:%M} CDT {datetime.now():%Y}\n')
+        for i in range(nodes):
+            fh.write(f'tcp   {50000 + i:05d}   0000{node_id(i)}  ESTABLISHED\n')
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """
+    Adds the wall time of every round trip to `timer['db']`.
+    """
+
+    timer = {'db': 0.0, 'calls': 0}
+
+    def __timed(self, func, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            TimedCursor.timer['db'] += time.perf_counter() - started
+            TimedCursor.timer['calls'] += 1
+
+    def execute(self, *args, **kwargs):
+        return self.__timed(super().execute, *args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self.__timed(super().executemany, *args, **kwargs)
+
+    def copy_expert(self, *args, **kwargs):
+        return self.__timed(super().copy_expert, *args, **kwargs)
+
+
+class TimedConnection(psycopg2.extensions.connection):
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault('cursor_factory', TimedCursor)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            TimedCursor.timer['db'] += time.perf_counter() - started
+
+
+def __run_child(func, results):
+    # every connection the tasks open in this process gets timed
+    connect = psycopg2.connect
+    psycopg2.connect = partial(connect, connection_factory=TimedConnection)
+
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    func()
+    wall = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+
+    results.put({
+        'wall': wall,
+        'cpu': cpu,
+        'db': TimedCursor.timer['db'],
+        'db_calls': TimedCursor.timer['calls'],
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+
+
+def run_stage(func):
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    child = ctx.Process(target=__run_child, args=(func, results))
+    child.start()
+    child.join()
+    if child.exitcode != 0:
+        raise RuntimeError(f'benchmark child exited with {child.exitcode}')
+
+    return results.get()
+
+
+def serve(directory):
+    handler = partial(QuietHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def last_sensor_id(dsn):
+    conn = psycopg2.connect(dsn)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(SELECT_LAST_SENSOR_ID)
+        (sensor_id,) = cursor.fetchone()
+        return sensor_id
+    finally:
+        conn.close()
+
+
+def clean(dsn, sensor_id):
+    conn = psycopg2.connect(dsn)
+    try:
+        cursor = conn.cursor()
+        for statement in DELETE_BENCH_ROWS:
+            cursor.execute(statement, {
+                'prefix': f'{NODE_ID_PREFIX}%',
+                'project_id': PROJECT_ID,
+                'last_sensor_id': sensor_id,
+            })
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def clear_download_cache():
+    for name in (BOOT_EVENTS_NAME, RSSH_PORTS_NAME):
+        for suffix in ('', '.meta', '.part', '.part.meta'):
+            path = os.path.join(utils.get_download_dir(), f'{name}{suffix}')
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the stages whose rows/sec fell more than `tolerance` below the
+    baseline run's.
+    """
+    regressions = []
+    previous = {r['stage']: r for r in baseline}
+    for result in results:
+        before = previous.get(result['stage'])
+        if before and result['rows_per_sec'] < before['rows_per_sec'] * (1 - tolerance):
+            regressions.append((result['stage'], before['rows_per_sec'], result['rows_per_sec']))
+
+    return regressions
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--nodes', type=int, default=100)
+    argparser.add_argument('--sensors', type=int, default=60, help='readings per node per timestamp')
+    argparser.add_argument('--steps', type=int, default=144, help='25 second timestamps per node')
+    argparser.add_argument('--boots-per-node', type=int, default=24)
+    argparser.add_argument('--modes', nargs='+', default=['copy'], choices=['copy', 'row'])
+    argparser.add_argument('--repeat', type=int, default=1)
+    argparser.add_argument('--output', help='write the results as json')
+    argparser.add_argument('--baseline', help='results json from an earlier run to compare against')
+    argparser.add_argument('--tolerance', type=float, default=0.2, help='allowed rows/sec drop vs the baseline')
+    args = argparser.parse_args()
+
+    _cfg = Config()
+    dsn = _cfg.get_pg_dsn()
+
+    # keep the readings inside the retention window so none are skipped
+    start = datetime.utcnow().replace(microsecond=0) - timedelta(seconds=25 * args.steps + 300)
+    if datetime.utcnow() - start > timedelta(hours=_cfg.observation_retention_hours):
+        sys.exit(f'{args.steps} steps reach past the {_cfg.observation_retention_hours}h retention window')
+
+    directory = tempfile.mkdtemp(prefix='bench_ingest_')
+    data_rows = args.nodes * args.sensors * args.steps
+    print(f'generating {args.nodes} nodes x {args.sensors} sensors x {args.steps} steps = {data_rows} rows')
+    make_tarball(os.path.join(directory, TARBALL_NAME), args.nodes, args.sensors, args.steps, start)
+    make_boot_events(os.path.join(directory, BOOT_EVENTS_NAME), args.nodes, args.boots_per_node, start)
+    make_rssh_ports(os.path.join(directory, RSSH_PORTS_NAME), args.nodes)
+
+    server = serve(directory)
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    load_boot_events.DOWNLOAD_SOURCE = f'{base_url}/{BOOT_EVENTS_NAME}'
+    load_rssh_ports.DOWNLOAD_SOURCE = f'{base_url}/{RSSH_PORTS_NAME}'
+    tarball_url = f'{base_url}/{TARBALL_NAME}'
+
+    results = []
+    sensor_id = last_sensor_id(dsn)
+    try:
+        for mode in args.modes:
+            for _ in range(args.repeat):
+                clean(dsn, sensor_id)
+                clear_download_cache()
+                load_nodes_and_data._cfg.ingest_mode = mode
+
+                stages = [
+                    (f'process_tarball[{mode}]', data_rows, partial(load_nodes_and_data.process_tarball, tarball_url)),
+                    ('load_boot_events.run', args.nodes * args.boots_per_node, load_boot_events.run),
+                    ('load_rssh_ports.run', args.nodes, load_rssh_ports.run),
+                ]
+                for stage, rows, func in stages:
+                    result = run_stage(func)
+                    result.update({'stage': stage, 'rows': rows, 'rows_per_sec': rows / result['wall']})
+                    results.append(result)
+    finally:
+        clean(dsn, sensor_id)
+        clear_download_cache()
+        server.shutdown()
+        shutil.rmtree(directory)
+
+    print(f'{"stage":>24} {"rows":>10} {"wall s":>8} {"rows/sec":>10} {"db s":>8} {"python s":>9} '
+          f'{"cpu s":>7} {"db calls":>9} {"peak rss":>9}')
+    for r in results:
+        print(f'{r["stage"]:>24} {r["rows"]:>10} {r["wall"]:>8.2f} {r["rows_per_sec"]:>10.0f} {r["db"]:>8.2f} '
+              f'{r["wall"] - r["db"]:>9.2f} {r["cpu"]:>7.2f} {r["db_calls"]:>9} {r["peak_rss_mb"]:>7.0f}MB')
+
+    if args.output:
+        with open(args.output, mode='w') as fh:
+            json.dump(results, fh, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            regressions = compare(results, json.load(fh), args.tolerance)
+        for stage, before, after in regressions:
+            print(f'REGRESSION {stage}: {before:.0f} -> {after:.0f} rows/sec')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+"""
+Compares the per-row arrow parse the loaders used to do against the shared
+`utils.TimestampConverter`. The synthetic input mimics data.csv: a few
+thousand distinct timestamps, each shared by many readings, spanning both
+DST transitions.
+
+    $ python bench_timestamps.py --rows 1000000 --readings-per-timestamp 40
+"""
+
+import argparse
+import time
+from datetime import datetime, timedelta
+
+import arrow
+
+import utils
+
+
+def make_timestamps(rows, readings_per_timestamp):
+    start = datetime(2019, 3, 9)
+    values = []
+    step = 0
+    while len(values) < rows:
+        ts = (start + timedelta(seconds=25 * step)).strftime('%Y/%m/%d %H:%M:%S')
+        values.extend([ts] * readings_per_timestamp)
+        step += 1
+
+    return values[:rows]
+
+
+def arrow_path(values):
+    return [
+        arrow.get(f'{value} America/Chicago', 'YYYY/MM/DD HH:mm:ss ZZZ').to('UTC').naive
+        for value in values
+    ]
+
+
+def converter_path(values):
+    return utils.TimestampConverter('America/Chicago').convert_many(values)
+
+
+def bench(label, func, values):
+    started = time.perf_counter()
+    result = func(values)
+    elapsed = time.perf_counter() - started
+    print(f'{label:>10}: {elapsed:8.3f}s  {len(values) / elapsed:12.0f} rows/sec')
+    return result, elapsed
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--rows', type=int, default=200000)
+    argparser.add_argument('--readings-per-timestamp', type=int, default=40)
+    args = argparser.parse_args()
+
+    values = make_timestamps(args.rows, args.readings_per_timestamp)
+    print(f'{len(values)} timestamps, {len(set(values))} distinct')
+
+    expected, arrow_elapsed = bench('arrow', arrow_path, values)
+    actual, converter_elapsed = bench('converter', converter_path, values)
+
+    assert actual == expected, 'converter output differs from arrow'
+    print(f'speedup: {arrow_elapsed / converter_elapsed:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+"""
+Exercises the resumable downloads in `utils` against a stand-in HTTP server on
+localhost that can drop connections part way through a body and change the
+file it serves, without touching the ANL servers:
+
+- `download(save_to_file=True)` survives dropped connections by resuming the
+  `.part` file with `Range`/`If-Range`, and leaves only the file and its
+  `.meta` sidecar behind
+- the next download revalidates with `If-None-Match` and a 304 keeps the file
+- a `.part` left over from an interrupted run is resumed while the file is
+  unchanged upstream, and started over (If-Range mismatch) once it has changed
+- a chunked download that breaks off before its last chunk is resumed the
+  same way
+- `ResumableStream` resumes a dropped tarball stream, and refuses to splice
+  in a body that changed upstream
+- a gzip-encoded stream reads to the end without looking truncated, and a
+  truncated one fails rather than coming up short
+
+    $ python check_downloads.py
+"""
+
+import gzip
+import hashlib
+import http.server
+import json
+import os
+import sys
+import threading
+
+# keep the retries quick; the config is read when utils is imported
+os.environ.setdefault('DOWNLOAD_BACKOFF', '0.01')
+os.environ.setdefault('DOWNLOAD_CHUNK_SIZE', '4096')
+
+import requests
+from urllib3.exceptions import ProtocolError
+
+import utils
+
+
+FILENAME = 'check_downloads.bin'
+
+
+class StandIn:
+    """
+    What the handler serves and how it misbehaves: `drops` responses in a row
+    are cut off a third of the way through. Bodies are sent `chunked` or with
+    a Content-Length, and gzip-encoded when `gzip` is set. Every request's
+    conditional headers are logged.
+    """
+
+    def __init__(self, body):
+        self.body = body
+        self.drops = 0
+        self.chunked = False
+        self.gzip = False
+        self.requests = []
+
+    @property
+    def etag(self):
+        return f'"{hashlib.md5(self.body).hexdigest()}"'
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    stand_in = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        stand_in = self.stand_in
+        (body, etag) = (stand_in.body, stand_in.etag)
+        headers = {name: self.headers.get(name) for name in ('If-None-Match', 'Range', 'If-Range')}
+        stand_in.requests.append(headers)
+
+        if headers['If-None-Match'] == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start = 0
+        if headers['Range'] and headers['If-Range'] in (None, etag):
+            start = int(headers['Range'].split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(body) - 1}/{len(body)}')
+        else:
+            self.send_response(200)
+
+        body = body[start:]
+        if stand_in.gzip:
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('ETag', etag)
+        if stand_in.chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if stand_in.drops > 0:
+            stand_in.drops -= 1
+            self.write_body(body[:len(body) // 3], end=False)
+            self.wfile.flush()
+            self.close_connection = True
+            return
+
+        self.write_body(body)
+
+    def write_body(self, body, end=True):
+        if not self.stand_in.chunked:
+            self.wfile.write(body)
+            return
+
+        for i in range(0, len(body), 65536):
+            chunk = body[i:i + 65536]
+            self.wfile.write(f'{len(chunk):x}\r\n'.encode('ascii') + chunk + b'\r\n')
+        if end:
+            self.wfile.write(b'0\r\n\r\n')
+
+
+def serve(stand_in):
+    handler = type('Handler', (StandInHandler,), {'stand_in': stand_in})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def paths():
+    save_path = os.path.join(utils.get_download_dir(), FILENAME)
+    return {suffix: f'{save_path}{suffix}' for suffix in ('', '.meta', '.part', '.part.meta')}
+
+
+def clear():
+    for path in paths().values():
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def read(path):
+    with open(path, mode='rb') as fh:
+        return fh.read()
+
+
+def leave_part(stand_in, url, length, validator):
+    # what an interrupted run leaves behind
+    p = paths()
+    with open(p['.part'], mode='wb') as fh:
+        fh.write(stand_in.body[:length])
+    with open(p['.part.meta'], mode='w') as fh:
+        json.dump({'url': url, 'validator': validator}, fh)
+
+
+def check(name, ok, detail=''):
+    print(f'{"ok" if ok else "FAIL":>4}  {name}{f" -- {detail}" if detail and not ok else ""}')
+    return ok
+
+
+def check_download(stand_in, url):
+    p = paths()
+    results = []
+
+    stand_in.drops, stand_in.requests = 2, []
+    utils.download(url, save_to_file=True)
+    ranges = [r for r in stand_in.requests if r['Range']]
+    results.append(check('dropped download resumes to the full body', read(p['']) == stand_in.body))
+    results.append(check(
+        'resumes with Range and If-Range', len(ranges) == 2 and all(r['If-Range'] == stand_in.etag for r in ranges),
+        f'{stand_in.requests}'))
+    results.append(check(
+        'only the file and its .meta are left',
+        os.path.exists(p['.meta']) and not os.path.exists(p['.part']) and not os.path.exists(p['.part.meta'])))
+
+    stand_in.requests = []
+    mtime = os.path.getmtime(p[''])
+    utils.download(url, save_to_file=True)
+    results.append(check(
+        'cached copy is revalidated and kept on a 304',
+        stand_in.requests == [{'If-None-Match': stand_in.etag, 'Range': None, 'If-Range': None}]
+        and os.path.getmtime(p['']) == mtime, f'{stand_in.requests}'))
+
+    clear()
+    leave_part(stand_in, url, 1000, stand_in.etag)
+    stand_in.requests = []
+    utils.download(url, save_to_file=True)
+    results.append(check(
+        'leftover .part is resumed while unchanged upstream',
+        read(p['']) == stand_in.body and stand_in.requests[0]['Range'] == 'bytes=1000-', f'{stand_in.requests}'))
+
+    clear()
+    leave_part(stand_in, url, 1000, stand_in.etag)
+    stand_in.body = stand_in.body[::-1]
+    utils.download(url, save_to_file=True)
+    results.append(check('leftover .part is started over once changed upstream', read(p['']) == stand_in.body))
+
+    return results
+
+
+def check_chunked_download(stand_in, url):
+    p = paths()
+    clear()
+
+    stand_in.chunked, stand_in.drops, stand_in.requests = True, 1, []
+    try:
+        utils.download(url, save_to_file=True)
+    finally:
+        stand_in.chunked = False
+
+    ranges = [r for r in stand_in.requests if r['Range']]
+    return [check(
+        'dropped chunked download resumes to the full body',
+        read(p['']) == stand_in.body and len(ranges) == 1, f'{stand_in.requests}')]
+
+
+def check_stream(stand_in, url):
+    results = []
+
+    stand_in.drops = 2
+    with utils.open_stream(url) as res:
+        data = utils.ResumableStream(res).read()
+    results.append(check('dropped stream resumes to the full body', data == stand_in.body))
+
+    stand_in.drops = 1
+    with utils.open_stream(url) as res:
+        stream = utils.ResumableStream(res)
+        stand_in.body = stand_in.body[::-1]
+        try:
+            stream.read()
+            refused = False
+        except requests.HTTPError:
+            refused = True
+    results.append(check('stream refuses to resume once changed upstream', refused))
+
+    stand_in.gzip = True
+    try:
+        with utils.open_stream(url) as res:
+            data = utils.ResumableStream(res).read()
+        results.append(check('gzip-encoded stream reads to the end', data == stand_in.body))
+
+        stand_in.drops = 1
+        with utils.open_stream(url) as res:
+            try:
+                utils.ResumableStream(res).read()
+                failed = False
+            except ProtocolError:
+                failed = True
+        results.append(check('truncated gzip-encoded stream fails', failed))
+    finally:
+        stand_in.gzip = False
+
+    return results
+
+
+def main():
+    stand_in = StandIn(os.urandom(1024 * 1024))
+    server = serve(stand_in)
+    url = f'http://127.0.0.1:{server.server_address[1]}/{FILENAME}'
+
+    clear()
+    try:
+        results = check_download(stand_in, url) + check_chunked_download(stand_in, url) + check_stream(stand_in, url)
+    finally:
+        clear()
+        server.shutdown()
+
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,35 @@ class __BaseConfig:
     rmq_pass  = os.environ.get('RABBITMQ_DEFAULT_PASS',  'guest')
     rmq_vhost = os.environ.get('RABBITMQ_DEFAULT_VHOST', '/')
 
+    ingest_mode     = os.environ.get('INGEST_MODE',         'copy')
+    copy_batch_size = int(os.environ.get('COPY_BATCH_SIZE', '50000'))
+
+    watermark_lag_minutes = int(os.environ.get('INGEST_WATERMARK_LAG_MINUTES', '60'))
+    ingest_task_expires   = int(os.environ.get('INGEST_TASK_EXPIRES',          '300'))
+
+    worker_concurrency    = int(os.environ.get('WORKER_CONCURRENCY',           '4'))
+
+    expire_mode                 = os.environ.get('EXPIRE_MODE',                      'partition')
+    expire_batch_size           = int(os.environ.get('EXPIRE_BATCH_SIZE',            '10000'))
+    observation_retention_hours = int(os.environ.get('OBSERVATION_RETENTION_HOURS',  '24'))
+    partitions_ahead_hours      = int(os.environ.get('PARTITIONS_AHEAD_HOURS',       '6'))
+
+    download_chunk_size      = int(os.environ.get('DOWNLOAD_CHUNK_SIZE',        str(1024 * 1024)))
+    download_connect_timeout = float(os.environ.get('DOWNLOAD_CONNECT_TIMEOUT', '10'))
+    download_read_timeout    = float(os.environ.get('DOWNLOAD_READ_TIMEOUT',    '60'))
+    download_retries         = int(os.environ.get('DOWNLOAD_RETRIES',           '5'))
+    download_backoff         = float(os.environ.get('DOWNLOAD_BACKOFF',         '1.0'))
+
+    upsert_page_size       = int(os.environ.get('UPSERT_PAGE_SIZE',       '1000'))
+    node_ids_cache_seconds = int(os.environ.get('NODE_IDS_CACHE_SECONDS', '3600'))
+
+    ingest_channel = os.environ.get('INGEST_NOTIFY_CHANNEL', 'node_status_ingest')
+
+    # metrics are only pushed when a statsd host is set
+    statsd_host   = os.environ.get('STATSD_HOST',          '')
+    statsd_port   = int(os.environ.get('STATSD_PORT',      '8125'))
+    statsd_prefix = os.environ.get('STATSD_PREFIX',        'node_status')
+
     def get_pg_dsn(self):
         return f"host='{self.pg_host}' port='{self.pg_port}' dbname='{self.pg_dbname}' user='{self.pg_user}' password='{self.pg_pass}'"
 
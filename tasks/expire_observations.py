@@ -1,44 +1,276 @@
 #!/usr/bin/env python3
 
+import logging
+import time
+from datetime import datetime, timedelta
+
 import psycopg2
+from psycopg2 import sql
 
+import metrics
 from app import app
 from config import Config
 
 
+PARTITION_PREFIX = 'observations_p'
+PARTITION_FORMAT = '%Y%m%d%H'
+BOUND_FORMAT = '%Y-%m-%d %H:%M:%S'
+DEFAULT_PARTITION = 'observations_default'
+
+SELECT_PARTITIONS = """
+SELECT c.relname
+FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = 'observations'::regclass
+"""
+
+# rows that landed in the default partition for an hour that is about to get
+# its own partition have to be moved out first or the attach is refused. the
+# table is locked against writes until the partition exists, so an ingest
+# can't put rows back in the default partition in between. the parent is
+# locked (which takes its partitions along with it) rather than just the
+# default partition so the lock is taken in the same order an insert takes it.
+LOCK_OBSERVATIONS = """
+LOCK TABLE observations IN SHARE ROW EXCLUSIVE MODE
+"""
+
+CREATE_MOVED_OBSERVATIONS = """
+CREATE TEMPORARY TABLE moved_observations
+    (LIKE observations)
+ON COMMIT DROP
+"""
+
+MOVE_FROM_DEFAULT_PARTITION = """
+WITH moved AS (
+    DELETE FROM observations_default
+    WHERE timestamp >= %(lower)s
+        AND timestamp < %(upper)s
+    RETURNING *
+)
+INSERT INTO moved_observations
+SELECT * FROM moved
+"""
+
+# postgres 11 only takes plain literals as partition bounds, not the casts
+# psycopg2 renders parameters as, so the bounds are formatted in as literals
+CREATE_PARTITION = """
+CREATE TABLE {partition}
+PARTITION OF observations
+FOR VALUES FROM ( {lower} ) TO ( {upper} )
+"""
+
+RESTORE_MOVED_OBSERVATIONS = """
+INSERT INTO observations
+SELECT * FROM moved_observations
+"""
+
+DROP_PARTITION = """
+DROP TABLE {partition}
+"""
+
+DELETE_EXPIRED_DEFAULT_PARTITION = """
+DELETE FROM observations_default
+WHERE timestamp < %(cutoff)s
+"""
+
+CREATE_EXPIRE_CUTOFFS = """
+CREATE TEMPORARY TABLE expire_cutoffs AS
+SELECT node_id, max(timestamp) - interval '1 hour' AS cutoff
+FROM observations
+GROUP BY node_id
+"""
+
 DELETE_OBSERVATIONS = """
-DELETE FROM observations
-WHERE node_id = %(node_id)s
-    AND timestamp < (%(timestamp)s - interval '1 hour')
+DELETE FROM observations o
+USING expire_cutoffs c
+WHERE o.node_id = c.node_id
+    AND o.timestamp < c.cutoff
+"""
+
+# ctids are only unique within a single partition, so batches run per partition.
+# the expired rows are found in one pass and numbered in physical order, then
+# deleted a slice at a time, so no batch has to search the partition again.
+CREATE_EXPIRED_CTIDS = """
+CREATE TEMPORARY TABLE expired_ctids AS
+SELECT row_number() OVER (ORDER BY o.ctid) AS n, o.ctid AS expired_ctid
+FROM {partition} o
+    JOIN expire_cutoffs c ON c.node_id = o.node_id
+WHERE o.timestamp < c.cutoff
 """
 
+INDEX_EXPIRED_CTIDS = """
+CREATE INDEX ON expired_ctids ( n )
+"""
+
+DELETE_OBSERVATIONS_BATCH = """
+DELETE FROM {partition}
+WHERE ctid = ANY(ARRAY(
+    SELECT expired_ctid
+    FROM expired_ctids
+    WHERE n > %(start)s AND n <= %(end)s
+))
+"""
+
+DROP_EXPIRED_CTIDS = """
+DROP TABLE expired_ctids
+"""
+
+
+def partition_name(hour):
+    return f'{PARTITION_PREFIX}{hour.strftime(PARTITION_FORMAT)}'
+
+
+def get_partitions(conn, cursor):
+    """
+    Returns a dict of hour -> partition name for the hourly partitions that
+    currently exist.
+    """
+    cursor.execute(SELECT_PARTITIONS)
+    names = [name for (name,) in cursor.fetchall()]
+    conn.commit()
+
+    partitions = {}
+    for name in names:
+        if name.startswith(PARTITION_PREFIX):
+            hour = datetime.strptime(name[len(PARTITION_PREFIX):], PARTITION_FORMAT)
+            partitions[hour] = name
+
+    return partitions
+
+
+def create_partition(conn, cursor, hour):
+    name = partition_name(hour)
+    bounds = {'lower': hour, 'upper': hour + timedelta(hours=1)}
+
+    cursor.execute(LOCK_OBSERVATIONS)
+    cursor.execute(CREATE_MOVED_OBSERVATIONS)
+    cursor.execute(MOVE_FROM_DEFAULT_PARTITION, bounds)
+    moved = cursor.rowcount
+    cursor.execute(sql.SQL(CREATE_PARTITION).format(
+        partition=sql.Identifier(name),
+        lower=sql.Literal(bounds['lower'].strftime(BOUND_FORMAT)),
+        upper=sql.Literal(bounds['upper'].strftime(BOUND_FORMAT))))
+    cursor.execute(RESTORE_MOVED_OBSERVATIONS)
+    conn.commit()
+
+    return name, moved
+
+
+def maintain_partitions(conn, cursor, _cfg, logger):
+    """
+    Makes sure there is an hourly partition for every hour from the retention
+    cutoff up to `partitions_ahead_hours` from now, and drops the partitions
+    that have aged out entirely -- retention is a metadata operation rather
+    than a mass delete.
+    """
+    now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    cutoff = now - timedelta(hours=_cfg.observation_retention_hours)
+    partitions = get_partitions(conn, cursor)
+
+    # create upcoming partitions
+    hour = cutoff
+    while hour <= now + timedelta(hours=_cfg.partitions_ahead_hours):
+        if hour not in partitions:
+            name, moved = create_partition(conn, cursor, hour)
+            logger.info(f'created partition {name} ({moved} rows moved from default partition)')
+            metrics.current().count('partitions_created')
+            metrics.current().count('observations_moved', moved)
+
+        hour += timedelta(hours=1)
+
+    # drop expired partitions
+    dropped = 0
+    for hour, name in sorted(partitions.items()):
+        if hour + timedelta(hours=1) <= cutoff:
+            logger.debug(f'dropping partition {name}')
+            cursor.execute(sql.SQL(DROP_PARTITION).format(partition=sql.Identifier(name)))
+            conn.commit()
+            dropped += 1
+
+    # sweep up any strays that are older than the cutoff
+    cursor.execute(DELETE_EXPIRED_DEFAULT_PARTITION, {'cutoff': cutoff})
+    deleted = cursor.rowcount
+    conn.commit()
+
+    logger.info(f'dropped {dropped} partitions and deleted {deleted} rows from the default '
+                f'partition older than {cutoff}')
+    metrics.current().count('partitions_dropped', dropped)
+    metrics.current().count('observations_deleted', deleted)
+
+
+def delete_expired(conn, cursor, _cfg, logger):
+    """
+    Deletes each node's observations older than an hour before its latest
+    observation, either in one set-based statement or in short batched
+    transactions so the ingest tasks are never blocked for long.
+    """
+    logger.info('getting expiry cutoffs per node')
+    cursor.execute(CREATE_EXPIRE_CUTOFFS)
+    conn.commit()
+
+    batch_size = _cfg.expire_batch_size
+    deleted = 0
+
+    if batch_size <= 0:
+        logger.info('deleting all observations older than hour per node')
+        logger.debug(f'delete sql statement:{DELETE_OBSERVATIONS}\n')
+        cursor.execute(DELETE_OBSERVATIONS)
+        deleted = cursor.rowcount
+        conn.commit()
+
+    else:
+        logger.info(f'deleting all observations older than hour per node in batches of {batch_size}')
+        logger.debug(f'delete sql statement:{DELETE_OBSERVATIONS_BATCH}\n')
+
+        partitions = list(get_partitions(conn, cursor).values()) + [DEFAULT_PARTITION]
+        for partition in partitions:
+            cursor.execute(sql.SQL(CREATE_EXPIRED_CTIDS).format(partition=sql.Identifier(partition)))
+            expired = cursor.rowcount
+            cursor.execute(INDEX_EXPIRED_CTIDS)
+            conn.commit()
+
+            statement = sql.SQL(DELETE_OBSERVATIONS_BATCH).format(partition=sql.Identifier(partition))
+            for start in range(0, expired, batch_size):
+                cursor.execute(statement, {'start': start, 'end': start + batch_size})
+                deleted += cursor.rowcount
+                conn.commit()
+
+            cursor.execute(DROP_EXPIRED_CTIDS)
+            conn.commit()
+
+    logger.info(f'deleted {deleted} observations')
+    metrics.current().count('observations_deleted', deleted)
+
 
 @app.task
 def run():
     # init
     _cfg = Config()
     logger = logging.getLogger('expire_observations')
-    conn = psycopg2.connect(_cfg.get_pg_dsn())
-    cursor = conn.cursor()
 
-    # get node id, max(timestamp)
-    logger.info('getting max timestamps per node')
-    cursor.execute('SELECT node_id, max(timestamp) FROM observations GROUP BY node_id')
-    nodes_times = dict((n, t) for (n, t) in cursor.fetchall())
-    conn.commit()
+    with metrics.run('expire_observations', logger, mode=_cfg.expire_mode) as m:
+        conn = psycopg2.connect(_cfg.get_pg_dsn())
+        cursor = conn.cursor()
+        started = time.monotonic()
 
-    # remove all observations older than an hour per node
-    logger.info('deleting all observations older than hour per node')
-    logger.debug(f'delete sql statement:{DELETE_OBSERVATIONS}\n')
-    for node_id, timestamp in nodes_times.items():
-        cursor.execute(DELETE_OBSERVATIONS, {'node_id': node_id, 'timestamp': timestamp})
+        # expire old observations
+        try:
+            with m.stage('db'):
+                if _cfg.expire_mode == 'partition':
+                    maintain_partitions(conn, cursor, _cfg, logger)
+                elif _cfg.expire_mode == 'delete':
+                    delete_expired(conn, cursor, _cfg, logger)
+                else:
+                    raise ValueError(f'unknown expire mode {_cfg.expire_mode}')
 
-    conn.commit()
+            elapsed = time.monotonic() - started
+            logger.info(f'expired observations via {_cfg.expire_mode} in {elapsed:.2f}s')
 
-    # clean up
-    logger.info('cleaning up')
-    cursor.close()
-    conn.close()
+        finally:
+            # clean up
+            logger.info('cleaning up')
+            cursor.close()
+            conn.close()
 
 
 if __name__ == '__main__':
@@ -7,10 +7,10 @@ import logging
 import os
 import tarfile
 
-import arrow
 import psycopg2
 import requests
 
+import metrics
 import utils
 from app import app
 from config import Config
@@ -21,8 +21,7 @@ DOWNLOAD_SOURCE = 'https://www.mcs.anl.gov/research/projects/waggle/downloads/st
 UPSERT_BOOT_EVENT = """
 INSERT INTO boot_events
     (node_id, timestamp, boot_id, boot_media)
-VALUES
-    (%(node_id)s, %(timestamp)s, %(boot_id)s, %(boot_media)s)
+VALUES %s
 ON CONFLICT ( node_id )
     DO UPDATE SET
         timestamp   = EXCLUDED.timestamp,
@@ -30,23 +29,12 @@ ON CONFLICT ( node_id )
         boot_media  = EXCLUDED.boot_media
 """
 
+BOOT_EVENT_TEMPLATE = "(%(node_id)s, %(timestamp)s, %(boot_id)s, %(boot_media)s)"
 
-@app.task
-def run():
-    # init
-    _cfg = Config()
-    logger = logging.getLogger('load_boot_events')
-    conn = psycopg2.connect(_cfg.get_pg_dsn())
-    cursor = conn.cursor()
-
-    # download the csv
-    logger.info(f'downloading source csv')
-
-    download_filename = utils.download(DOWNLOAD_SOURCE, save_to_file=True)
 
+def load_boot_events(cursor, download_filename, logger):
     # get the existing node ids
-    cursor.execute("SELECT node_id FROM nodes")
-    node_ids = set(node for (node,) in cursor.fetchall())
+    node_ids = utils.node_ids.get(cursor)
 
     # rip the csv
     logger.info('ripping source csv')
@@ -55,26 +43,53 @@ def run():
 
     boots = {}
     for row in utils.iter_csv(download_filename):
-        row['timestamp'] = row['timestamp']
-
         node_id = row.pop('node_id')
         if node_id not in node_ids:
             logger.warning(f'{node_id} not present in nodes table')
+            metrics.current().count('unknown_nodes')
             continue
 
         if row['timestamp'] > boots.get(node_id, {'timestamp': ''}).get('timestamp'):
             boots[node_id] = row
 
-    for node_id, row in boots.items():
+    timestamps = utils.utc_to_utc.convert_many(row['timestamp'] for row in boots.values())
+    for (node_id, row), timestamp in zip(boots.items(), timestamps):
         row['node_id'] = node_id
-        row['timestamp'] = arrow.get(row['timestamp']).datetime
-        cursor.execute(UPSERT_BOOT_EVENT, row)
+        row['timestamp'] = timestamp
 
-    conn.commit()
+    # one row per node, so the whole batch can go in a single upsert
+    count = utils.upsert_rows(
+        cursor, UPSERT_BOOT_EVENT, boots.values(),
+        template=BOOT_EVENT_TEMPLATE, page_size=Config().upsert_page_size)
+    logger.info(f'upserted {count} boot events')
+    metrics.current().count('boot_events_upserted', count)
+
+    with metrics.current().stage('db'):
+        utils.notify_ingest(cursor, 'load_boot_events')
+        cursor.connection.commit()
+
+
+@app.task
+def run():
+    # init
+    _cfg = Config()
+    logger = logging.getLogger('load_boot_events')
 
-    # clean up
-    logger.info('cleaning up')
-    os.remove(download_filename)
+    with metrics.run('load_boot_events', logger) as m:
+        # download the csv
+        logger.info(f'downloading source csv')
+
+        # the download is kept and revalidated next run rather than fetched again
+        download_filename = utils.download(DOWNLOAD_SOURCE, save_to_file=True)
+
+        conn = psycopg2.connect(_cfg.get_pg_dsn())
+        try:
+            with m.stage('parse'):
+                load_boot_events(conn.cursor(), download_filename, logger)
+        finally:
+            # clean up
+            logger.info('cleaning up')
+            conn.close()
 
 
 if __name__ == '__main__':
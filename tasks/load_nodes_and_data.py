@@ -3,17 +3,21 @@
 import codecs
 import csv
 import gzip
+import hashlib
 import logging
+import math
 import os
 import os.path
 import re
-import shutil
 import tarfile
+import time
+from datetime import datetime, timedelta
 
-import arrow
 import psycopg2
 import requests
+from celery import group
 
+import metrics
 import utils
 from app import app
 from config import Config
@@ -22,50 +26,188 @@ from config import Config
 TARBALL_LIST_PAGE   = 'https://www.mcs.anl.gov/research/projects/waggle/downloads/datasets/index.php'
 NODES_FILENAME      = 'nodes.csv'
 DATA_ZIPNAME        = 'data.csv.gz'
-DATA_FILENAME       = 'data.csv'
 
-UPSERT_NODE = """
-INSERT INTO nodes
-    (node_id, vsn, address, lat, lon, description)
-VALUES
-    (%(node_id)s, %(vsn)s, %(address)s, %(lat)s, %(lon)s, %(description)s)
-ON CONFLICT ( node_id )
-    DO UPDATE SET
-        vsn             = EXCLUDED.vsn,
-        address         = EXCLUDED.address,
-        lat             = EXCLUDED.lat,
-        lon             = EXCLUDED.lon,
-        description     = EXCLUDED.description
+# nodes.csv rarely changes, so only new or changed rows (by content hash) are
+# sent, and they update nodes, projects_nodes and the stored hashes in one go
+# hashes are keyed by the project_id in each row, which needn't match the one in
+# the tarball's name, so they're looked up under the same key they're stored by
+SELECT_NODE_HASHES = """
+SELECT h.node_id, h.project_id, h.hash
+FROM node_hashes h
+    JOIN projects_nodes p ON p.node_id = h.node_id AND p.project_id = h.project_id
+WHERE h.project_id = ANY(%(project_ids)s)
 """
 
-UPSERT_PROJECT_NODE = """
-INSERT INTO projects_nodes
-    (node_id, project_id, start_timestamp, end_timestamp)
-VALUES
-    (%(node_id)s, %(project_id)s, %(start_timestamp)s, %(end_timestamp)s)
+UPSERT_CHANGED_NODES = """
+WITH changed (node_id, project_id, vsn, address, lat, lon, description, start_timestamp, end_timestamp, hash) AS (
+    VALUES %s
+),
+upserted_nodes AS (
+    INSERT INTO nodes
+        (node_id, vsn, address, lat, lon, description)
+    SELECT node_id, vsn, address, lat, lon, description
+    FROM changed
+    ON CONFLICT ( node_id )
+        DO UPDATE SET
+            vsn             = EXCLUDED.vsn,
+            address         = EXCLUDED.address,
+            lat             = EXCLUDED.lat,
+            lon             = EXCLUDED.lon,
+            description     = EXCLUDED.description
+),
+upserted_projects_nodes AS (
+    INSERT INTO projects_nodes
+        (node_id, project_id, start_timestamp, end_timestamp)
+    SELECT node_id, project_id, start_timestamp, end_timestamp
+    FROM changed
+    ON CONFLICT ( node_id, project_id )
+        DO UPDATE SET
+            start_timestamp = EXCLUDED.start_timestamp,
+            end_timestamp   = EXCLUDED.end_timestamp
+)
+INSERT INTO node_hashes
+    (node_id, project_id, hash)
+SELECT node_id, project_id, hash
+FROM changed
 ON CONFLICT ( node_id, project_id )
     DO UPDATE SET
-        start_timestamp = EXCLUDED.start_timestamp,
-        end_timestamp   = EXCLUDED.end_timestamp
+        hash            = EXCLUDED.hash
 """
 
+CHANGED_NODE_TEMPLATE = """(
+    %(node_id)s, %(project_id)s, %(vsn)s, %(address)s, %(lat)s::float, %(lon)s::float, %(description)s,
+    %(start_timestamp)s::timestamp, %(end_timestamp)s::timestamp, %(hash)s
+)"""
+
+NODE_COLUMNS = (
+    'node_id', 'project_id', 'vsn', 'address', 'lat', 'lon', 'description', 'start_timestamp', 'end_timestamp')
+
 INSERT_OBSERVATION = """
 INSERT INTO observations
-    (timestamp, node_id, subsystem, sensor, parameter, value_raw, value_hrf)
+    (timestamp, node_id, sensor_id, value_raw, value_hrf, value_hrf_text)
 VALUES
-    (%(timestamp)s, %(node_id)s, %(subsystem)s, %(sensor)s, %(parameter)s, %(value_raw)s, %(value_hrf)s)
-ON CONFLICT ( node_id, timestamp, subsystem, sensor, parameter )
+    (%(timestamp)s, %(node_id)s, %(sensor_id)s, %(value_raw)s, %(value_hrf)s, %(value_hrf_text)s)
+ON CONFLICT ( node_id, timestamp, sensor_id )
     DO NOTHING
 """
 
+CREATE_OBSERVATIONS_STAGING = """
+CREATE TEMPORARY TABLE observations_staging (
+    timestamp       TIMESTAMP NOT NULL ,
+    node_id         TEXT NOT NULL ,
+    sensor_id       INTEGER NOT NULL ,
+    value_raw       TEXT NULL ,
+    value_hrf       DOUBLE PRECISION NULL ,
+    value_hrf_text  TEXT NULL
+) ON COMMIT DROP
+"""
+
+# csv copies read an unquoted empty field as NULL; empty raw values are kept as
+# '' like the row inserts store them, while missing hrf values stay NULL
+COPY_OBSERVATIONS_STAGING = """
+COPY observations_staging
+    (timestamp, node_id, sensor_id, value_raw, value_hrf, value_hrf_text)
+FROM STDIN WITH (FORMAT CSV, FORCE_NOT_NULL (value_raw))
+"""
+
+# merges the staged rows and folds the ones that were actually new into the
+# per-node summary and latest values, returning how many were inserted
+MERGE_OBSERVATIONS_STAGING = """
+WITH inserted AS (
+    INSERT INTO observations
+        (timestamp, node_id, sensor_id, value_raw, value_hrf, value_hrf_text)
+    SELECT
+        timestamp, node_id, sensor_id, value_raw, value_hrf, value_hrf_text
+    FROM observations_staging
+    ON CONFLICT ( node_id, timestamp, sensor_id )
+        DO NOTHING
+    RETURNING node_id, timestamp, sensor_id, value_raw, value_hrf
+),
+latest_values AS (
+    INSERT INTO node_latest_values
+        (node_id, sensor_id, timestamp, value_raw, value_hrf)
+    SELECT DISTINCT ON (node_id, sensor_id)
+        node_id, sensor_id, timestamp, value_raw, value_hrf
+    FROM inserted
+    ORDER BY node_id, sensor_id, timestamp DESC
+    ON CONFLICT ( node_id, sensor_id )
+        DO UPDATE SET
+            timestamp   = EXCLUDED.timestamp,
+            value_raw   = EXCLUDED.value_raw,
+            value_hrf   = EXCLUDED.value_hrf
+        WHERE node_latest_values.timestamp <= EXCLUDED.timestamp
+),
+summary AS (
+    SELECT node_id, max(timestamp) AS latest_observation_timestamp, count(*) AS observations_ingested
+    FROM inserted
+    GROUP BY node_id
+),
+upserted AS (
+    INSERT INTO node_latest_observation
+        (node_id, latest_observation_timestamp, observations_ingested)
+    SELECT node_id, latest_observation_timestamp, observations_ingested
+    FROM summary
+    ON CONFLICT ( node_id )
+        DO UPDATE SET
+            latest_observation_timestamp    = GREATEST(node_latest_observation.latest_observation_timestamp, EXCLUDED.latest_observation_timestamp),
+            observations_ingested           = node_latest_observation.observations_ingested + EXCLUDED.observations_ingested
+)
+SELECT COALESCE(sum(observations_ingested), 0)
+FROM summary
+"""
+
+UPSERT_NODE_LATEST_OBSERVATION = """
+INSERT INTO node_latest_observation
+    (node_id, latest_observation_timestamp, observations_ingested)
+VALUES
+    (%(node_id)s, %(latest_observation_timestamp)s, %(observations_ingested)s)
+ON CONFLICT ( node_id )
+    DO UPDATE SET
+        latest_observation_timestamp    = GREATEST(node_latest_observation.latest_observation_timestamp, EXCLUDED.latest_observation_timestamp),
+        observations_ingested           = node_latest_observation.observations_ingested + EXCLUDED.observations_ingested
+"""
+
+UPSERT_NODE_LATEST_VALUES = """
+INSERT INTO node_latest_values
+    (node_id, sensor_id, timestamp, value_raw, value_hrf)
+VALUES %s
+ON CONFLICT ( node_id, sensor_id )
+    DO UPDATE SET
+        timestamp   = EXCLUDED.timestamp,
+        value_raw   = EXCLUDED.value_raw,
+        value_hrf   = EXCLUDED.value_hrf
+    WHERE node_latest_values.timestamp <= EXCLUDED.timestamp
+"""
+
+LATEST_VALUE_TEMPLATE = "(%(node_id)s, %(sensor_id)s, %(timestamp)s, %(value_raw)s, %(value_hrf)s)"
+
+SELECT_INGEST_STATE = """
+SELECT etag, last_modified, content_length, latest_observation_timestamp
+FROM ingest_state
+WHERE project_id = %(project_id)s
+"""
+
+UPSERT_INGEST_STATE = """
+INSERT INTO ingest_state
+    (project_id, etag, last_modified, content_length, latest_observation_timestamp, updated_at)
+VALUES
+    (%(project_id)s, %(etag)s, %(last_modified)s, %(content_length)s, %(latest_observation_timestamp)s, NOW())
+ON CONFLICT ( project_id )
+    DO UPDATE SET
+        etag                            = EXCLUDED.etag,
+        last_modified                   = EXCLUDED.last_modified,
+        content_length                  = EXCLUDED.content_length,
+        latest_observation_timestamp    = GREATEST(ingest_state.latest_observation_timestamp, EXCLUDED.latest_observation_timestamp),
+        updated_at                      = EXCLUDED.updated_at
+"""
+
+OBSERVATION_COLUMNS = ('timestamp', 'node_id', 'sensor_id', 'value_raw', 'value_hrf', 'value_hrf_text')
+
 
 _cfg = Config()
 
 logger = logging.getLogger('load_nodes_and_data')
 
-conn = psycopg2.connect(_cfg.get_pg_dsn())
-cursor = conn.cursor()
-
 ANL_LONLAT = (-87.981930, 41.718427)
 
 DEFAULT_LONLAT = {
@@ -104,43 +246,208 @@ def __check_lonlat(value):
     return value is None or value == '' or value == 0 or value == 0.0 or value == '0' or value == '0.0'
 
 
-def process_tarball(url):
-    # download tarball
-    logger.info(f'downloading source tarball')
-
-    # download the tarball
-    download_filename = utils.download(url, save_to_file=True)
-
-    # extract tarball
-    basedir = os.path.join(
-        os.path.dirname(__file__),
-        'downloads')
-    logger.info(f'decompressing tarball {download_filename}')
-    tarball = tarfile.open(download_filename)
-    extraction_dirname = tarball.getnames()[0]
-    tarball.extractall(path=basedir)
-    tarball.close()
-
-    # delete the tarball
-    os.remove(download_filename)
-
-    dirname = os.path.join(basedir, extraction_dirname)
-    logger.debug(f'dirname={dirname}')
-
-    # rip nodes.csv
-    nodes_filename = os.path.join(dirname, NODES_FILENAME)
+def __to_float(value):
+    # value_hrf is numeric; placeholders like 'NA' are stored as NULL
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+
+    if not math.isfinite(value):
+        return None
+
+    # psycopg2 sends -0.0 as 0, so it's stored as 0 whichever way it's loaded
+    return value + 0.0
+
+
+def __format_hrf(value):
+    # how the export writes value_hrf back out: the shortest text that reads
+    # back as the same float, without a trailing .0
+    text = repr(value)
+    return text[:-2] if text.endswith('.0') else text
+
+
+def __hrf_text(value, text):
+    # the reported text is only kept when the export couldn't reproduce it
+    rendered = '' if value is None else __format_hrf(value)
+    return None if text is None or text == rendered else text
+
+
+def __iter_observations(rows, watermark, progress):
+    sensor_ids = utils.sensor_ids
+    for row in rows:
+        timestamp = row['timestamp'] = utils.chicago_to_utc(row['timestamp'])
+
+        if watermark is not None and timestamp <= watermark:
+            progress['skipped'] += 1
+            continue
+
+        row['sensor_id'] = sensor_ids((row['subsystem'], row['sensor'], row['parameter']))
+        row['value_hrf_text'] = row['value_hrf']
+        row['value_hrf'] = __to_float(row['value_hrf'])
+        row['value_hrf_text'] = __hrf_text(row['value_hrf'], row['value_hrf_text'])
+
+        if progress['latest'] is None or timestamp > progress['latest']:
+            progress['latest'] = timestamp
+
+        yield row
+
+
+def __load_observations_by_row(cursor, rows):
+    logger.debug(f'insert sql template is:{INSERT_OBSERVATION}\n')
+
+    m = metrics.current()
+    count = 0
+    summary = {}
+    latest_values = {}
+    for row in rows:
+        with m.stage('db'):
+            cursor.execute(INSERT_OBSERVATION, row)
+        count += 1
+
+        if cursor.rowcount:
+            node = summary.setdefault(row['node_id'], {
+                'node_id': row['node_id'],
+                'latest_observation_timestamp': row['timestamp'],
+                'observations_ingested': 0,
+            })
+            node['latest_observation_timestamp'] = max(node['latest_observation_timestamp'], row['timestamp'])
+            node['observations_ingested'] += 1
+
+            key = (row['node_id'], row['sensor_id'])
+            if key not in latest_values or latest_values[key]['timestamp'] <= row['timestamp']:
+                latest_values[key] = row
+
+    with m.stage('db'):
+        cursor.executemany(UPSERT_NODE_LATEST_OBSERVATION, summary.values())
+    utils.upsert_rows(
+        cursor, UPSERT_NODE_LATEST_VALUES, latest_values.values(),
+        template=LATEST_VALUE_TEMPLATE, page_size=_cfg.upsert_page_size)
+    return count, sum(node['observations_ingested'] for node in summary.values())
+
+
+def __load_observations_by_copy(cursor, rows):
+    logger.debug(f'copy sql template is:{COPY_OBSERVATIONS_STAGING}\n')
+
+    with metrics.current().stage('db'):
+        cursor.execute(CREATE_OBSERVATIONS_STAGING)
+    count = utils.copy_rows(
+        cursor, COPY_OBSERVATIONS_STAGING,
+        (tuple(row[col] for col in OBSERVATION_COLUMNS) for row in rows),
+        batch_size=_cfg.copy_batch_size)
+
+    logger.debug(f'merge sql statement:{MERGE_OBSERVATIONS_STAGING}\n')
+    with metrics.current().stage('db'):
+        cursor.execute(MERGE_OBSERVATIONS_STAGING)
+        (inserted,) = cursor.fetchone()
+    return count, int(inserted)
+
+
+def load_observations(cursor, rows, mode=None, watermark=None):
+    """
+    Loads observation rows into the database using either the `copy` (staged
+    `COPY FROM STDIN` and a single merge) or the `row` (one insert per row)
+    strategy, and logs the throughput so the two can be compared. Rows at or
+    before `watermark` are dropped before they reach the database.
+
+    Returns the latest observation timestamp that was loaded.
+    """
+    mode = mode or _cfg.ingest_mode
+    if mode == 'row':
+        loader = __load_observations_by_row
+    elif mode == 'copy':
+        loader = __load_observations_by_copy
+    else:
+        raise ValueError(f'unknown ingest mode {mode}')
+
+    progress = {'skipped': 0, 'latest': None}
+
+    m = metrics.current()
+    started = time.monotonic()
+    with m.stage('parse'):
+        count, inserted = loader(cursor, __iter_observations(rows, watermark, progress))
+    with m.stage('db'):
+        cursor.connection.commit()
+    elapsed = time.monotonic() - started
+
+    m.count('observations_read', count + progress['skipped'])
+    m.count('observations_inserted', inserted)
+    m.count('observations_skipped', progress['skipped'])
+
+    rate = count / elapsed if elapsed > 0 else 0
+    logger.info(f'loaded {count} observations ({inserted} new, {progress["skipped"]} skipped '
+                f'at or before watermark {watermark}) in {elapsed:.2f}s via {mode}: {rate:.0f} rows/sec')
+
+    return progress['latest']
+
+
+def get_ingest_state(cursor, project_id):
+    with metrics.current().stage('db'):
+        cursor.execute(SELECT_INGEST_STATE, {'project_id': project_id})
+        row = cursor.fetchone()
+        cursor.connection.commit()
+
+    if row is None:
+        return {}
+
+    return dict(zip(('etag', 'last_modified', 'content_length', 'latest_observation_timestamp'), row))
+
+
+def save_ingest_state(cursor, project_id, res, latest_observation_timestamp):
+    content_length = res.headers.get('Content-Length')
+
+    with metrics.current().stage('db'):
+        cursor.execute(UPSERT_INGEST_STATE, {
+            'project_id': project_id,
+            'etag': res.headers.get('ETag'),
+            'last_modified': res.headers.get('Last-Modified'),
+            'content_length': int(content_length) if content_length else None,
+            'latest_observation_timestamp': latest_observation_timestamp,
+        })
+        utils.notify_ingest(cursor, f'load_nodes_and_data:{project_id}')
+        cursor.connection.commit()
+
+
+def __conditional_headers(state):
+    headers = {}
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'):
+        headers['If-Modified-Since'] = state['last_modified']
+
+    return headers
+
+
+def __is_unchanged(state, res):
+    if res.status_code == 304:
+        return True
+
+    # not every server honors conditional requests, so compare validators too
+    etag = res.headers.get('ETag')
+    if etag and etag == state.get('etag'):
+        return True
+
+    last_modified = res.headers.get('Last-Modified')
+    content_length = res.headers.get('Content-Length')
+    return bool(last_modified) and bool(content_length) \
+        and last_modified == state.get('last_modified') \
+        and int(content_length) == state.get('content_length')
+
+
+def __node_hash(row):
+    return hashlib.md5(repr(tuple(row[column] for column in NODE_COLUMNS)).encode('utf8')).hexdigest()
+
+
+def process_nodes(cursor, rows, project_id):
     logger.info('ripping nodes file')
-    logger.debug(f'nodes_filename={nodes_filename}')
-    logger.debug(f'upsert sql template is:{UPSERT_NODE}\n')
+    logger.debug(f'upsert sql template is:{UPSERT_CHANGED_NODES}\n')
 
-    for row in utils.iter_csv(nodes_filename):
+    nodes = {}
+    for row in rows:
         # fix the insane timestamps in this file
-        row['start_timestamp'] = arrow.get(f'{row["start_timestamp"]} America/Chicago', 'YYYY/MM/DD HH:mm:ss ZZZ').to('UTC').datetime
+        row['start_timestamp'] = utils.chicago_to_utc(row['start_timestamp'])
 
-        if row['end_timestamp'] == '':
-            row['end_timestamp'] = None
-        else:
-            row['end_timestamp'] = arrow.get(f'{row["end_timestamp"]} America/Chicago', 'YYYY/MM/DD HH:mm:ss ZZZ').to('UTC').datetime
+        row['end_timestamp'] = utils.chicago_to_utc(row['end_timestamp'])
 
         # fix missing locations
         if __check_lonlat(row['lon']) or __check_lonlat(row['lat']):
@@ -148,45 +455,123 @@ def process_tarball(url):
             row['lon'] = lon
             row['lat'] = lat
 
-        # upsert node and project/node data
-        cursor.execute(UPSERT_NODE, row)
-        cursor.execute(UPSERT_PROJECT_NODE, row)
+        row['hash'] = __node_hash(row)
+        nodes[row['node_id']] = row
 
-    conn.commit()
+    m = metrics.current()
+    with m.stage('db'):
+        cursor.execute(SELECT_NODE_HASHES, {'project_ids': sorted({row['project_id'] for row in nodes.values()})})
+        hashes = {(node_id, node_project_id): node_hash for (node_id, node_project_id, node_hash) in cursor.fetchall()}
 
-    # extract and rip data.csv.gz
-    datagz_filename = os.path.join(dirname, DATA_ZIPNAME)
-    data_filename = os.path.join(dirname, DATA_FILENAME)
-    logger.debug(f'gunzipping {datagz_filename}')
+    def stored_hash(row):
+        return hashes.get((row['node_id'], row['project_id']))
 
-    with gzip.open(datagz_filename) as ifh:
-        with open(data_filename, 'wb') as ofh:
-            shutil.copyfileobj(ifh, ofh)
+    inserted = [row for row in nodes.values() if stored_hash(row) is None]
+    updated = [row for row in nodes.values() if stored_hash(row) not in (None, row['hash'])]
+    unchanged = len(nodes) - len(inserted) - len(updated)
 
-    logger.info('ripping data file')
-    logger.debug(f'data_filename={data_filename}')
-    logger.debug(f'insert sql template is:{INSERT_OBSERVATION}\n')
+    # upsert new and changed node and project/node data
+    utils.upsert_rows(
+        cursor, UPSERT_CHANGED_NODES, inserted + updated,
+        template=CHANGED_NODE_TEMPLATE, page_size=_cfg.upsert_page_size)
+    with m.stage('db'):
+        cursor.connection.commit()
+
+    m.count('nodes_inserted', len(inserted))
+    m.count('nodes_updated', len(updated))
+    m.count('nodes_unchanged', unchanged)
 
-    for row in utils.iter_csv(data_filename):
-        row['timestamp'] = arrow.get(f'{row["timestamp"]} America/Chicago', 'YYYY/MM/DD HH:mm:ss ZZZ').to('UTC').datetime
-        cursor.execute(INSERT_OBSERVATION, row)
+    logger.info(f'{project_id} nodes: {len(inserted)} inserted, {len(updated)} updated, {unchanged} unchanged')
+    if inserted:
+        utils.node_ids.invalidate()
 
-    conn.commit()
 
-    # clean up
-    logger.info('cleaning up')
-    shutil.rmtree(dirname)
+def __project_id(url):
+    return url.split('/')[-1].split('.')[0]
+
+
+def __process_tarball(cursor, url):
+    project_id = __project_id(url)
+    state = get_ingest_state(cursor, project_id)
+    logger.debug(f'project_id={project_id} ingest state={state}')
+
+    # re-examine a trailing window behind the watermark so readings that
+    # arrive upstream late are still picked up -- the merge dedupes them
+    watermark = state.get('latest_observation_timestamp')
+    if watermark is not None:
+        watermark -= timedelta(minutes=_cfg.watermark_lag_minutes)
+
+    # don't bother loading rows whose partition would be dropped already
+    if _cfg.expire_mode == 'partition':
+        retention_cutoff = datetime.utcnow() - timedelta(hours=_cfg.observation_retention_hours)
+        watermark = max(watermark or retention_cutoff, retention_cutoff)
+
+    # stream the tarball straight off the wire -- members are handled in the
+    # order they appear in the archive and nothing is written to disk. if the
+    # connection drops part way, the stream resumes where it left off.
+    logger.info(f'streaming source tarball {url}')
+
+    with utils.open_stream(url, headers=__conditional_headers(state)) as res:
+        if __is_unchanged(state, res):
+            logger.info(f'{project_id} tarball unchanged since last ingest; skipping')
+            metrics.current().count('tarballs_unchanged')
+            __record_lag(state.get('latest_observation_timestamp'))
+            return
+
+        latest = None
+        with tarfile.open(fileobj=utils.ResumableStream(res), mode='r|') as tarball:
+            for member in tarball:
+                filename = os.path.basename(member.name)
+                logger.debug(f'tarball member {member.name}')
+
+                if filename == NODES_FILENAME:
+                    with metrics.current().stage('parse'):
+                        process_nodes(cursor, utils.iter_csv_stream(tarball.extractfile(member)), project_id)
+
+                elif filename == DATA_ZIPNAME:
+                    logger.info('ripping data file')
+                    with gzip.open(tarball.extractfile(member)) as fh:
+                        latest = load_observations(cursor, utils.iter_csv_stream(fh), watermark=watermark)
+
+        save_ingest_state(cursor, project_id, res, latest)
+        __record_lag(max(filter(None, [latest, state.get('latest_observation_timestamp')]), default=None))
+
+
+def __record_lag(latest):
+    # how far behind real time the newest loaded observation is -- what to alert on
+    if latest is not None:
+        metrics.current().gauge('ingest_lag_seconds', round((datetime.utcnow() - latest).total_seconds()))
 
 
 @app.task
-def run():
-    urls = scrape_list_page()
-    for url in urls:
+def process_tarball(url):
+    # each tarball gets its own connection so projects can load in parallel
+    with metrics.run('load_nodes_and_data', logger, project_id=__project_id(url)):
+        conn = psycopg2.connect(_cfg.get_pg_dsn())
         try:
-            process_tarball(url)
+            __process_tarball(conn.cursor(), url)
         except Exception as e:
-            logger.error(f'{e}')
+            logger.error(f'{url}: {e}')
+            raise
+        finally:
+            conn.close()
+            utils.sensor_ids.close()
+
+
+@app.task
+def run():
+    # fan out one subtask per project; worker concurrency bounds how many load
+    # at once, and subtasks still queued when the next beat fires are dropped
+    with metrics.run('load_nodes_and_data.run', logger) as m:
+        urls = scrape_list_page()
+        m.count('tarballs_listed', len(urls))
+
+    group(
+        process_tarball.signature((url,), expires=_cfg.ingest_task_expires)
+        for url in urls
+    ).apply_async()
 
 
 if __name__ == '__main__':
-    run()
\ No newline at end of file
+    for url in scrape_list_page():
+        process_tarball(url)
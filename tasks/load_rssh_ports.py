@@ -10,10 +10,10 @@ import shutil
 import tarfile
 from datetime import date, datetime
 
-import arrow
 import psycopg2
 import requests
 
+import metrics
 import utils
 from app import app
 from config import Config
@@ -26,34 +26,26 @@ NODE_ID_AND_PORT_RE = re.compile('.{6}(?P<port>\d{5})\s+0*(?P<node_id>001e06\w+)
 UPSERT_RSSH_PORT = """
 INSERT INTO rssh_ports
     (node_id, timestamp, port)
-VALUES
-    (%(node_id)s, %(timestamp)s, %(port)s)
+VALUES %s
 ON CONFLICT ( node_id )
     DO UPDATE SET
         timestamp   = EXCLUDED.timestamp,
         port        = EXCLUDED.port
 """
 
+RSSH_PORT_TEMPLATE = "(%(node_id)s, %(timestamp)s, %(port)s)"
 
-@app.task
-def run():
-    # init
-    _cfg = Config()
-    logger = logging.getLogger('load_rssh_ports')
-    conn = psycopg2.connect(_cfg.get_pg_dsn())
-    cursor = conn.cursor()
-
-    download_filename = utils.download(DOWNLOAD_SOURCE, save_to_file=True)
 
+def load_rssh_ports(cursor, download_filename, logger):
     # get the existing node ids
-    cursor.execute("SELECT node_id FROM nodes")
-    node_ids = set(node for (node,) in cursor.fetchall())
+    node_ids = utils.node_ids.get(cursor)
 
     # rip the csv
     logger.info('ripping source csv')
     logger.debug(f'download_filename={download_filename}')
     logger.debug(f'upsert sql template is:{UPSERT_RSSH_PORT}\n')
 
+    ports = {}
     timestamp = None
     with codecs.open(download_filename, 'r', encoding='utf8') as fh:
         for line in fh:
@@ -63,9 +55,7 @@ def run():
                 if m:
                     time = m.groupdict().get('time')
                     if time:
-                        timestamp = arrow.get(
-                            f'{date.today().isoformat()} {time} America/Chicago',
-                            'YYYY-MM-DD HH:mm ZZZ').datetime
+                        timestamp = utils.chicago_to_utc(f'{date.today().isoformat()} {time}:00')
                         logger.debug(f'timestamp set to {timestamp}')
                         continue
                     else:
@@ -82,16 +72,42 @@ def run():
 
                 if node_id not in node_ids:
                     logger.warning(f'{node_id} not present in nodes table')
+                    metrics.current().count('unknown_nodes')
                 elif node_id and port:
-                    cursor.execute(UPSERT_RSSH_PORT, {'node_id': node_id, 'timestamp': timestamp, 'port': port})
+                    # the last line for a node wins, as it did when each line was its own upsert
+                    ports[node_id] = {'node_id': node_id, 'timestamp': timestamp, 'port': port}
                 else:
                     logger.warning(f'data line regex hit but no parse result: {line}')
 
-    conn.commit()
+    count = utils.upsert_rows(
+        cursor, UPSERT_RSSH_PORT, ports.values(),
+        template=RSSH_PORT_TEMPLATE, page_size=Config().upsert_page_size)
+    logger.info(f'upserted {count} rssh ports')
+    metrics.current().count('rssh_ports_upserted', count)
+
+    with metrics.current().stage('db'):
+        utils.notify_ingest(cursor, 'load_rssh_ports')
+        cursor.connection.commit()
+
+
+@app.task
+def run():
+    # init
+    _cfg = Config()
+    logger = logging.getLogger('load_rssh_ports')
 
-    # clean up
-    logger.info('cleaning up')
-    os.remove(download_filename)
+    with metrics.run('load_rssh_ports', logger) as m:
+        # the download is kept and revalidated next run rather than fetched again
+        download_filename = utils.download(DOWNLOAD_SOURCE, save_to_file=True)
+
+        conn = psycopg2.connect(_cfg.get_pg_dsn())
+        try:
+            with m.stage('parse'):
+                load_rssh_ports(conn.cursor(), download_filename, logger)
+        finally:
+            # clean up
+            logger.info('cleaning up')
+            conn.close()
 
 
 if __name__ == '__main__':
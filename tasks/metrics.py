@@ -0,0 +1,149 @@
+"""
+Per-run instrumentation for the tasks: stage timers, counters and gauges
+collected while a task runs, then written out as one structured summary log
+line and, when `STATSD_HOST` is set, pushed to a statsd compatible sink.
+
+    with metrics.run('load_boot_events', logger) as m:
+        with m.stage('download'):
+            ...
+        m.count('boot_events_upserted', count)
+
+Code further down the call stack (downloads, the timestamp converter, copy
+buffers) records into whichever run is active via `metrics.current()`.
+Stages nest and their times are exclusive -- time spent in an inner stage is
+taken out of the outer one -- so the stage times add up to the run's duration
+and a `parse` stage wrapping a streamed load shows only the parsing itself.
+"""
+
+import json
+import logging
+import re
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from config import Config
+
+
+logger = logging.getLogger('metrics')
+
+_local = threading.local()
+
+
+class TaskMetrics:
+    def __init__(self, task, **labels):
+        self.task = task
+        self.labels = labels
+        self.stages = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self._children = []
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        self._children.append(0.0)
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started, self._children.pop())
+
+    def add_time(self, name, elapsed, children=0.0):
+        """
+        Records `elapsed` seconds against a stage, for code that times itself
+        rather than using `stage`.
+        """
+        self.stages[name] += elapsed - children
+        if self._children:
+            self._children[-1] += elapsed
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def summary(self, status, duration):
+        return dict(self.labels, **{
+            'task': self.task,
+            'status': status,
+            'duration': round(duration, 3),
+            'stages': {name: round(elapsed, 3) for name, elapsed in sorted(self.stages.items())},
+            'counters': dict(sorted(self.counters.items())),
+            'gauges': dict(sorted(self.gauges.items())),
+        })
+
+
+# records from outside any run land here and are never reported
+_detached = TaskMetrics('detached')
+
+
+def current():
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else _detached
+
+
+@contextmanager
+def run(task, task_logger=None, **labels):
+    """
+    Collects metrics for one run of a task. The summary is logged and pushed
+    whether the run succeeds or fails; unaccounted time goes to an `other`
+    stage.
+    """
+    metrics = TaskMetrics(task, **labels)
+    stack = _local.__dict__.setdefault('stack', [])
+    stack.append(metrics)
+
+    status = 'ok'
+    started = time.perf_counter()
+    try:
+        with metrics.stage('other'):
+            yield metrics
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        stack.pop()
+        summary = metrics.summary(status, duration)
+        (task_logger or logger).info(f'metrics {json.dumps(summary, sort_keys=True, default=str)}')
+        push(summary)
+
+
+def _name(*parts):
+    return '.'.join(re.sub(r'[^\w\-]', '_', str(part)) for part in parts if part)
+
+
+def statsd_lines(summary, prefix):
+    """
+    Formats a run summary as statsd lines. Labels become part of the metric
+    path, e.g. `node_status.load_nodes_and_data.AoT_Chicago.stage.download`.
+    """
+    reserved = ('task', 'status', 'duration', 'stages', 'counters', 'gauges')
+    base = _name(prefix, summary['task'], *(summary[k] for k in sorted(summary) if k not in reserved))
+
+    lines = [
+        f'{base}.runs.{summary["status"]}:1|c',
+        f'{base}.duration:{summary["duration"] * 1000:.0f}|ms',
+    ]
+    lines.extend(f'{base}.stage.{_name(name)}:{elapsed * 1000:.0f}|ms' for name, elapsed in summary['stages'].items())
+    lines.extend(f'{base}.{_name(name)}:{value}|c' for name, value in summary['counters'].items())
+    lines.extend(f'{base}.{_name(name)}:{value}|g' for name, value in summary['gauges'].items())
+    return lines
+
+
+def push(summary):
+    _cfg = Config()
+    if not _cfg.statsd_host:
+        return
+
+    # a few lines per datagram keeps packets well under the usual mtu
+    lines = statsd_lines(summary, _cfg.statsd_prefix)
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            for i in range(0, len(lines), 8):
+                sock.sendto('\n'.join(lines[i:i + 8]).encode('utf8'), (_cfg.statsd_host, _cfg.statsd_port))
+    except OSError as e:
+        logger.warning(f'failed to push metrics to statsd: {e}')
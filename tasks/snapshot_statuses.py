@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+import logging
+from datetime import datetime
+
+import psycopg2
+
+import metrics
+import utils
+from app import app
+from config import Config
+
+
+# node_status() in 00-init.sql holds the status rules, so this agrees with
+# the web tier's status queries (web/queries.py), evaluated as of %(now)s.
+# each node gets one status across its projects: it only counts as
+# decommissioned (black) once every one of its projects has ended.
+CREATE_CURRENT_STATUSES = """
+CREATE TEMPORARY TABLE current_statuses ON COMMIT DROP AS
+SELECT
+    n.node_id,
+    node_status(
+        p.start_timestamp, p.end_timestamp,
+        o.latest_observation_timestamp, b.timestamp, r.timestamp,
+        %(now)s
+    ) AS status
+FROM
+    nodes n
+    LEFT JOIN (
+        SELECT
+            node_id,
+            min(start_timestamp) AS start_timestamp,
+            CASE WHEN bool_and(end_timestamp IS NOT NULL) THEN max(end_timestamp) END AS end_timestamp
+        FROM projects_nodes
+        GROUP BY node_id
+    ) p ON p.node_id = n.node_id
+    LEFT JOIN node_latest_observation o ON o.node_id = n.node_id
+    LEFT JOIN boot_events b ON b.node_id = n.node_id
+    LEFT JOIN rssh_ports r ON r.node_id = n.node_id
+"""
+
+# ends the open runs of nodes whose status changed or that are gone altogether
+CLOSE_TRANSITIONS = """
+UPDATE status_transitions t
+SET end_timestamp = %(now)s
+WHERE
+    t.end_timestamp IS NULL
+    AND NOT EXISTS (
+        SELECT 1
+        FROM current_statuses c
+        WHERE c.node_id = t.node_id AND c.status = t.status
+    )
+"""
+
+OPEN_TRANSITIONS = """
+INSERT INTO status_transitions
+    (node_id, start_timestamp, status)
+SELECT c.node_id, %(now)s, c.status
+FROM current_statuses c
+WHERE NOT EXISTS (
+    SELECT 1
+    FROM status_transitions t
+    WHERE t.node_id = c.node_id AND t.end_timestamp IS NULL
+)
+"""
+
+# hours are rolled up again from the latest one that has a rollup, since it
+# (and the ones since) were still in progress when they were last computed
+SELECT_ROLLUP_START = """
+SELECT COALESCE(
+    (SELECT max(bucket) FROM status_hourly),
+    (SELECT date_trunc('hour', min(start_timestamp)) FROM status_transitions)
+)
+"""
+
+# the seconds each node spent in each status per hour, with the open runs
+# counted up to %(now)s
+UPSERT_HOURLY_ROLLUP = """
+WITH hours AS (
+    SELECT generate_series(%(since)s, date_trunc('hour', %(now)s), interval '1 hour') AS bucket
+),
+spans AS (
+    SELECT
+        h.bucket,
+        t.node_id,
+        t.status,
+        extract(epoch FROM
+            LEAST(COALESCE(t.end_timestamp, %(now)s), h.bucket + interval '1 hour')
+            - GREATEST(t.start_timestamp, h.bucket)
+        ) AS seconds
+    FROM
+        status_transitions t
+        JOIN hours h
+            ON t.start_timestamp < h.bucket + interval '1 hour'
+            AND COALESCE(t.end_timestamp, %(now)s) > h.bucket
+    WHERE
+        t.end_timestamp IS NULL OR t.end_timestamp > %(since)s
+)
+INSERT INTO status_hourly
+    (bucket, node_id, status, seconds)
+SELECT bucket, node_id, status, sum(seconds)
+FROM spans
+GROUP BY bucket, node_id, status
+HAVING sum(seconds) > 0
+ON CONFLICT ( bucket, node_id, status )
+    DO UPDATE SET
+        seconds = EXCLUDED.seconds
+"""
+
+UPSERT_DAILY_ROLLUP = """
+INSERT INTO status_daily
+    (bucket, node_id, status, seconds)
+SELECT date_trunc('day', bucket), node_id, status, sum(seconds)
+FROM status_hourly
+WHERE bucket >= date_trunc('day', %(since)s::timestamp)
+GROUP BY date_trunc('day', bucket), node_id, status
+ON CONFLICT ( bucket, node_id, status )
+    DO UPDATE SET
+        seconds = EXCLUDED.seconds
+"""
+
+
+def snapshot(cursor, now, logger):
+    """
+    Records each node's current status in `status_transitions`. Only changes
+    are stored: a node keeps a single open run for as long as its status stays
+    the same, so the table grows with the number of transitions rather than
+    the number of snapshots.
+    """
+    params = {'now': now}
+    cursor.execute(CREATE_CURRENT_STATUSES, params)
+    cursor.execute(CLOSE_TRANSITIONS, params)
+    closed = cursor.rowcount
+    cursor.execute(OPEN_TRANSITIONS, params)
+    opened = cursor.rowcount
+
+    logger.info(f'closed {closed} and opened {opened} status runs')
+    metrics.current().count('status_runs_closed', closed)
+    metrics.current().count('status_runs_opened', opened)
+
+
+def rollup(cursor, now, logger):
+    """
+    Refreshes the hourly rollups for the hours since the last run, then the
+    daily rollups for the days those hours fall in, so reports over months of
+    history only ever read the rollups.
+    """
+    cursor.execute(SELECT_ROLLUP_START)
+    (since,) = cursor.fetchone()
+    if since is None:
+        logger.info('no status runs to roll up')
+        return
+
+    params = {'now': now, 'since': since}
+    cursor.execute(UPSERT_HOURLY_ROLLUP, params)
+    hourly = cursor.rowcount
+    cursor.execute(UPSERT_DAILY_ROLLUP, params)
+    daily = cursor.rowcount
+
+    logger.info(f'rolled up {hourly} hourly and {daily} daily status rows since {since}')
+    metrics.current().count('status_hourly_upserted', hourly)
+    metrics.current().count('status_daily_upserted', daily)
+
+
+@app.task
+def run():
+    # init
+    _cfg = Config()
+    logger = logging.getLogger('snapshot_statuses')
+
+    with metrics.run('snapshot_statuses', logger) as m:
+        conn = psycopg2.connect(_cfg.get_pg_dsn())
+        cursor = conn.cursor()
+        now = datetime.utcnow().replace(microsecond=0)
+
+        try:
+            with m.stage('db'):
+                snapshot(cursor, now, logger)
+                rollup(cursor, now, logger)
+                utils.notify_ingest(cursor, 'snapshot_statuses')
+                conn.commit()
+
+        finally:
+            # clean up
+            logger.info('cleaning up')
+            cursor.close()
+            conn.close()
+
+
+if __name__ == '__main__':
+    run()
@@ -1,9 +1,243 @@
 
 import codecs
 import csv
+import io
+import json
+import logging
+import os
 import os.path
+import threading
+import time
+from datetime import datetime, timezone
+from functools import partial
 
+import psycopg2
 import requests
+from dateutil import parser as dateparser
+from dateutil import tz
+from psycopg2.extras import execute_values
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from urllib3.util.retry import Retry
+
+import metrics
+from config import Config
+
+
+logger = logging.getLogger('utils')
+
+
+class TimestampConverter:
+    """
+    Converts wall-clock timestamp strings in a given timezone to naive UTC
+    datetimes, which is what the `TIMESTAMP` columns store.
+
+    The fixed-width `YYYY/MM/DD HH:mm:ss` layout used by the AoT files (any
+    separators) is sliced directly instead of going through a format parser.
+    UTC offsets are resolved once per local hour -- DST transitions always fall
+    on the hour -- and whole strings are memoized, since every reading in a
+    batch shares a handful of timestamps. Ambiguous fall-back times resolve to
+    the first (daylight) occurrence. Anything else, e.g. strings carrying their
+    own UTC offset, falls back to dateutil.
+    """
+
+    def __init__(self, tzname, memo_size=65536):
+        self.tzinfo = tz.gettz(tzname)
+        self.memo_size = memo_size
+        self._offsets = {}
+        self._memo = {}
+
+    def __call__(self, value):
+        if not value:
+            return None
+
+        result = self._memo.get(value)
+        if result is None:
+            if len(self._memo) >= self.memo_size:
+                self._memo.clear()
+
+            started = time.perf_counter()
+            result = self._memo[value] = self._convert(value)
+            metrics.current().add_time('timestamps', time.perf_counter() - started)
+
+        return result
+
+    def convert_many(self, values):
+        return [self(value) for value in values]
+
+    def _convert(self, value):
+        if len(value) != 19:
+            return self._convert_slow(value)
+
+        try:
+            local = datetime(
+                int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                int(value[11:13]), int(value[14:16]), int(value[17:19]))
+        except ValueError:
+            return self._convert_slow(value)
+
+        hour = value[:13]
+        offset = self._offsets.get(hour)
+        if offset is None:
+            offset = self._offsets[hour] = local.replace(
+                minute=0, second=0, tzinfo=self.tzinfo).utcoffset()
+
+        return local - offset
+
+    def _convert_slow(self, value):
+        parsed = dateparser.parse(value)
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=self.tzinfo)
+
+        return parsed.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+# the nodes and data files report local time; boot events are already utc
+chicago_to_utc = TimestampConverter('America/Chicago')
+utc_to_utc = TimestampConverter('UTC')
+
+
+def notify_ingest(cursor, source):
+    """
+    Tells listeners (e.g. the web tier's caches) that `source` loaded new data.
+    Postgres only delivers the notification once the transaction commits.
+    """
+    cursor.execute('SELECT pg_notify(%(channel)s, %(source)s)', {
+        'channel': Config().ingest_channel,
+        'source': source,
+    })
+
+
+class NodeIdCache:
+    """
+    The set of node ids in the nodes table, shared by the loaders that only
+    accept rows for known nodes. Nodes are upserted but never deleted, so the
+    set is only reloaded when the row count changes (one tiny query instead
+    of pulling every id each run) or it's older than `max_age` seconds.
+    """
+
+    def __init__(self, max_age=3600):
+        self.max_age = max_age
+        self._node_ids = None
+        self._count = None
+        self._loaded = 0
+        self._lock = threading.Lock()
+
+    def get(self, cursor):
+        with metrics.current().stage('db'):
+            cursor.execute('SELECT count(*) FROM nodes')
+            (count,) = cursor.fetchone()
+
+            with self._lock:
+                if self._node_ids is None or count != self._count or time.monotonic() - self._loaded > self.max_age:
+                    cursor.execute('SELECT node_id FROM nodes')
+                    self._node_ids = frozenset(node for (node,) in cursor.fetchall())
+                    self._count = count
+                    self._loaded = time.monotonic()
+
+                return self._node_ids
+
+    def invalidate(self):
+        with self._lock:
+            self._node_ids = None
+
+
+node_ids = NodeIdCache(Config().node_ids_cache_seconds)
+
+
+class SensorIdCache:
+    """
+    Maps (subsystem, sensor, parameter) to its id in the sensors dimension
+    table. The whole table is read on the first miss, and sensors that aren't
+    there yet are added right away on a separate autocommit connection -- ids
+    then never point at rows an ingest rollback took back, and parallel loads
+    don't wait on each other's open transactions to claim a new sensor. The
+    connection is opened on demand, and `close()` hands it back at the end of
+    each load so an idle worker doesn't hold a backend.
+    """
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self._ids = {}
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __call__(self, key):
+        sensor_id = self._ids.get(key)
+        if sensor_id is None:
+            with metrics.current().stage('db'), self._lock:
+                sensor_id = self._resolve(key)
+
+        return sensor_id
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+    def _connection(self):
+        # connections can't be shared across celery's forks
+        if self._conn is None or self._conn.closed or self._pid != os.getpid():
+            self._conn = psycopg2.connect(self.dsn)
+            self._conn.autocommit = True
+            self._pid = os.getpid()
+            self._ids = {}
+
+        return self._conn
+
+    def _resolve(self, key):
+        cursor = self._connection().cursor()
+        if not self._ids:
+            cursor.execute('SELECT subsystem, sensor, parameter, sensor_id FROM sensors')
+            self._ids = {tuple(row[:3]): row[3] for row in cursor.fetchall()}
+
+        if key not in self._ids:
+            params = dict(zip(('subsystem', 'sensor', 'parameter'), key))
+            cursor.execute(INSERT_SENSOR, params)
+            row = cursor.fetchone()
+            if row is None:
+                cursor.execute(SELECT_SENSOR, params)
+                row = cursor.fetchone()
+
+            self._ids[key] = row[0]
+
+        return self._ids[key]
+
+
+INSERT_SENSOR = """
+INSERT INTO sensors
+    (subsystem, sensor, parameter)
+VALUES
+    (%(subsystem)s, %(sensor)s, %(parameter)s)
+ON CONFLICT ( subsystem, sensor, parameter )
+    DO NOTHING
+RETURNING sensor_id
+"""
+
+SELECT_SENSOR = """
+SELECT sensor_id
+FROM sensors
+WHERE subsystem = %(subsystem)s AND sensor = %(sensor)s AND parameter = %(parameter)s
+"""
+
+sensor_ids = SensorIdCache(Config().get_pg_dsn())
+
+
+def upsert_rows(cursor, sql, rows, template=None, page_size=1000):
+    """
+    Runs an `INSERT ... VALUES %s ... ON CONFLICT` statement for a whole
+    iterable of rows with `execute_values`, `page_size` rows per round trip.
+    A single statement can't touch the same row twice, so callers have to
+    dedupe on the conflict key first. Returns the number of rows sent.
+    """
+    rows = list(rows)
+    if rows:
+        with metrics.current().stage('db'):
+            execute_values(cursor, sql, rows, template=template, page_size=page_size)
+
+    return len(rows)
 
 
 def get_download_dir():
@@ -17,21 +251,153 @@ def get_download_dir():
     return dirname
 
 
+_session = None
+_session_pid = None
+
+
+def get_session():
+    """
+    A keep-alive `requests.Session` per process (celery forks its workers, and
+    pooled sockets mustn't be shared across a fork). Connection errors and
+    5xx responses are retried with exponential backoff before any body is read.
+    """
+    global _session, _session_pid
+
+    if _session is None or _session_pid != os.getpid():
+        _cfg = Config()
+        retry = Retry(
+            total=_cfg.download_retries,
+            backoff_factor=_cfg.download_backoff,
+            status_forcelist=(500, 502, 503, 504),
+            raise_on_status=False)
+
+        _session = requests.Session()
+        _session.mount('http://', HTTPAdapter(max_retries=retry))
+        _session.mount('https://', HTTPAdapter(max_retries=retry))
+        _session_pid = os.getpid()
+
+    return _session
+
+
+def __timeout():
+    _cfg = Config()
+    return (_cfg.download_connect_timeout, _cfg.download_read_timeout)
+
+
 def download(url, save_to_file=False):
+    """
+    Downloads `url` into memory, or into the download dir when `save_to_file`
+    is set. Saved files are kept as a cache: the next download of the same url
+    revalidates them with `If-None-Match`/`If-Modified-Since` and a 304 reuses
+    the file as is, and a transfer that breaks off part way is resumed with a
+    `Range` request rather than started over.
+    """
     if save_to_file:
         download_dirname = get_download_dir()
         fname_part = url.split('/')[-1]
         save_path = os.path.join(download_dirname, fname_part)
 
-        if os.path.exists(save_path):
-            os.remove(save_path)
-
         return __download_to_file(url, save_path)
 
     else:
         return __download_to_mem(url)
 
 
+def open_stream(url, headers=None):
+    with metrics.current().stage('download'):
+        res = get_session().get(url, stream=True, headers=headers, timeout=__timeout())
+    res.raise_for_status()
+    res.raw.decode_content = True
+    return res
+
+
+class ResumableStream:
+    """
+    A file-like view of a streamed response body that picks up where it left
+    off with a `Range` request (guarded by `If-Range`, so a file that changed
+    upstream in the meantime isn't spliced together) when the connection
+    drops part way through. Bodies that are content-encoded, or served without
+    an `ETag`/`Last-Modified` validator, can't be resumed safely and just fail
+    as before.
+    """
+
+    def __init__(self, res, retries=None, backoff=None):
+        _cfg = Config()
+        self.res = res
+        self.url = res.url
+        self.timeout = (_cfg.download_connect_timeout, _cfg.download_read_timeout)
+        self.retries = _cfg.download_retries if retries is None else retries
+        self.backoff = _cfg.download_backoff if backoff is None else backoff
+        self.offset = 0
+
+        self.validator = res.headers.get('ETag') or res.headers.get('Last-Modified')
+        if res.headers.get('Content-Encoding', 'identity') != 'identity':
+            self.validator = None
+
+        self.length = self.__content_length()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            # a dropped connection ends an unbounded read early without an
+            # error, so read to the end a chunk at a time
+            return b''.join(iter(partial(self.read, Config().download_chunk_size), b''))
+
+        with metrics.current().stage('download'):
+            data = self.__read(size)
+
+        metrics.current().count('bytes_downloaded', len(data))
+        return data
+
+    def __read(self, size):
+        attempt = 0
+        while True:
+            try:
+                data = self.res.raw.read(size)
+
+                # urllib3 doesn't enforce the content length, so a dropped
+                # connection can look like a clean end of the body. the length
+                # counts bytes on the wire, not the decoded bytes of a
+                # content-encoded body, so it's checked against the raw count.
+                if not data and size != 0 and self.length is not None and self.res.raw.tell() < self.length:
+                    raise ProtocolError(
+                        f'connection closed at byte {self.res.raw.tell()} of {self.length} (decoded byte {self.offset})')
+
+                self.offset += len(data)
+                return data
+
+            except (ProtocolError, ReadTimeoutError, requests.ConnectionError) as e:
+                if self.validator is None or attempt >= self.retries:
+                    raise
+
+                delay = self.backoff * 2 ** attempt
+                attempt += 1
+                logger.warning(f'{self.url}: {e}; resuming from byte {self.offset} in {delay:.1f}s')
+                time.sleep(delay)
+                self.__reopen()
+
+    def __reopen(self):
+        self.res.close()
+        self.res = get_session().get(self.url, stream=True, timeout=self.timeout, headers={
+            'Range': f'bytes={self.offset}-',
+            'If-Range': self.validator,
+            'Accept-Encoding': 'identity',
+        })
+
+        if self.res.status_code != 206:
+            self.res.close()
+            raise requests.HTTPError(f'{self.url}: could not resume (status {self.res.status_code})')
+
+        self.length = self.__content_length()
+
+    def __content_length(self):
+        # of the current response, not the whole body
+        length = self.res.headers.get('Content-Length')
+        return int(length) if length else None
+
+    def close(self):
+        self.res.close()
+
+
 def iter_csv(path):
     with codecs.open(path, mode='r', encoding='utf8') as fh:
         reader = csv.DictReader(fh)
@@ -39,19 +405,158 @@ def iter_csv(path):
             yield row
 
 
+def iter_csv_stream(fh):
+    """
+    Like `iter_csv`, but reads rows incrementally from an open binary file
+    object (e.g. a tarball member or a gzip stream) instead of a path.
+    """
+    reader = csv.DictReader(codecs.iterdecode(fh, 'utf8'))
+    for row in reader:
+        yield row
+
+
+def copy_rows(cursor, sql, rows, batch_size=50000):
+    """
+    Streams an iterable of row tuples into Postgres with `COPY ... FROM STDIN WITH CSV`.
+    Rows are buffered `batch_size` at a time so memory stays bounded. Returns the
+    number of rows copied.
+    """
+    count = 0
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+
+        if count % batch_size == 0:
+            __flush_copy_buffer(cursor, sql, buf)
+
+    __flush_copy_buffer(cursor, sql, buf)
+    return count
+
+
+def __flush_copy_buffer(cursor, sql, buf):
+    if buf.tell() == 0:
+        return
+
+    buf.seek(0)
+    with metrics.current().stage('db'):
+        cursor.copy_expert(sql, buf)
+    buf.seek(0)
+    buf.truncate()
+
+
 def __download_to_mem(url):
-    res = requests.get(url)
-    res.raise_for_status()
+    with metrics.current().stage('download'):
+        res = get_session().get(url, timeout=__timeout())
+        res.raise_for_status()
+
+    metrics.current().count('bytes_downloaded', len(res.content))
     return res.content.decode('utf8')
 
 
+def __read_meta(path, url):
+    try:
+        with open(path) as fh:
+            meta = json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+    return meta if meta.get('url') == url else {}
+
+
+def __write_meta(path, meta):
+    with open(path, mode='w') as fh:
+        json.dump(meta, fh)
+
+
 def __download_to_file(url, save_path):
-    res = requests.get(url, stream=True)
-    res.raise_for_status()
+    meta_path = f'{save_path}.meta'
+    part_path = f'{save_path}.part'
+    part_meta_path = f'{part_path}.meta'
+    retries = Config().download_retries
+    backoff = Config().download_backoff
+
+    attempt = 0
+    while True:
+        try:
+            with metrics.current().stage('download'):
+                return __fetch_to_file(url, save_path, meta_path, part_path, part_meta_path)
+
+        # iter_content raises ChunkedEncodingError when a chunked body is cut off
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                ProtocolError, ReadTimeoutError) as e:
+            if attempt >= retries:
+                raise
+
+            delay = backoff * 2 ** attempt
+            attempt += 1
+            logger.warning(f'{url}: {e}; retrying in {delay:.1f}s')
+            time.sleep(delay)
+
+
+def __fetch_to_file(url, save_path, meta_path, part_path, part_meta_path):
+    headers = {'Accept-Encoding': 'identity'}
+    offset = 0
+
+    part_meta = __read_meta(part_meta_path, url)
+    meta = __read_meta(meta_path, url)
+
+    if os.path.exists(part_path) and part_meta.get('validator'):
+        # pick up an interrupted transfer, unless the file changed upstream
+        offset = os.path.getsize(part_path)
+        headers['Range'] = f'bytes={offset}-'
+        headers['If-Range'] = part_meta['validator']
+
+    elif os.path.exists(save_path):
+        # revalidate the cached copy
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    with get_session().get(url, stream=True, headers=headers, timeout=__timeout()) as res:
+        if res.status_code == 304:
+            logger.debug(f'{url}: cached copy is current')
+            return save_path
+
+        if res.status_code == 416:
+            # the partial file is no prefix of what's there now; start over
+            os.remove(part_path)
+            os.remove(part_meta_path)
+            return __fetch_to_file(url, save_path, meta_path, part_path, part_meta_path)
+
+        res.raise_for_status()
+        if res.status_code != 206:
+            offset = 0
+
+        etag = res.headers.get('ETag')
+        last_modified = res.headers.get('Last-Modified')
+        resumable = res.headers.get('Content-Encoding', 'identity') == 'identity'
+        __write_meta(part_meta_path, {
+            'url': url,
+            'validator': (etag or last_modified) if resumable else None,
+        })
+
+        logger.debug(f'{url}: downloading from byte {offset}')
+        received = 0
+        with open(part_path, mode='ab' if offset else 'wb') as fh:
+            for chunk in res.iter_content(chunk_size=Config().download_chunk_size):
+                if chunk:
+                    fh.write(chunk)
+                    received += len(chunk)
+
+        metrics.current().count('bytes_downloaded', received)
+
+        # urllib3 doesn't enforce the content length, so a dropped connection
+        # can look like a clean end of the body
+        length = res.headers.get('Content-Length')
+        if resumable and length and received < int(length):
+            raise ProtocolError(f'connection closed at byte {offset + received} of {offset + int(length)}')
 
-    with open(save_path, mode='wb') as fh:
-        for chunk in res.iter_content(chunk_size=1024):
-            if chunk:
-                fh.write(chunk)
+    os.replace(part_path, save_path)
+    os.remove(part_meta_path)
+    __write_meta(meta_path, {'url': url, 'etag': etag, 'last_modified': last_modified})
 
     return save_path
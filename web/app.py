@@ -1,119 +1,387 @@
 #!/usr/bin/env python3
 
 import csv
-from datetime import datetime, timedelta
+from datetime import datetime
 from io import StringIO
 
-import arrow
-import psycopg2
-from flask import Flask, jsonify, make_response, render_template
+from flask import Flask, Response, abort, make_response, render_template, request, stream_with_context
 from flask_cors import CORS
 
+import columnar
+import mvt
 import queries
+import request_args
+import serializers
+from cache import ResponseCache
 from config import Config
+from db import Database
+from events import StatusEvents, TooManyClients
+from listener import IngestListener
+from request_args import ALL_PROJECTS
 
 
 _cfg = Config()
 
-conn = psycopg2.connect(_cfg.get_pg_dsn())
-cursor = conn.cursor()
+db = Database(
+    _cfg.get_pg_dsn(),
+    minconn=_cfg.pg_pool_min,
+    maxconn=_cfg.pg_pool_max,
+    check_interval=_cfg.pg_pool_check_interval)
 
 app = Flask(__name__)
 app.config.from_object(_cfg)
 CORS(app)
 
+# status responses only change when the tasks load new data, so they're cached
+# until the next ingest notification (or the ttl, should one be missed)
+cache = ResponseCache(_cfg.status_cache_ttl, max_entries=_cfg.status_cache_max_entries)
+listener = IngestListener(_cfg.get_pg_dsn(), _cfg.ingest_channel)
+listener.subscribe(cache.invalidate)
 
-ALL_PROJECTS = 'all'
+# tiles get their own cache so panning around the map can't evict the status responses
+tile_cache = ResponseCache(_cfg.status_cache_ttl, max_entries=_cfg.tile_cache_max_entries)
+listener.subscribe(tile_cache.invalidate)
 
+# and so do node details, which map popups fetch one node at a time
+node_cache = ResponseCache(_cfg.status_cache_ttl, max_entries=_cfg.node_cache_max_entries)
+listener.subscribe(node_cache.invalidate)
 
-def _get_status(project_id):
-    headers = "node_id vsn project_id lon lat address description start_timestamp " \
-        "end_timestamp latest_boot_timestamp boot_id boot_media latest_rssh_timestamp " \
-        "port latest_observation_timestamp status".split(" ")
 
-    if project_id == ALL_PROJECTS:
-        cursor.execute(queries.STATUSES_FOR_ALL)
-    else:
-        cursor.execute(queries.STATUSES_FOR_PROJECT, {'project_id': project_id})
+def _bad_request(parse, *args, **kwargs):
+    try:
+        return parse(*args, **kwargs)
+    except ValueError as e:
+        abort(400, f'{e}')
+
+
+def _status_params(project_id):
+    return _bad_request(request_args.status_params, project_id, request.args)
+
+
+def _iter_status(params):
+    # a server-side cursor keeps memory flat no matter how big the fleet gets.
+    # pages fetch one extra row to tell whether there's another page.
+    if params['limit'] is not None:
+        params = dict(params, limit=params['limit'] + 1)
+
+    with db.cursor(name='status_cursor') as cursor:
+        cursor.itersize = _cfg.export_chunk_size
+        if params['project_id'] == ALL_PROJECTS:
+            cursor.execute(queries.STATUSES_FOR_ALL, params)
+        else:
+            cursor.execute(queries.STATUSES_FOR_PROJECT, params)
+
+        for row in cursor:
+            yield row
+
+
+def _load_statuses(project_id):
+    return list(_iter_status(request_args.default_status_params(project_id)))
+
+
+# live updates for the /events/status streams, recomputed after every ingest
+events = StatusEvents(
+    _load_statuses,
+    refresh_interval=_cfg.events_refresh_interval,
+    heartbeat_interval=_cfg.events_heartbeat_interval,
+    max_clients=_cfg.events_max_clients)
+listener.subscribe(events.notify)
+
+
+def _get_status_page(params):
+    """
+    Returns the status rows and the headers (the `X-Next-Cursor` for the next
+    page, if there is one) to send with them.
+    """
+    rows = list(_iter_status(params))
+
+    headers = {}
+    if params['limit'] is not None and len(rows) > params['limit']:
+        rows = rows[:params['limit']]
+        headers['X-Next-Cursor'] = request_args.encode_cursor(rows[-1])
+
+    return rows, headers
+
+
+def _iter_csv(headers, rows):
+    """
+    Writes rows out as csv, yielding the encoded text a chunk at a time.
+    """
+    si = StringIO()
+    writer = csv.writer(si)
+    writer.writerow(headers)
+
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % _cfg.export_chunk_size == 0:
+            yield si.getvalue().encode('utf8')
+            si.seek(0)
+            si.truncate()
+
+    if si.tell():
+        yield si.getvalue().encode('utf8')
+
 
-    rows = cursor.fetchall()
-    conn.commit()
+def _cached_response(key, build, mimetype, cache=cache):
+    listener.start_once()
+    entry = cache.get_or_set(key, build)
 
-    rows = [dict(zip(headers, row)) for row in rows]
-    for row in rows:
-        for key, value in row.items():
-            if isinstance(value, datetime):
-                row[key] = arrow.get(value).to('America/Chicago').format('YYYY-MM-DD HH:mm:ss Z')
+    resp = make_response(entry.body)
+    resp.mimetype = mimetype
+    resp.headers.extend(entry.headers)
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.set_etag(entry.etag)
+    return resp.make_conditional(request)
 
-    return rows
+
+def _cached_stream(key, generate, mimetype):
+    """
+    Like `_cached_response`, but on a cache miss the body is streamed to the
+    client as it's generated and only cached once it's complete.
+    """
+    listener.start_once()
+    entry = cache.get(key)
+    if entry is not None:
+        return _cached_response(key, lambda: (entry.body, entry.headers), mimetype)
+
+    generation = cache.generation
+
+    def tee():
+        chunks = []
+        for chunk in generate():
+            chunks.append(chunk)
+            yield chunk
+
+        cache.set(key, b''.join(chunks), generation=generation)
+
+    resp = Response(stream_with_context(tee()), mimetype=mimetype)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
+def _generate_status_csv(params):
+    return _iter_csv(serializers.STATUS_HEADERS, serializers.status_values(_iter_status(params)))
+
+
+def _build_status_csv(params):
+    rows, headers = _get_status_page(params)
+    return b''.join(_iter_csv(serializers.STATUS_HEADERS, serializers.status_values(rows))), headers
+
+
+def _build_status_json(params):
+    rows, headers = _get_status_page(params)
+    return serializers.dumps(serializers.status_records(rows)), headers
+
+
+def _build_status_geojson(params, zoom):
+    rows, headers = _get_status_page(params)
+    if zoom is not None and zoom < _cfg.cluster_max_zoom:
+        collection = serializers.status_cluster_collection(rows, zoom, _cfg.cluster_cell_pixels)
+    else:
+        collection = serializers.status_feature_collection(rows)
+
+    return serializers.dumps(collection), headers
 
 
 @app.route('/status.csv')
 @app.route('/status/<project_id>.csv')
 def status_csv(project_id=ALL_PROJECTS):
-    rows = _get_status(project_id)
-    si = StringIO()
-    writer = csv.DictWriter(si, rows[0].keys())
-    writer.writeheader()
-    writer.writerows(rows)
-    resp = make_response(si.getvalue())
+    params = _status_params(project_id)
+    key = request_args.status_cache_key(params, 'csv')
+
+    # pages are small and need their next cursor up front; everything else streams
+    if params['limit'] is not None:
+        resp = _cached_response(key, lambda: _build_status_csv(params), 'text/csv')
+    else:
+        resp = _cached_stream(key, lambda: _generate_status_csv(params), 'text/csv')
+
     now = datetime.now().strftime("%Y-%m-%d.%H-%M-%S")
     resp.headers["Content-Disposition"] = f"attachment; filename=node-status-{now}.csv"
-    resp.headers["Content-type"] = "text/csv"
     return resp
 
 
 @app.route('/status.json')
 @app.route('/status/<project_id>.json')
 def status_json(project_id=ALL_PROJECTS):
-    return jsonify(_get_status(project_id))
+    params = _status_params(project_id)
+    return _cached_response(
+        request_args.status_cache_key(params, 'json'), lambda: _build_status_json(params), 'application/json')
 
 
 @app.route('/status.geojson')
 @app.route('/status/<project_id>.geojson')
 def status_geojson(project_id=ALL_PROJECTS):
-    data = []
-    for obj in _get_status(project_id):
-        lon = obj.pop('lon')
-        lat = obj.pop('lat')
-        data.append({
-            'type': 'Feature',
-            'geometry': {
-                'type': 'Point',
-                'coordinates': [lon, lat]
-            },
-            'properties': obj
-        })
-
-    return jsonify(data)
+    params = _status_params(project_id)
+    zoom = request.args.get('zoom', type=int)
+    return _cached_response(
+        request_args.status_cache_key(params, 'geojson', zoom),
+        lambda: _build_status_geojson(params, zoom), 'application/json')
+
+
+@app.route('/tiles/<project_id>/<int:z>/<int:x>/<int:y>.mvt')
+def status_tile(project_id, z, x, y):
+    if not mvt.is_valid_tile(z, x, y):
+        abort(404)
+
+    params = _bad_request(request_args.tile_params, project_id, z, x, y, request.args)
+    return _cached_response(
+        request_args.status_cache_key(params, 'mvt', z, x, y),
+        lambda: serializers.status_tile(_iter_status(params), z, x, y),
+        'application/vnd.mapbox-vector-tile',
+        cache=tile_cache)
+
+
+@app.route('/events/status')
+@app.route('/events/status/<project_id>')
+def status_events(project_id=ALL_PROJECTS):
+    if not _cfg.wsgi_events:
+        abort(404)
+
+    listener.start_once()
+    try:
+        client = events.subscribe(project_id)
+    except TooManyClients as e:
+        resp = make_response(f'{e}', 503)
+        resp.headers['Retry-After'] = str(_cfg.events_refresh_interval)
+        return resp
+
+    resp = Response(events.stream(client, request.headers.get('Last-Event-ID')), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+
+def _rollup_params(project_id, default_resolution):
+    return _bad_request(
+        request_args.rollup_params, project_id, request.args, default_resolution, _cfg.history_default_days)
+
+
+def _build_rollup_json(query, params, records):
+    with db.cursor() as cursor:
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+
+    return serializers.dumps(records(rows)), {}
+
+
+@app.route('/status/history')
+@app.route('/status/<project_id>/history')
+def status_history(project_id=ALL_PROJECTS):
+    params, resolution = _rollup_params(project_id, 'hour')
+    return _cached_response(
+        request_args.status_cache_key(params, 'history', resolution),
+        lambda: _build_rollup_json(queries.STATUS_HISTORY[resolution], params, serializers.history_records),
+        'application/json')
+
+
+@app.route('/uptime')
+@app.route('/uptime/<project_id>')
+def uptime(project_id=ALL_PROJECTS):
+    params, resolution = _rollup_params(project_id, 'day')
+    return _cached_response(
+        request_args.status_cache_key(params, 'uptime', resolution),
+        lambda: _build_rollup_json(queries.UPTIME[resolution], params, serializers.uptime_records),
+        'application/json')
 
 
 @app.route('/')
 @app.route('/<project_id>')
 def index(project_id=ALL_PROJECTS):
-    cursor.execute(queries.PROJECT_IDS)
-    projects = [proj for (proj,) in cursor.fetchall()]
-    conn.commit()
-    return render_template('index.html', project_id=project_id, hostname=_cfg.HOSTNAME, projects=projects)
+    with db.cursor() as cursor:
+        cursor.execute(queries.PROJECT_IDS)
+        projects = [proj for (proj,) in cursor.fetchall()]
+
+    return render_template(
+        'index.html', project_id=project_id, hostname=_cfg.HOSTNAME, projects=projects,
+        live_events=_cfg.wsgi_events, poll_interval=_cfg.events_refresh_interval)
+
+
+def _build_node_detail(node_id):
+    with db.cursor() as cursor:
+        cursor.execute(queries.NODE_DETAIL, {'node_id': node_id})
+        node = cursor.fetchone()
+        if node is None:
+            abort(404)
+
+        cursor.execute(queries.LATEST_VALUES_FOR_NODE, {'node_id': node_id})
+        readings = cursor.fetchall()
+
+    return serializers.dumps(serializers.node_detail(node, readings)), {}
+
+
+@app.route('/node/<node_id>.json')
+def node_detail(node_id):
+    return _cached_response(('node', node_id), lambda: _build_node_detail(node_id), 'application/json',
+                            cache=node_cache)
 
 
 @app.route('/export/<node_id>.csv')
 def export(node_id):
-    cursor.execute(queries.EXPORT_FOR_NODE, {'node_id': node_id})
-    headers = ['node_id', 'timestamp', 'subsystem', 'sensor', 'parameter', "value_raw", "value_hrf"]
-    rows = [dict(zip(headers, row)) for row in cursor.fetchall()]
-    conn.commit()
+    with db.cursor() as cursor:
+        cursor.execute(queries.VSN_FOR_NODE, {'node_id': node_id})
+        row = cursor.fetchone()
 
-    si = StringIO()
-    writer = csv.DictWriter(si, rows[0].keys())
-    writer.writeheader()
-    writer.writerows(rows)
-    resp = make_response(si.getvalue())
+    if row is None:
+        abort(404)
+
+    (vsn,) = row
+
+    def generate():
+        with db.cursor(name='export_cursor') as cursor:
+            cursor.itersize = _cfg.export_chunk_size
+            cursor.execute(queries.EXPORT_FOR_NODE, {'node_id': node_id})
+            for chunk in _iter_csv(serializers.EXPORT_HEADERS, serializers.export_values(cursor)):
+                yield chunk
+
+    resp = Response(stream_with_context(generate()), mimetype='text/csv')
     now = datetime.now().strftime("%Y-%m-%d.%H-%M-%S")
     resp.headers["Content-Disposition"] = f"attachment; filename={vsn}-last-hour-{now}.csv"
-    resp.headers["Content-type"] = "text/csv"
     return resp
 
 
+def _columnar_response(params, writer_class, mimetype, filename):
+    def generate():
+        with db.cursor(name='columnar_export_cursor') as cursor:
+            cursor.itersize = _cfg.columnar_batch_size
+            cursor.execute(queries.EXPORT_OBSERVATIONS, params)
+            for chunk in columnar.iter_batches(writer_class(), cursor, _cfg.columnar_batch_size):
+                yield chunk
+
+    resp = Response(stream_with_context(generate()), mimetype=mimetype)
+    resp.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return resp
+
+
+@app.route('/export/<node_id>.parquet')
+def export_parquet(node_id):
+    with db.cursor() as cursor:
+        cursor.execute(queries.VSN_FOR_NODE, {'node_id': node_id})
+        row = cursor.fetchone()
+
+    if row is None:
+        abort(404)
+
+    (vsn,) = row
+    now = datetime.now().strftime("%Y-%m-%d.%H-%M-%S")
+    return _columnar_response(
+        _bad_request(request_args.export_params, request.args, node_id=node_id),
+        columnar.ParquetWriter, 'application/vnd.apache.parquet', f'{vsn}-{now}.parquet')
+
+
+@app.route('/export/<project_id>/observations.arrow')
+def export_arrow(project_id):
+    with db.cursor() as cursor:
+        cursor.execute(queries.PROJECT_EXISTS, {'project_id': project_id})
+        row = cursor.fetchone()
+
+    if row is None:
+        abort(404)
+
+    now = datetime.now().strftime("%Y-%m-%d.%H-%M-%S")
+    return _columnar_response(
+        _bad_request(request_args.export_params, request.args, project_id=project_id),
+        columnar.ArrowWriter, 'application/vnd.apache.arrow.stream', f'{project_id}-observations-{now}.arrow')
+
+
 if __name__ == "__main__":
     app.run(debug=_cfg.DEBUG, host="0.0.0.0")
@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+
+"""
+The same routes and output formats as `app.py`, served on asyncio by Quart
+with an asyncpg connection pool. Requests waiting on the database don't tie
+up a thread each, so a long export streaming out of a server-side cursor
+doesn't hold up the quick status requests behind it. The columnar exports
+are CPU heavy end to end -- decoding the rows as much as building the arrow
+batches -- so each runs in a niced `export_worker.py` process and the app
+only relays the bytes it writes.
+
+    $ hypercorn --bind 0.0.0.0:5001 --workers 4 async_app:app
+
+The queries, serializers, caches and query string parsing are shared with
+the wsgi app; only the request handling and database access differ.
+"""
+
+import asyncio
+import csv
+import json
+import logging
+import os
+import pickle
+import queue
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from io import StringIO
+
+import asyncpg
+from quart import Quart, Response, abort, render_template, request
+from quart_cors import cors
+from werkzeug.http import parse_etags
+
+import columnar
+import mvt
+import queries
+import request_args
+import serializers
+from cache import ResponseCache
+from config import Config
+from events import KEEPALIVE, StatusEvents, TooManyClients
+from listener import IngestListener
+from request_args import ALL_PROJECTS
+
+
+_cfg = Config()
+logger = logging.getLogger('async_app')
+
+app = Quart(__name__)
+app.config.from_object(_cfg)
+app = cors(app)
+
+cache = ResponseCache(_cfg.status_cache_ttl, max_entries=_cfg.status_cache_max_entries)
+tile_cache = ResponseCache(_cfg.status_cache_ttl, max_entries=_cfg.tile_cache_max_entries)
+node_cache = ResponseCache(_cfg.status_cache_ttl, max_entries=_cfg.node_cache_max_entries)
+
+listener = IngestListener(_cfg.get_pg_dsn(), _cfg.ingest_channel)
+listener.subscribe(cache.invalidate)
+listener.subscribe(tile_cache.invalidate)
+listener.subscribe(node_cache.invalidate)
+
+# event streams wait on the loop rather than in a thread each; threads are
+# only needed to subscribe, since the first subscriber to a project blocks
+# while its rows load
+_events_executor = ThreadPoolExecutor(4, thread_name_prefix='status-events')
+
+# columnar exports run in export_worker processes, at most `export_processes`
+# at a time per web worker, niced so the quick requests get the cpu first
+_EXPORT_WORKER = [
+    'nice', '-n', str(_cfg.export_niceness),
+    sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'export_worker.py')]
+_EXPORT_READ_SIZE = 256 * 1024
+
+_pool = None
+_loop = None
+_export_slots = None
+
+
+_PARAM_RE = re.compile(r'%\((\w+)\)s')
+
+_compiled = {}
+
+
+def _compile(query):
+    """
+    Rewrites a psycopg2 style query (`%(name)s` placeholders) into asyncpg's
+    numbered ones, returning it along with the parameter names in order.
+    """
+    names = []
+
+    def placeholder(m):
+        if m.group(1) not in names:
+            names.append(m.group(1))
+        return f'${names.index(m.group(1)) + 1}'
+
+    return _PARAM_RE.sub(placeholder, query).replace('%%', '%'), names
+
+
+def _bind(query, params):
+    compiled = _compiled.get(query)
+    if compiled is None:
+        compiled = _compiled[query] = _compile(query)
+
+    (sql, names) = compiled
+    return (sql,) + tuple(params[name] for name in names)
+
+
+async def _init_connection(conn):
+    await conn.set_type_codec('jsonb', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+
+@app.before_serving
+async def _start():
+    global _pool, _loop, _export_slots
+    _loop = asyncio.get_event_loop()
+    _export_slots = asyncio.Semaphore(_cfg.export_processes)
+    _pool = await asyncpg.create_pool(
+        host=_cfg.pg_host, port=int(_cfg.pg_port), user=_cfg.pg_user, password=_cfg.pg_pass,
+        database=_cfg.pg_dbname, min_size=_cfg.pg_pool_min, max_size=_cfg.pg_pool_max,
+        init=_init_connection)
+
+
+@app.after_serving
+async def _stop():
+    await _pool.close()
+
+
+async def _fetch(query, params):
+    async with _pool.acquire() as conn:
+        return await conn.fetch(*_bind(query, params))
+
+
+async def _fetchrow(query, params):
+    async with _pool.acquire() as conn:
+        return await conn.fetchrow(*_bind(query, params))
+
+
+async def _iter_cursor(query, params, batch_size):
+    """
+    Yields lists of up to `batch_size` rows from a server-side cursor.
+    """
+    async with _pool.acquire() as conn:
+        async with conn.transaction():
+            cursor = await conn.cursor(*_bind(query, params))
+            while True:
+                rows = await cursor.fetch(batch_size)
+                if not rows:
+                    break
+
+                yield rows
+
+
+def _bad_request(parse, *args, **kwargs):
+    try:
+        return parse(*args, **kwargs)
+    except ValueError as e:
+        abort(400, f'{e}')
+
+
+def _status_query(params):
+    if params['project_id'] == ALL_PROJECTS:
+        return queries.STATUSES_FOR_ALL
+    return queries.STATUSES_FOR_PROJECT
+
+
+async def _get_status_page(params):
+    # pages fetch one extra row to tell whether there's another page
+    query_params = params
+    if params['limit'] is not None:
+        query_params = dict(params, limit=params['limit'] + 1)
+
+    rows = await _fetch(_status_query(params), query_params)
+
+    headers = {}
+    if params['limit'] is not None and len(rows) > params['limit']:
+        rows = rows[:params['limit']]
+        headers['X-Next-Cursor'] = request_args.encode_cursor(rows[-1])
+
+    return rows, headers
+
+
+def _load_statuses(project_id):
+    # called from the status events thread, so the query runs on the app's loop
+    future = asyncio.run_coroutine_threadsafe(
+        _fetch(_status_query({'project_id': project_id}), request_args.default_status_params(project_id)), _loop)
+    return future.result()
+
+
+events = StatusEvents(
+    _load_statuses,
+    refresh_interval=_cfg.events_refresh_interval,
+    heartbeat_interval=_cfg.events_heartbeat_interval,
+    max_clients=_cfg.events_max_clients)
+listener.subscribe(events.notify)
+
+
+def _csv_chunk(headers, rows):
+    si = StringIO()
+    writer = csv.writer(si)
+    if headers:
+        writer.writerow(headers)
+    writer.writerows(rows)
+    return si.getvalue().encode('utf8')
+
+
+def _response(body, mimetype, headers=None, status=200):
+    resp = Response(body, status=status, mimetype=mimetype)
+    resp.headers.update(headers or {})
+    return resp
+
+
+async def _cached_response(key, build, mimetype, cache=cache):
+    """
+    `build` is a coroutine function returning the body and its headers.
+    """
+    listener.start_once()
+    entry = cache.get(key)
+    if entry is None:
+        generation = cache.generation
+        entry = cache.set(key, *(await build()), generation=generation)
+
+    headers = dict(entry.headers, **{'Cache-Control': 'no-cache', 'ETag': f'"{entry.etag}"'})
+    if parse_etags(request.headers.get('If-None-Match')).contains(entry.etag):
+        return _response(b'', mimetype, headers, status=304)
+
+    return _response(entry.body, mimetype, headers)
+
+
+async def _build_status_csv(params):
+    rows, headers = await _get_status_page(params)
+    return _csv_chunk(serializers.STATUS_HEADERS, serializers.status_values(rows)), headers
+
+
+async def _build_status_json(params):
+    rows, headers = await _get_status_page(params)
+    return serializers.dumps(serializers.status_records(rows)), headers
+
+
+async def _build_status_geojson(params, zoom):
+    rows, headers = await _get_status_page(params)
+    if zoom is not None and zoom < _cfg.cluster_max_zoom:
+        collection = serializers.status_cluster_collection(rows, zoom, _cfg.cluster_cell_pixels)
+    else:
+        collection = serializers.status_feature_collection(rows)
+
+    return serializers.dumps(collection), headers
+
+
+@app.route('/status.csv')
+@app.route('/status/<project_id>.csv')
+async def status_csv(project_id=ALL_PROJECTS):
+    params = _bad_request(request_args.status_params, project_id, request.args)
+    resp = await _cached_response(
+        request_args.status_cache_key(params, 'csv'), lambda: _build_status_csv(params), 'text/csv')
+
+    now = datetime.now().strftime("%Y-%m-%d.%H-%M-%S")
+    resp.headers["Content-Disposition"] = f"attachment; filename=node-status-{now}.csv"
+    return resp
+
+
+@app.route('/status.json')
+@app.route('/status/<project_id>.json')
+async def status_json(project_id=ALL_PROJECTS):
+    params = _bad_request(request_args.status_params, project_id, request.args)
+    return await _cached_response(
+        request_args.status_cache_key(params, 'json'), lambda: _build_status_json(params), 'application/json')
+
+
+@app.route('/status.geojson')
+@app.route('/status/<project_id>.geojson')
+async def status_geojson(project_id=ALL_PROJECTS):
+    params = _bad_request(request_args.status_params, project_id, request.args)
+    zoom = request.args.get('zoom', type=int)
+    return await _cached_response(
+        request_args.status_cache_key(params, 'geojson', zoom),
+        lambda: _build_status_geojson(params, zoom), 'application/json')
+
+
+async def _build_status_tile(params, z, x, y):
+    rows = await _fetch(_status_query(params), params)
+    return serializers.status_tile(rows, z, x, y), {}
+
+
+@app.route('/tiles/<project_id>/<int:z>/<int:x>/<int:y>.mvt')
+async def status_tile(project_id, z, x, y):
+    if not mvt.is_valid_tile(z, x, y):
+        abort(404)
+
+    params = _bad_request(request_args.tile_params, project_id, z, x, y, request.args)
+    return await _cached_response(
+        request_args.status_cache_key(params, 'mvt', z, x, y),
+        lambda: _build_status_tile(params, z, x, y),
+        'application/vnd.mapbox-vector-tile',
+        cache=tile_cache)
+
+
+async def _next_event(client, ready):
+    """
+    The async counterpart of `StatusEvents.next_event`: waits on `ready`,
+    which the refresh thread sets whenever it queues a message for the client.
+    """
+    while True:
+        try:
+            return client.queue.get_nowait()
+        except queue.Empty:
+            pass
+
+        # a message queued between the get and the clear is picked up by the
+        # next get, so clearing here can't lose a wakeup
+        if ready.is_set():
+            ready.clear()
+            continue
+
+        try:
+            await asyncio.wait_for(ready.wait(), events.heartbeat_interval)
+        except asyncio.TimeoutError:
+            return KEEPALIVE
+
+
+async def _stream_events(client, ready, last_event_id):
+    try:
+        snapshot = events.snapshot_event(client, last_event_id)
+        if snapshot is not None:
+            yield snapshot
+
+        while True:
+            message = await _next_event(client, ready)
+            if message is None:
+                break
+
+            yield message
+    finally:
+        events.unsubscribe(client)
+
+
+@app.route('/events/status')
+@app.route('/events/status/<project_id>')
+async def status_events(project_id=ALL_PROJECTS):
+    listener.start_once()
+    ready = asyncio.Event()
+    try:
+        # the first subscriber to a project loads its rows through the events thread
+        client = await _loop.run_in_executor(
+            _events_executor, events.subscribe, project_id, lambda: _loop.call_soon_threadsafe(ready.set))
+    except TooManyClients as e:
+        return _response(f'{e}', 'text/plain', {'Retry-After': str(_cfg.events_refresh_interval)}, status=503)
+
+    resp = _response(
+        _stream_events(client, ready, request.headers.get('Last-Event-ID')), 'text/event-stream',
+        {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    resp.timeout = None
+    return resp
+
+
+async def _build_rollup_json(query, params, records):
+    rows = await _fetch(query, params)
+    return serializers.dumps(records(rows)), {}
+
+
+@app.route('/status/history')
+@app.route('/status/<project_id>/history')
+async def status_history(project_id=ALL_PROJECTS):
+    params, resolution = _bad_request(
+        request_args.rollup_params, project_id, request.args, 'hour', _cfg.history_default_days)
+    return await _cached_response(
+        request_args.status_cache_key(params, 'history', resolution),
+        lambda: _build_rollup_json(queries.STATUS_HISTORY[resolution], params, serializers.history_records),
+        'application/json')
+
+
+@app.route('/uptime')
+@app.route('/uptime/<project_id>')
+async def uptime(project_id=ALL_PROJECTS):
+    params, resolution = _bad_request(
+        request_args.rollup_params, project_id, request.args, 'day', _cfg.history_default_days)
+    return await _cached_response(
+        request_args.status_cache_key(params, 'uptime', resolution),
+        lambda: _build_rollup_json(queries.UPTIME[resolution], params, serializers.uptime_records),
+        'application/json')
+
+
+@app.route('/')
+@app.route('/<project_id>')
+async def index(project_id=ALL_PROJECTS):
+    rows = await _fetch(queries.PROJECT_IDS, {})
+    projects = [proj for (proj,) in rows]
+
+    return await render_template(
+        'index.html', project_id=project_id, hostname=_cfg.HOSTNAME, projects=projects,
+        live_events=True, poll_interval=_cfg.events_refresh_interval)
+
+
+async def _build_node_detail(node_id):
+    node = await _fetchrow(queries.NODE_DETAIL, {'node_id': node_id})
+    if node is None:
+        abort(404)
+
+    readings = await _fetch(queries.LATEST_VALUES_FOR_NODE, {'node_id': node_id})
+    return serializers.dumps(serializers.node_detail(node, readings)), {}
+
+
+@app.route('/node/<node_id>.json')
+async def node_detail(node_id):
+    return await _cached_response(
+        ('node', node_id), lambda: _build_node_detail(node_id), 'application/json', cache=node_cache)
+
+
+@app.route('/export/<node_id>.csv')
+async def export(node_id):
+    row = await _fetchrow(queries.VSN_FOR_NODE, {'node_id': node_id})
+    if row is None:
+        abort(404)
+
+    (vsn,) = row
+
+    async def generate():
+        headers = serializers.EXPORT_HEADERS
+        async for rows in _iter_cursor(queries.EXPORT_FOR_NODE, {'node_id': node_id}, _cfg.export_chunk_size):
+            yield _csv_chunk(headers, serializers.export_values(rows))
+            headers = None
+
+        if headers:
+            yield _csv_chunk(headers, [])
+
+    now = datetime.now().strftime("%Y-%m-%d.%H-%M-%S")
+    resp = _response(generate(), 'text/csv', {
+        "Content-Disposition": f"attachment; filename={vsn}-last-hour-{now}.csv"})
+    resp.timeout = None
+    return resp
+
+
+async def _run_export(params, writer_class):
+    """
+    Yields the encoded export as the worker process writes it out. The worker
+    is killed if the client goes away first, and a worker that fails raises
+    rather than letting the export end as though it were complete.
+    """
+    job = pickle.dumps({
+        'query': queries.EXPORT_OBSERVATIONS,
+        'params': params,
+        'writer_class': writer_class,
+        'batch_size': _cfg.columnar_batch_size,
+    })
+
+    async with _export_slots:
+        process = await asyncio.create_subprocess_exec(
+            *_EXPORT_WORKER, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+        try:
+            process.stdin.write(job)
+            await process.stdin.drain()
+            process.stdin.close()
+
+            while True:
+                chunk = await process.stdout.read(_EXPORT_READ_SIZE)
+                if not chunk:
+                    break
+
+                yield chunk
+
+            if await process.wait() != 0:
+                logger.error(f'export worker exited with status {process.returncode}')
+                raise RuntimeError(f'export worker exited with status {process.returncode}')
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+
+
+async def _columnar_response(params, writer_class, mimetype, filename):
+    # the first chunk is waited for before the response starts, so a worker
+    # that fails before writing anything is a 500 rather than an empty 200. a
+    # failure after that breaks off the stream, short of the end of the file.
+    export = _run_export(params, writer_class)
+    try:
+        first = await export.__anext__()
+    except StopAsyncIteration:
+        first = b''
+
+    async def generate():
+        yield first
+        async for chunk in export:
+            yield chunk
+
+    resp = _response(generate(), mimetype, {"Content-Disposition": f"attachment; filename={filename}"})
+    resp.timeout = None
+    return resp
+
+
+@app.route('/export/<node_id>.parquet')
+async def export_parquet(node_id):
+    row = await _fetchrow(queries.VSN_FOR_NODE, {'node_id': node_id})
+    if row is None:
+        abort(404)
+
+    (vsn,) = row
+    now = datetime.now().strftime("%Y-%m-%d.%H-%M-%S")
+    return await _columnar_response(
+        _bad_request(request_args.export_params, request.args, node_id=node_id),
+        columnar.ParquetWriter, 'application/vnd.apache.parquet', f'{vsn}-{now}.parquet')
+
+
+@app.route('/export/<project_id>/observations.arrow')
+async def export_arrow(project_id):
+    row = await _fetchrow(queries.PROJECT_EXISTS, {'project_id': project_id})
+    if row is None:
+        abort(404)
+
+    now = datetime.now().strftime("%Y-%m-%d.%H-%M-%S")
+    return await _columnar_response(
+        _bad_request(request_args.export_params, request.args, project_id=project_id),
+        columnar.ArrowWriter, 'application/vnd.apache.arrow.stream', f'{project_id}-observations-{now}.arrow')
+
+
+if __name__ == "__main__":
+    app.run(debug=_cfg.DEBUG, host="0.0.0.0", port=5001)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""
+Load tests running web servers -- e.g. the wsgi app under gunicorn and the
+asyncio app under hypercorn -- with the same request mix, and compares their
+throughput and latency. Each of `--concurrency` clients keeps a connection
+open and requests the `--path`s in turn for `--duration` seconds, while
+`--background-clients` clients download `--background` exports over and over
+to see whether long responses hold up the quick ones.
+
+    $ WEB_WORKERS=1 gunicorn --config gunicorn.conf.py app:app
+    $ hypercorn --bind 0.0.0.0:5001 --workers 1 async_app:app
+    $ python bench_load.py --target wsgi=http://localhost:5000 --target asyncio=http://localhost:5001 \\
+          --path /status/AoT_Chicago.json --path /node/001e0610ba46.json \\
+          --background /export/AoT_Chicago/observations.arrow --background-clients 2
+"""
+
+import argparse
+import http.client
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+class Client(threading.Thread):
+    def __init__(self, base_url, paths, deadline, headers=None):
+        super().__init__(daemon=True)
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.prefix = parts.path.rstrip('/')
+        self.paths = paths
+        self.deadline = deadline
+        self.headers = headers or {}
+        self.latencies = []
+        self.errors = 0
+        self.bytes = 0
+
+    def run(self):
+        conn = None
+        i = 0
+        while time.monotonic() < self.deadline:
+            path = self.paths[i % len(self.paths)]
+            i += 1
+
+            started = time.perf_counter()
+            try:
+                if conn is None:
+                    conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+                conn.request('GET', self.prefix + path, headers=self.headers)
+                res = conn.getresponse()
+                self.bytes += len(res.read())
+                if res.status >= 400:
+                    self.errors += 1
+                    continue
+            except (OSError, http.client.HTTPException):
+                self.errors += 1
+                conn = None
+                continue
+
+            self.latencies.append(time.perf_counter() - started)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run_target(name, base_url, args):
+    # warm the caches and connection pools first so both servers start even
+    Client(base_url, args.path, time.monotonic() + args.warmup).run()
+
+    deadline = time.monotonic() + args.duration
+    background = [Client(base_url, args.background, deadline) for _ in range(args.background_clients)
+                  if args.background]
+    clients = [Client(base_url, args.path, deadline) for _ in range(args.concurrency)]
+
+    started = time.monotonic()
+    for client in background + clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.monotonic() - started
+
+    # a background download still going at the deadline is left to finish,
+    # but doesn't count against the quick requests' throughput
+    for client in background:
+        client.join()
+
+    latencies = [latency for client in clients for latency in client.latencies]
+    return {
+        'target': name,
+        'requests': len(latencies),
+        'errors': sum(client.errors for client in clients),
+        'req_per_sec': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies, default=0.0) * 1000,
+        'background_requests': sum(len(client.latencies) for client in background),
+        'background_mb': sum(client.bytes for client in background) / 1024 / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', action='append', required=True, metavar='NAME=URL',
+                        help='a server to test, e.g. wsgi=http://localhost:5000')
+    parser.add_argument('--path', action='append', default=None,
+                        help='path the clients request in turn (default /status.json)')
+    parser.add_argument('--background', action='append', default=[],
+                        help='long running path, e.g. an export, requested by the background clients')
+    parser.add_argument('--background-clients', type=int, default=0)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--output', help='write the results to this file as json')
+    args = parser.parse_args()
+    args.path = args.path or ['/status.json']
+
+    results = []
+    for target in args.target:
+        (name, _, base_url) = target.partition('=')
+        results.append(run_target(name, base_url, args))
+
+    print(f'{"target":>12} {"requests":>9} {"errors":>7} {"req/sec":>9} {"p50 ms":>8} {"p99 ms":>8} '
+          f'{"max ms":>8} {"bg reqs":>8} {"bg MB":>8}')
+    for r in results:
+        print(f'{r["target"]:>12} {r["requests"]:>9} {r["errors"]:>7} {r["req_per_sec"]:>9.0f} '
+              f'{r["p50_ms"]:>8.1f} {r["p99_ms"]:>8.1f} {r["max_ms"]:>8.1f} '
+              f'{r["background_requests"]:>8} {r["background_mb"]:>8.1f}')
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
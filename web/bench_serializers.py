@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+"""
+Measures per-request CPU time of the status serializers against the old
+dict-and-arrow path for fleets of 1k, 10k and 100k synthetic nodes. No
+database is needed -- the rows mimic what the status queries return.
+
+    $ python bench_serializers.py --nodes 1000 10000 100000
+"""
+
+import argparse
+import json
+import random
+import time
+from datetime import datetime, timedelta
+
+import arrow
+
+import serializers
+
+
+STATUSES = ['green', 'blue', 'yellow', 'orange', 'red', 'gray', 'black']
+
+
+def make_rows(count):
+    now = datetime(2019, 6, 1, 12)
+    rows = []
+    for i in range(count):
+        latest = now - timedelta(seconds=25 * random.randint(0, 5000))
+        rows.append((
+            f'001e06{i:06x}', f'{i:03d}', 'AoT_Chicago', -87.6 + random.random(), 41.8 + random.random(),
+            f'{i} Some St Chicago IL', 'node description', datetime(2018, 1, 1), None,
+            latest, 'deadbeef', 'SD', latest, '50000', latest, random.choice(STATUSES)))
+
+    return rows
+
+
+def old_records(rows):
+    rows = [dict(zip(serializers.STATUS_HEADERS, row)) for row in rows]
+    for row in rows:
+        for key, value in row.items():
+            if isinstance(value, datetime):
+                row[key] = arrow.get(value).to('America/Chicago').format('YYYY-MM-DD HH:mm:ss Z')
+
+    return rows
+
+
+def old_json(rows):
+    return json.dumps(old_records(rows), sort_keys=True).encode('utf8')
+
+
+def old_geojson(rows):
+    data = []
+    for obj in old_records(rows):
+        lon = obj.pop('lon')
+        lat = obj.pop('lat')
+        data.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+            'properties': obj
+        })
+
+    return json.dumps(data, sort_keys=True).encode('utf8')
+
+
+def new_json(rows):
+    return serializers.dumps(serializers.status_records(rows))
+
+
+def new_geojson(rows):
+    return serializers.dumps(serializers.status_feature_collection(rows))
+
+
+def bench(func, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        # start cold so the formatter's memo doesn't carry over between runs
+        serializers.format_timestamp = serializers.TimestampFormatter('America/Chicago')
+        started = time.process_time()
+        func(rows)
+        elapsed = time.process_time() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--nodes', type=int, nargs='+', default=[1000, 10000, 100000])
+    argparser.add_argument('--repeat', type=int, default=3)
+    args = argparser.parse_args()
+
+    encoder = 'orjson' if serializers.orjson is not None else 'stdlib json'
+    print(f'encoder: {encoder}')
+    print(f'{"nodes":>8} {"format":>8} {"old ms":>10} {"new ms":>10} {"speedup":>8}')
+
+    for count in args.nodes:
+        rows = make_rows(count)
+        for label, old, new in [('json', old_json, new_json), ('geojson', old_geojson, new_geojson)]:
+            old_elapsed = bench(old, rows, args.repeat)
+            new_elapsed = bench(new, rows, args.repeat)
+            print(f'{count:>8} {label:>8} {old_elapsed * 1000:>10.1f} {new_elapsed * 1000:>10.1f} '
+                  f'{old_elapsed / new_elapsed:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+
+CacheEntry = namedtuple('CacheEntry', ['body', 'etag', 'created', 'headers'])
+
+
+class ResponseCache:
+    """
+    Holds serialized response bodies (and any extra headers that go with them)
+    keyed by e.g. (project_id, format) for up to `ttl` seconds. At most
+    `max_entries` are kept, least recently used first out. Everything is
+    dropped when `invalidate` is called, which the ingest listener does
+    whenever the tasks load new data.
+
+    Each invalidation starts a new `generation`. A body built from rows read
+    before an invalidation is passed to `set` with the generation it started
+    in, and is handed back without being cached, so it can't outlive the
+    ingest that made it stale.
+    """
+
+    def __init__(self, ttl, max_entries=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.generation = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            if time.monotonic() - entry.created > self.ttl:
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, body, headers=None, generation=None):
+        entry = CacheEntry(body, hashlib.sha1(body).hexdigest(), time.monotonic(), headers or {})
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return entry
+
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return entry
+
+    def get_or_set(self, key, build):
+        """
+        `build` returns the body, or a (body, headers) tuple.
+        """
+        entry = self.get(key)
+        if entry is None:
+            generation = self.generation
+            built = build()
+            if not isinstance(built, tuple):
+                built = (built,)
+            entry = self.set(key, *built, generation=generation)
+
+        return entry
+
+    def invalidate(self, *args):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
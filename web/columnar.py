@@ -0,0 +1,114 @@
+"""
+Columnar exports of observations. Rows come off a server-side cursor a batch
+at a time, are converted into Arrow record batches and written out either as
+an Arrow IPC stream or as a Parquet file (one row group per batch), so an
+export never holds more than one batch in memory and the client starts
+receiving data before the query has finished.
+"""
+
+import io
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+OBSERVATION_SCHEMA = pa.schema([
+    ('node_id', pa.string()),
+    ('timestamp', pa.timestamp('us', tz='UTC')),
+    ('subsystem', pa.string()),
+    ('sensor', pa.string()),
+    ('parameter', pa.string()),
+    ('value_raw', pa.string()),
+    ('value_hrf', pa.float64()),
+])
+
+
+class _ChunkSink(io.RawIOBase):
+    """
+    A write-only file that keeps what's written to it until it's drained,
+    letting the arrow writers feed a streamed response.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _record_batch(rows):
+    columns = zip(*rows)
+    arrays = [pa.array(values, type=field.type) for values, field in zip(columns, OBSERVATION_SCHEMA)]
+    return pa.RecordBatch.from_arrays(arrays, schema=OBSERVATION_SCHEMA)
+
+
+class _BatchWriter:
+    """
+    Encodes batches of observation rows, handing back the bytes that are
+    ready to send after each one.
+    """
+
+    def __init__(self):
+        self._sink = _ChunkSink()
+        self._writer = self._open(self._sink)
+
+    def write(self, rows):
+        self._write(_record_batch(rows))
+        return self._sink.drain()
+
+    def close(self):
+        self._writer.close()
+        return self._sink.drain()
+
+
+class ArrowWriter(_BatchWriter):
+    """
+    An Arrow IPC stream.
+    """
+
+    def _open(self, sink):
+        return pa.RecordBatchStreamWriter(sink, OBSERVATION_SCHEMA)
+
+    def _write(self, batch):
+        self._writer.write_batch(batch)
+
+
+class ParquetWriter(_BatchWriter):
+    """
+    A snappy compressed Parquet file. The footer comes last, once every row
+    group has been written.
+    """
+
+    def _open(self, sink):
+        return pq.ParquetWriter(sink, OBSERVATION_SCHEMA, compression='snappy')
+
+    def _write(self, batch):
+        self._writer.write_table(pa.Table.from_batches([batch]))
+
+
+def iter_batches(writer, cursor, batch_size):
+    """
+    Yields the cursor's rows encoded by `writer`, `batch_size` rows at a time.
+    """
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+
+        yield writer.write(rows)
+
+    yield writer.close()
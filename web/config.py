@@ -13,6 +13,37 @@ class __BaseConfig:
     pg_pass   = os.environ.get('POSTGRES_PASSWORD', 'postgres')
     pg_dbname = os.environ.get('POSTGRES_DB',       'node_status')
 
+    pg_pool_min            = int(os.environ.get('PG_POOL_MIN',            '1'))
+    pg_pool_max            = int(os.environ.get('PG_POOL_MAX',            '10'))
+    pg_pool_check_interval = int(os.environ.get('PG_POOL_CHECK_INTERVAL', '30'))
+
+    status_cache_ttl         = int(os.environ.get('STATUS_CACHE_TTL',         '300'))
+    status_cache_max_entries = int(os.environ.get('STATUS_CACHE_MAX_ENTRIES', '256'))
+    export_chunk_size        = int(os.environ.get('EXPORT_CHUNK_SIZE',        '5000'))
+    columnar_batch_size      = int(os.environ.get('COLUMNAR_BATCH_SIZE',      '65536'))
+
+    # asyncio app only: columnar exports run in separate, lower priority processes
+    export_processes = int(os.environ.get('EXPORT_PROCESSES', '2'))
+    export_niceness  = int(os.environ.get('EXPORT_NICENESS',  '19'))
+
+    cluster_max_zoom    = int(os.environ.get('CLUSTER_MAX_ZOOM',    '12'))
+    cluster_cell_pixels = int(os.environ.get('CLUSTER_CELL_PIXELS', '60'))
+
+    tile_cache_max_entries = int(os.environ.get('TILE_CACHE_MAX_ENTRIES', '4096'))
+    node_cache_max_entries = int(os.environ.get('NODE_CACHE_MAX_ENTRIES', '1024'))
+
+    events_max_clients        = int(os.environ.get('EVENTS_MAX_CLIENTS',        '16'))
+    events_refresh_interval   = int(os.environ.get('EVENTS_REFRESH_INTERVAL',   '60'))
+    events_heartbeat_interval = int(os.environ.get('EVENTS_HEARTBEAT_INTERVAL', '15'))
+
+    # wsgi app only: every open event stream holds a gunicorn thread, so the
+    # map page polls the wsgi app instead unless its streams are turned on
+    wsgi_events = bool(int(os.environ.get('WSGI_EVENTS', '0')))
+
+    history_default_days = int(os.environ.get('HISTORY_DEFAULT_DAYS', '7'))
+
+    ingest_channel = os.environ.get('INGEST_NOTIFY_CHANNEL', 'node_status_ingest')
+
     rmq_host  = os.environ.get('RABBITMQ_HOST',          'localhost')
     rmq_port  = os.environ.get('RABBITMQ_PORT',          '5672')
     rmq_user  = os.environ.get('RABBITMQ_DEFAULT_USER',  'guest')
@@ -0,0 +1,107 @@
+import logging
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+
+logger = logging.getLogger('db')
+
+
+class Database:
+    """
+    Thread-safe pool of Postgres connections handing out per-request cursors.
+
+    The pool is created lazily so each forked wsgi worker gets its own sockets.
+    Callers block when every connection is checked out rather than erroring.
+    Connections that have sat idle for `check_interval` seconds are pinged
+    before use, and any connection that is closed or raises a connection-level
+    error is discarded so the next checkout reconnects.
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=10, check_interval=30):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.check_interval = check_interval
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        # keyed by the connection itself rather than its id(), which a new
+        # connection can be handed once the old one is garbage collected
+        self._last_used = weakref.WeakKeyDictionary()
+
+    @property
+    def pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadedConnectionPool(self.minconn, self.maxconn, self.dsn)
+
+        return self._pool
+
+    @contextmanager
+    def connection(self):
+        self._slots.acquire()
+        try:
+            conn = self._checkout()
+            broken = False
+            try:
+                yield conn
+                conn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = True
+                raise
+            except BaseException:
+                # includes GeneratorExit from a streamed response whose client
+                # went away mid-transfer
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                self._checkin(conn, broken or bool(conn.closed))
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def cursor(self, *args, **kwargs):
+        with self.connection() as conn:
+            with conn.cursor(*args, **kwargs) as cursor:
+                yield cursor
+
+    def _checkout(self):
+        # a closed or unresponsive connection costs one retry per pool slot
+        for _ in range(self.maxconn + 1):
+            conn = self.pool.getconn()
+            if self._is_healthy(conn):
+                return conn
+
+            logger.warning('discarding dead database connection')
+            self._checkin(conn, True)
+
+        raise psycopg2.OperationalError('could not get a healthy database connection')
+
+    def _checkin(self, conn, discard):
+        self._last_used.pop(conn, None)
+        if not discard:
+            self._last_used[conn] = time.monotonic()
+
+        self.pool.putconn(conn, close=discard)
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+
+        last_used = self._last_used.get(conn)
+        if last_used is not None and time.monotonic() - last_used < self.check_interval:
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
@@ -0,0 +1,263 @@
+"""
+Server-sent events for live status updates. Rather than have every client
+poll the status endpoints, one thread per web worker keeps the latest status
+rows for each project someone is watching, recomputes them whenever the
+ingest listener hears from the tasks (and every `refresh_interval` seconds,
+since statuses also age out on their own), and pushes only the nodes whose
+status or latest timestamps changed.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+import serializers
+
+
+logger = logging.getLogger('events')
+
+WATCHED_COLUMNS = [
+    'status', 'latest_observation_timestamp', 'latest_boot_timestamp', 'latest_rssh_timestamp']
+
+_WATCHED_INDEXES = [serializers.STATUS_HEADERS.index(column) for column in WATCHED_COLUMNS]
+_NODE_ID_INDEX = serializers.STATUS_HEADERS.index('node_id')
+_PROJECT_ID_INDEX = serializers.STATUS_HEADERS.index('project_id')
+
+# a comment line, sent when there's been nothing else for a while
+KEEPALIVE = b': keepalive\n\n'
+
+
+class TooManyClients(Exception):
+    pass
+
+
+def _row_key(row):
+    return (row[_NODE_ID_INDEX], row[_PROJECT_ID_INDEX])
+
+
+def _watched(row):
+    return tuple(row[i] for i in _WATCHED_INDEXES)
+
+
+def format_event(event, data, event_id=None):
+    """
+    Formats a single event. `data` is a compact JSON body, so it never needs
+    splitting over several `data:` lines.
+    """
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append(f'data: {data.decode("utf8")}')
+    return ('\n'.join(lines) + '\n\n').encode('utf8')
+
+
+class _Channel:
+    """
+    The latest rows for one project, keyed by (node_id, project_id), and the
+    queues of the clients watching it. Event ids are `<epoch>-<version>` so a
+    client reconnecting to a channel that has since been recreated can't
+    mistake it for the one it left.
+    """
+
+    def __init__(self):
+        self.epoch = f'{time.time():.6f}'
+        self.version = 0
+        self.rows = None
+        self.clients = set()
+
+    @property
+    def event_id(self):
+        return f'{self.epoch}-{self.version}'
+
+
+class Client:
+    """
+    `wake`, if given, is called from the refresh thread after every message
+    put on the client's queue, so a consumer that isn't a thread blocked on
+    the queue -- e.g. a coroutine -- knows to drain it.
+    """
+
+    def __init__(self, project_id, queue_size, wake=None):
+        self.project_id = project_id
+        self.queue = queue.Queue(queue_size)
+        self.snapshot = None
+        self.event_id = None
+        self.wake = wake
+
+
+class StatusEvents:
+    """
+    `load(project_id)` returns the status rows for a project. Each web worker
+    serves at most `max_clients` streams. Under gunicorn every one of them
+    holds a thread for as long as it's open (see `stream`), so there the limit
+    is really the worker's thread count; the asyncio app waits on clients'
+    `wake` instead and holds no thread per stream.
+    """
+
+    def __init__(self, load, refresh_interval=60, heartbeat_interval=15, max_clients=16, queue_size=64):
+        self.load = load
+        self.refresh_interval = refresh_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.max_clients = max_clients
+        self.queue_size = queue_size
+        self._channels = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._thread = None
+
+    def notify(self, *args):
+        """
+        Ingest listener callback -- refreshes are coalesced, so a burst of
+        notifications only costs one round of queries.
+        """
+        self._dirty.set()
+
+    def start_once(self):
+        # started lazily so each forked wsgi worker gets its own thread
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='status-events', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._dirty.wait(self.refresh_interval)
+            self._dirty.clear()
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f'failed to refresh status events: {e}')
+
+    def refresh(self, project_ids=None):
+        """
+        Reloads the rows for the given projects (all of the watched ones by
+        default) and sends each project's clients a diff if anything changed.
+        """
+        with self._refresh_lock:
+            watched = project_ids is None
+            if watched:
+                with self._lock:
+                    project_ids = list(self._channels)
+
+            for project_id in project_ids:
+                rows = {_row_key(row): row for row in self.load(project_id)}
+
+                with self._lock:
+                    channel = self._channels.get(project_id)
+                    if channel is None:
+                        # everyone watching it left while the rows were loading
+                        if watched:
+                            continue
+                        channel = self._channels[project_id] = _Channel()
+
+                    previous, channel.rows = channel.rows, rows
+                    if previous is None:
+                        continue
+
+                    changed = [row for key, row in rows.items()
+                               if key not in previous or _watched(previous[key]) != _watched(row)]
+                    removed = [key for key in previous if key not in rows]
+                    if not changed and not removed:
+                        continue
+
+                    channel.version += 1
+                    data = serializers.dumps({
+                        'changed': serializers.status_records(changed),
+                        'removed': [dict(zip(['node_id', 'project_id'], key)) for key in removed]
+                    })
+                    message = format_event('diff', data, channel.event_id)
+
+                    logger.debug(f'sending {len(changed)} changed and {len(removed)} removed nodes '
+                                 f'to {len(channel.clients)} clients of {project_id}')
+                    for client in list(channel.clients):
+                        self._send(channel, client, message)
+
+    def _send(self, channel, client, message):
+        try:
+            client.queue.put_nowait(message)
+        except queue.Full:
+            # a client this far behind is dropped; it'll reconnect and get a snapshot
+            logger.warning(f'dropping slow status events client of {client.project_id}')
+            channel.clients.discard(client)
+            while not client.queue.empty():
+                client.queue.get_nowait()
+            client.queue.put_nowait(None)
+
+        if client.wake is not None:
+            client.wake()
+
+    def subscribe(self, project_id, wake=None):
+        """
+        Registers a new client and hands it the current rows of its project,
+        atomically with respect to diffs so none are missed in between.
+        """
+        self.start_once()
+        client = Client(project_id, self.queue_size, wake)
+
+        while True:
+            with self._lock:
+                channel = self._channels.get(project_id)
+                if sum(len(c.clients) for c in self._channels.values()) >= self.max_clients:
+                    if channel is not None and not channel.clients:
+                        del self._channels[project_id]
+                    raise TooManyClients(f'already serving {self.max_clients} status event streams')
+
+                if channel is not None and channel.rows is not None:
+                    channel.clients.add(client)
+                    client.snapshot = list(channel.rows.values())
+                    client.event_id = channel.event_id
+                    return client
+
+            self.refresh([project_id])
+
+    def unsubscribe(self, client):
+        with self._lock:
+            channel = self._channels.get(client.project_id)
+            if channel is not None:
+                channel.clients.discard(client)
+                if not channel.clients:
+                    del self._channels[client.project_id]
+
+    def snapshot_event(self, client, last_event_id=None):
+        """
+        The full `snapshot` a client's stream opens with, or `None` if it's
+        reconnecting and already up to date.
+        """
+        snapshot, client.snapshot = client.snapshot, None
+        if last_event_id == client.event_id:
+            return None
+
+        return format_event('snapshot', serializers.dumps(serializers.status_records(snapshot)), client.event_id)
+
+    def next_event(self, client):
+        """
+        Blocks for up to `heartbeat_interval` seconds for the client's next
+        `diff`, returning a comment heartbeat to keep proxies from closing the
+        connection if there isn't one, or `None` once the client was dropped.
+        """
+        try:
+            return client.queue.get(timeout=self.heartbeat_interval)
+        except queue.Empty:
+            return KEEPALIVE
+
+    def stream(self, client, last_event_id=None):
+        """
+        Yields the events for a client: its snapshot, then a diff whenever its
+        project's statuses change. Blocks the calling thread between events.
+        """
+        try:
+            snapshot = self.snapshot_event(client, last_event_id)
+            if snapshot is not None:
+                yield snapshot
+
+            while True:
+                message = self.next_event(client)
+                if message is None:
+                    break
+
+                yield message
+        finally:
+            self.unsubscribe(client)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+"""
+Runs a single columnar export for the asyncio app in a process of its own, so
+neither decoding the rows nor encoding the arrow batches competes with the
+event loop for the web worker's gil. The job -- a pickled dict of the query,
+its params, the writer class and the batch size -- is read from stdin, and the
+encoded export is written to stdout as it's produced.
+
+    $ python export_worker.py < job.pickle > export.arrow
+"""
+
+import pickle
+import sys
+
+import psycopg2
+
+import columnar
+from config import Config
+
+
+def main():
+    job = pickle.load(sys.stdin.buffer)
+    out = sys.stdout.buffer
+
+    conn = psycopg2.connect(Config().get_pg_dsn())
+    try:
+        with conn.cursor(name='columnar_export_cursor') as cursor:
+            cursor.itersize = job['batch_size']
+            cursor.execute(job['query'], job['params'])
+            for chunk in columnar.iter_batches(job['writer_class'](), cursor, job['batch_size']):
+                out.write(chunk)
+                out.flush()
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
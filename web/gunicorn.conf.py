@@ -0,0 +1,13 @@
+import os
+
+bind    = '0.0.0.0:5000'
+workers = int(os.environ.get('WEB_WORKERS', '4'))
+threads = int(os.environ.get('WEB_THREADS', '32'))
+
+# each open /events/status stream holds one of a worker's threads for as long
+# as it's connected, blocked on its queue between events. a worker can't serve
+# more streams than it has threads, whatever EVENTS_MAX_CLIENTS says, and every
+# stream is a thread the other requests can't use. so the streams are off here
+# unless WSGI_EVENTS=1 (and the map page polls instead); if you turn them on,
+# keep EVENTS_MAX_CLIENTS comfortably below WEB_THREADS. async_app holds no
+# thread per stream and always serves them.
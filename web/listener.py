@@ -0,0 +1,71 @@
+import logging
+import select
+import threading
+import time
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+
+logger = logging.getLogger('listener')
+
+
+class IngestListener(threading.Thread):
+    """
+    Background thread that `LISTEN`s on the channel the tasks `NOTIFY` after
+    every ingest and calls each subscriber with the notification payload. If
+    the connection drops, subscribers are called with `None` -- notifications
+    may have been missed -- and the listener reconnects.
+    """
+
+    def __init__(self, dsn, channel, poll_interval=60, retry_interval=5):
+        super().__init__(name='ingest-listener', daemon=True)
+        self.dsn = dsn
+        self.channel = channel
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self._subscribers = []
+        self._start_lock = threading.Lock()
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def start_once(self):
+        # started lazily so each forked wsgi worker gets its own thread
+        with self._start_lock:
+            if self.ident is None:
+                self.start()
+
+    def run(self):
+        while True:
+            try:
+                self._listen()
+            except psycopg2.Error as e:
+                logger.warning(f'ingest listener lost its connection: {e}')
+                self._publish(None)
+                time.sleep(self.retry_interval)
+
+    def _listen(self):
+        conn = psycopg2.connect(self.dsn)
+        try:
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            conn.cursor().execute(sql.SQL('LISTEN {}').format(sql.Identifier(self.channel)))
+            logger.info(f'listening for ingest notifications on {self.channel}')
+
+            while True:
+                if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                    continue
+
+                conn.poll()
+                while conn.notifies:
+                    self._publish(conn.notifies.pop(0).payload)
+        finally:
+            conn.close()
+
+    def _publish(self, payload):
+        for callback in self._subscribers:
+            try:
+                callback(payload)
+            except Exception as e:
+                logger.error(f'ingest subscriber failed: {e}')
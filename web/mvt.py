@@ -0,0 +1,165 @@
+"""
+A minimal Mapbox vector tile (v2) encoder for the node status map. Nodes are
+the only thing on the map and they're all points, so rather than pulling in
+a full geometry stack this writes the handful of protobuf messages the spec
+needs by hand:
+
+    Tile    { repeated Layer layers = 3; }
+    Layer   { uint32 version = 15; string name = 1; repeated Feature features = 2;
+              repeated string keys = 3; repeated Value values = 4; uint32 extent = 5; }
+    Feature { repeated uint32 tags = 2 [packed]; GeomType type = 3;
+              repeated uint32 geometry = 4 [packed]; }
+    Value   { string string_value = 1; double double_value = 3;
+              sint64 sint_value = 6; bool bool_value = 7; }
+
+See https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+"""
+
+import math
+import struct
+
+
+EXTENT = 4096
+BUFFER = 64
+
+MAX_ZOOM = 24
+
+# the web mercator projection is undefined at the poles
+MAX_LAT = 85.0511287798
+
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH_DELIMITED = 2
+
+_POINT = 1
+_MOVE_TO = 1
+
+
+def _varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+
+    out.append(value)
+    return bytes(out)
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _key(field, wire_type):
+    return _varint((field << 3) | wire_type)
+
+
+def _bytes_field(field, value):
+    return _key(field, _LENGTH_DELIMITED) + _varint(len(value)) + value
+
+
+def _varint_field(field, value):
+    return _key(field, _VARINT) + _varint(value)
+
+
+def _packed_field(field, values):
+    return _bytes_field(field, b''.join(_varint(v) for v in values))
+
+
+def _value(value):
+    if isinstance(value, bool):
+        return _varint_field(7, int(value))
+    if isinstance(value, int):
+        return _varint_field(6, _zigzag(value))
+    if isinstance(value, float):
+        return _key(3, _FIXED64) + struct.pack('<d', value)
+
+    return _bytes_field(1, str(value).encode('utf8'))
+
+
+def tile_bounds(z, x, y):
+    """
+    Returns the (min_lon, min_lat, max_lon, max_lat) covered by a tile.
+    """
+    n = 2 ** z
+
+    def lat(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+    return (x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y))
+
+
+def is_valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def project(lon, lat, z, x, y, extent=EXTENT):
+    """
+    Projects a lon/lat into the integer pixel space of tile z/x/y.
+    """
+    n = 2 ** z
+    lat = max(-MAX_LAT, min(MAX_LAT, lat))
+    rad = math.radians(lat)
+
+    px = ((lon + 180) / 360 * n - x) * extent
+    py = ((1 - math.log(math.tan(rad) + 1 / math.cos(rad)) / math.pi) / 2 * n - y) * extent
+    return int(round(px)), int(round(py))
+
+
+class Layer:
+    """
+    Collects point features for one layer of a tile. Property keys and values
+    are deduplicated across features as the spec intends -- most nodes share
+    their project and status, so this keeps tiles small.
+    """
+
+    def __init__(self, name, z, x, y, extent=EXTENT, buffer=BUFFER):
+        self.name = name
+        self.z, self.x, self.y = z, x, y
+        self.extent = extent
+        self.buffer = buffer
+        self._keys = {}
+        self._values = {}
+        self._features = []
+
+    def __len__(self):
+        return len(self._features)
+
+    def add_point(self, lon, lat, properties):
+        """
+        Adds a point feature, skipping it if it falls outside the tile and its
+        buffer. None valued properties are left out.
+        """
+        px, py = project(lon, lat, self.z, self.x, self.y, self.extent)
+        if not (-self.buffer <= px <= self.extent + self.buffer and -self.buffer <= py <= self.extent + self.buffer):
+            return False
+
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+
+            tags.append(self._keys.setdefault(key, len(self._keys)))
+            tags.append(self._values.setdefault((type(value), value), len(self._values)))
+
+        geometry = [(1 << 3) | _MOVE_TO, _zigzag(px), _zigzag(py)]
+        self._features.append(
+            _packed_field(2, tags) + _varint_field(3, _POINT) + _packed_field(4, geometry))
+        return True
+
+    def encode(self):
+        return b''.join([
+            _varint_field(15, 2),
+            _bytes_field(1, self.name.encode('utf8')),
+            b''.join(_bytes_field(2, feature) for feature in self._features),
+            b''.join(_bytes_field(3, key.encode('utf8')) for key in self._keys),
+            b''.join(_bytes_field(4, _value(value)) for (_, value) in self._values),
+            _varint_field(5, self.extent),
+        ])
+
+
+def encode_tile(layers):
+    """
+    Encodes the non-empty layers into a tile. A tile with no features is a
+    valid, empty body.
+    """
+    return b''.join(_bytes_field(3, layer.encode()) for layer in layers if len(layer))
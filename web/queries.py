@@ -1,9 +1,10 @@
 
+# the status rules live in the node_status() function in 00-init.sql, which
+# the snapshot_statuses task applies as well
 STATUSES_FOR_ALL = """
 WITH q0 AS (
-    SELECT node_id, max(timestamp) AS latest_observation_timestamp
-    FROM observations
-    GROUP BY node_id
+    SELECT node_id, latest_observation_timestamp
+    FROM node_latest_observation
 ),
 q1 AS (
     SELECT
@@ -26,39 +27,41 @@ q1 AS (
         LEFT JOIN projects_nodes p ON p.node_id = n.node_id
         LEFT JOIN boot_events b ON b.node_id = n.node_id
         LEFT JOIN rssh_ports r ON r.node_id = n.node_id
+    WHERE
+        %(min_lon)s::float IS NULL
+        OR point(n.lon, n.lat) <@ box(point(%(min_lon)s, %(min_lat)s), point(%(max_lon)s, %(max_lat)s))
 ),
 q2 AS (
     SELECT q1.*, q0.latest_observation_timestamp
     FROM q1 LEFT JOIN q0 ON q0.node_id = q1.node_id
+),
+q3 AS (
+    SELECT
+        *,
+        node_status(
+            start_timestamp, end_timestamp,
+            latest_observation_timestamp, latest_boot_timestamp, latest_rssh_timestamp,
+            NOW() AT TIME ZONE 'UTC'
+        ) AS status
+    FROM q2
 )
-SELECT
-    *,
-    CASE
-        WHEN end_timestamp IS NOT NULL
-            THEN 'black'
-        WHEN start_timestamp IS NULL AND latest_observation_timestamp IS NOT NULL
-            THEN 'gray'
-        WHEN latest_observation_timestamp >= (NOW() - interval '24 hours')
-            THEN 'green'
-        WHEN latest_boot_timestamp >= (NOW() - interval '24 hours')
-            AND latest_rssh_timestamp >= (NOW() - interval '24 hours')
-            THEN 'blue'
-        WHEN latest_rssh_timestamp >= (NOW() - interval '24 hours')
-            THEN 'yellow'
-        WHEN latest_boot_timestamp >= (NOW() - interval '24 hours')
-            THEN 'orange'
-        ELSE 'red'
-    END AS status
-FROM q2
-ORDER BY vsn ASC
+SELECT *
+FROM q3
+WHERE
+    (%(status)s::text[] IS NULL OR status = ANY(%(status)s::text[]))
+    AND (
+        %(after_vsn)s::text IS NULL
+        OR (vsn, node_id, COALESCE(project_id, '')) > (%(after_vsn)s, %(after_node_id)s, %(after_project_id)s)
+    )
+ORDER BY vsn ASC, node_id ASC, COALESCE(project_id, '') ASC
+LIMIT %(limit)s
 """
 
 
 STATUSES_FOR_PROJECT = """
 WITH q0 AS (
-    SELECT node_id, max(timestamp) AS latest_observation_timestamp
-    FROM observations
-    GROUP BY node_id
+    SELECT node_id, latest_observation_timestamp
+    FROM node_latest_observation
 ),
 q1 AS (
     SELECT
@@ -83,40 +86,64 @@ q1 AS (
         LEFT JOIN rssh_ports r ON r.node_id = n.node_id
     WHERE
         p.project_id = %(project_id)s
+        AND (
+            %(min_lon)s::float IS NULL
+            OR point(n.lon, n.lat) <@ box(point(%(min_lon)s, %(min_lat)s), point(%(max_lon)s, %(max_lat)s))
+        )
 ),
 q2 AS (
     SELECT q1.*, q0.latest_observation_timestamp
     FROM q1 LEFT JOIN q0 ON q0.node_id = q1.node_id
+),
+q3 AS (
+    SELECT
+        *,
+        node_status(
+            start_timestamp, end_timestamp,
+            latest_observation_timestamp, latest_boot_timestamp, latest_rssh_timestamp,
+            NOW() AT TIME ZONE 'UTC'
+        ) AS status
+    FROM q2
 )
-SELECT
-    *,
-    CASE
-        WHEN latest_observation_timestamp >= (NOW() - interval '24 hours')
-            THEN 'green'
-        WHEN latest_boot_timestamp >= (NOW() - interval '24 hours')
-            AND latest_rssh_timestamp >= (NOW() - interval '24 hours')
-            THEN 'blue'
-        WHEN latest_rssh_timestamp >= (NOW() - interval '24 hours')
-            THEN 'yellow'
-        WHEN latest_boot_timestamp >= (NOW() - interval '24 hours')
-            THEN 'orange'
-        ELSE 'red'
-    END AS status
-FROM q2
-ORDER BY vsn ASC
+SELECT *
+FROM q3
+WHERE
+    (%(status)s::text[] IS NULL OR status = ANY(%(status)s::text[]))
+    AND (
+        %(after_vsn)s::text IS NULL
+        OR (vsn, node_id, COALESCE(project_id, '')) > (%(after_vsn)s, %(after_node_id)s, %(after_project_id)s)
+    )
+ORDER BY vsn ASC, node_id ASC, COALESCE(project_id, '') ASC
+LIMIT %(limit)s
 """
 
 
+# the last recorded hour of a node's observations, however long they are kept
 EXPORT_FOR_NODE = """
-SELECT *
-FROM observations
+SELECT
+    o.node_id,
+    o.timestamp,
+    s.subsystem,
+    s.sensor,
+    s.parameter,
+    o.value_raw,
+    o.value_hrf,
+    o.value_hrf_text
+FROM
+    observations o
+    JOIN sensors s ON s.sensor_id = o.sensor_id
 WHERE
-    node_id = %(node_id)s
+    o.node_id = %(node_id)s
+    AND o.timestamp >= (
+        SELECT latest_observation_timestamp - interval '1 hour'
+        FROM node_latest_observation
+        WHERE node_id = %(node_id)s
+    )
 ORDER BY
-    timestamp DESC,
-    subsystem ASC,
-    sensor ASC,
-    parameter ASC
+    o.timestamp DESC,
+    s.subsystem ASC,
+    s.sensor ASC,
+    s.parameter ASC
 """
 
 
@@ -124,4 +151,137 @@ PROJECT_IDS = """
 SELECT DISTINCT project_id
 FROM projects_nodes
 ORDER BY project_id ASC
-"""
\ No newline at end of file
+"""
+
+
+# the filters are plain parameters, so with the values inlined by the
+# server-side cursor postgres prunes the partitions outside since/until
+EXPORT_OBSERVATIONS = """
+SELECT
+    o.node_id,
+    o.timestamp,
+    s.subsystem,
+    s.sensor,
+    s.parameter,
+    o.value_raw,
+    o.value_hrf
+FROM
+    observations o
+    JOIN sensors s ON s.sensor_id = o.sensor_id
+WHERE
+    (%(node_id)s::text IS NULL OR o.node_id = %(node_id)s)
+    AND (
+        %(project_id)s::text IS NULL
+        OR o.node_id IN (SELECT node_id FROM projects_nodes WHERE project_id = %(project_id)s)
+    )
+    AND (%(since)s::timestamp IS NULL OR o.timestamp >= %(since)s)
+    AND (%(until)s::timestamp IS NULL OR o.timestamp < %(until)s)
+    AND (%(sensor)s::text IS NULL OR s.sensor = %(sensor)s)
+    AND (%(parameter)s::text IS NULL OR s.parameter = %(parameter)s)
+ORDER BY
+    o.node_id ASC,
+    o.timestamp ASC,
+    o.sensor_id ASC
+"""
+
+
+PROJECT_EXISTS = """
+SELECT 1
+FROM projects_nodes
+WHERE project_id = %(project_id)s
+LIMIT 1
+"""
+
+
+NODE_DETAIL = """
+SELECT node_id, vsn, lon, lat, address, description
+FROM nodes
+WHERE node_id = %(node_id)s
+"""
+
+
+LATEST_VALUES_FOR_NODE = """
+SELECT
+    s.subsystem,
+    s.sensor,
+    s.parameter,
+    v.timestamp,
+    v.value_raw,
+    v.value_hrf
+FROM
+    node_latest_values v
+    JOIN sensors s ON s.sensor_id = v.sensor_id
+WHERE
+    v.node_id = %(node_id)s
+ORDER BY
+    s.subsystem ASC,
+    s.sensor ASC,
+    s.parameter ASC
+"""
+
+
+VSN_FOR_NODE = """
+SELECT vsn
+FROM nodes
+WHERE node_id = %(node_id)s
+"""
+
+
+# history and uptime read the precomputed rollups -- status_hourly or
+# status_daily -- and count time spent green as up
+
+_STATUS_HISTORY = """
+SELECT
+    r.node_id,
+    n.vsn,
+    r.bucket,
+    jsonb_object_agg(r.status, r.seconds) AS seconds,
+    100 * COALESCE(sum(r.seconds) FILTER (WHERE r.status = 'green'), 0) / sum(r.seconds) AS uptime
+FROM
+    {table} r
+    LEFT JOIN nodes n ON n.node_id = r.node_id
+WHERE
+    r.bucket >= %(since)s
+    AND (%(until)s::timestamp IS NULL OR r.bucket < %(until)s)
+    AND (%(node_id)s::text IS NULL OR r.node_id = %(node_id)s)
+    AND (
+        %(project_id)s::text IS NULL
+        OR r.node_id IN (SELECT node_id FROM projects_nodes WHERE project_id = %(project_id)s)
+    )
+GROUP BY r.node_id, n.vsn, r.bucket
+ORDER BY n.vsn ASC, r.node_id ASC, r.bucket ASC
+"""
+
+
+_UPTIME = """
+WITH q0 AS (
+    SELECT node_id, status, sum(seconds) AS seconds
+    FROM {table}
+    WHERE
+        bucket >= %(since)s
+        AND (%(until)s::timestamp IS NULL OR bucket < %(until)s)
+        AND (%(node_id)s::text IS NULL OR node_id = %(node_id)s)
+        AND (
+            %(project_id)s::text IS NULL
+            OR node_id IN (SELECT node_id FROM projects_nodes WHERE project_id = %(project_id)s)
+        )
+    GROUP BY node_id, status
+)
+SELECT
+    q0.node_id,
+    n.vsn,
+    jsonb_object_agg(q0.status, q0.seconds) AS seconds,
+    100 * COALESCE(sum(q0.seconds) FILTER (WHERE q0.status = 'green'), 0) / sum(q0.seconds) AS uptime
+FROM
+    q0
+    LEFT JOIN nodes n ON n.node_id = q0.node_id
+GROUP BY q0.node_id, n.vsn
+ORDER BY n.vsn ASC, q0.node_id ASC
+"""
+
+
+ROLLUP_TABLES = {'hour': 'status_hourly', 'day': 'status_daily'}
+
+STATUS_HISTORY = {resolution: _STATUS_HISTORY.format(table=table) for resolution, table in ROLLUP_TABLES.items()}
+
+UPTIME = {resolution: _UPTIME.format(table=table) for resolution, table in ROLLUP_TABLES.items()}
@@ -0,0 +1,159 @@
+"""
+Query string parsing shared by the wsgi and asyncio apps. Everything here
+works on a plain `args` mapping and raises `ValueError` for bad input, which
+the apps turn into a 400.
+"""
+
+import base64
+import json
+from datetime import datetime, timedelta, timezone
+
+from dateutil import parser as dateparser
+
+import mvt
+import queries
+
+
+ALL_PROJECTS = 'all'
+
+
+def encode_cursor(row):
+    (node_id, vsn, project_id) = row[:3]
+    return base64.urlsafe_b64encode(json.dumps([vsn, node_id, project_id or '']).encode('utf8')).decode('ascii')
+
+
+def decode_cursor(value):
+    decoded = json.loads(base64.urlsafe_b64decode(value.encode('ascii')))
+    if not isinstance(decoded, list) or len(decoded) != 3 or not all(isinstance(v, str) for v in decoded):
+        raise ValueError(f'malformed cursor {value}')
+
+    return decoded
+
+
+def default_status_params(project_id):
+    return {
+        'project_id': project_id,
+        'min_lon': None, 'min_lat': None, 'max_lon': None, 'max_lat': None,
+        'status': None,
+        'after_vsn': None, 'after_node_id': None, 'after_project_id': None,
+        'limit': None,
+    }
+
+
+def status_params(project_id, args):
+    """
+    Turns the `bbox=min_lon,min_lat,max_lon,max_lat`, `status=green,blue`,
+    `limit=` and `cursor=` query string arguments into status query params.
+    """
+    params = default_status_params(project_id)
+
+    try:
+        bbox = args.get('bbox')
+        if bbox:
+            (params['min_lon'], params['min_lat'], params['max_lon'], params['max_lat']) = \
+                (float(value) for value in bbox.split(','))
+
+        status = args.get('status')
+        if status:
+            params['status'] = status.split(',')
+
+        limit = args.get('limit')
+        if limit:
+            params['limit'] = int(limit)
+            if params['limit'] <= 0:
+                raise ValueError('limit must be positive')
+
+        cursor = args.get('cursor')
+        if cursor:
+            (params['after_vsn'], params['after_node_id'], params['after_project_id']) = decode_cursor(cursor)
+
+    except TypeError as e:
+        raise ValueError(f'{e}')
+
+    return params
+
+
+def status_cache_key(params, fmt, *extra):
+    return (fmt,) + tuple(
+        (key, tuple(value) if isinstance(value, list) else value)
+        for key, value in sorted(params.items())) + extra
+
+
+def tile_params(project_id, z, x, y, args):
+    """
+    Status query params for tile z/x/y: the tile's bounds padded by the tile
+    buffer so points just over the edge still get drawn. Only the `status`
+    filter from the query string applies.
+    """
+    params = status_params(project_id, args)
+
+    (min_lon, min_lat, max_lon, max_lat) = mvt.tile_bounds(z, x, y)
+    pad_lon = (max_lon - min_lon) * mvt.BUFFER / mvt.EXTENT
+    pad_lat = (max_lat - min_lat) * mvt.BUFFER / mvt.EXTENT
+    params.update({
+        'min_lon': min_lon - pad_lon, 'min_lat': min_lat - pad_lat,
+        'max_lon': max_lon + pad_lon, 'max_lat': max_lat + pad_lat,
+        'after_vsn': None, 'after_node_id': None, 'after_project_id': None,
+        'limit': None,
+    })
+
+    return params
+
+
+def parse_timestamp(value):
+    # naive timestamps are taken to be utc, like everything in the database
+    try:
+        parsed = dateparser.parse(value)
+    except OverflowError as e:
+        raise ValueError(f'{e}')
+
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return parsed
+
+
+def _parse_range(params, args):
+    for key in ('since', 'until'):
+        value = args.get(key)
+        if value:
+            params[key] = parse_timestamp(value)
+
+
+def rollup_params(project_id, args, default_resolution, default_days):
+    """
+    Turns the `since=` and `until=` (ISO 8601 timestamps), `resolution=hour|day`
+    and `node_id=` query string arguments into rollup query params. Buckets
+    starting in [since, until) are included; since defaults to the start of
+    the day `default_days` ago.
+    """
+    resolution = args.get('resolution', default_resolution)
+    if resolution not in queries.ROLLUP_TABLES:
+        raise ValueError(f'resolution must be one of {", ".join(queries.ROLLUP_TABLES)}')
+
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    params = {
+        'project_id': None if project_id == ALL_PROJECTS else project_id,
+        'node_id': args.get('node_id'),
+        'since': today - timedelta(days=default_days),
+        'until': None,
+    }
+    _parse_range(params, args)
+
+    return params, resolution
+
+
+def export_params(args, **params):
+    """
+    Observation export query params, with the `since=`, `until=`, `sensor=`
+    and `parameter=` query string filters.
+    """
+    params = dict({
+        'node_id': None, 'project_id': None,
+        'since': None, 'until': None,
+        'sensor': args.get('sensor'),
+        'parameter': args.get('parameter'),
+    }, **params)
+    _parse_range(params, args)
+
+    return params
@@ -0,0 +1,259 @@
+"""
+Fast paths for turning status rows (plain tuples straight off the cursor) into
+response bodies. Timestamps are formatted with a cached per-hour UTC offset
+instead of a round trip through arrow, GeoJSON features are built directly
+from the tuples, and orjson is used for encoding when it's installed.
+"""
+
+import json
+import math
+from collections import Counter
+from datetime import timezone
+
+from dateutil import tz
+
+import mvt
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+STATUS_HEADERS = "node_id vsn project_id lon lat address description start_timestamp " \
+    "end_timestamp latest_boot_timestamp boot_id boot_media latest_rssh_timestamp " \
+    "port latest_observation_timestamp status".split(" ")
+
+TIMESTAMP_COLUMNS = frozenset([
+    'start_timestamp', 'end_timestamp', 'latest_boot_timestamp',
+    'latest_rssh_timestamp', 'latest_observation_timestamp'])
+
+LON_INDEX = STATUS_HEADERS.index('lon')
+LAT_INDEX = STATUS_HEADERS.index('lat')
+STATUS_INDEX = STATUS_HEADERS.index('status')
+
+
+class TimestampFormatter:
+    """
+    Formats naive UTC datetimes as local `YYYY-MM-DD HH:mm:ss Z` strings (the
+    same output as arrow's `.to(tzname).format(...)`). The UTC offset is looked
+    up once per UTC hour -- DST transitions always fall on the hour -- and
+    formatted values are memoized since many nodes share timestamps. (Unlike
+    arrow 0.12, the repeated fall-back hour gets the standard time offset.)
+    """
+
+    def __init__(self, tzname, memo_size=65536):
+        self.tzinfo = tz.gettz(tzname)
+        self.memo_size = memo_size
+        self._offsets = {}
+        self._memo = {}
+
+    def __call__(self, value):
+        if value is None:
+            return None
+
+        result = self._memo.get(value)
+        if result is None:
+            if len(self._memo) >= self.memo_size:
+                self._memo.clear()
+
+            result = self._memo[value] = self._format(value)
+
+        return result
+
+    def _format(self, value):
+        hour = value.replace(minute=0, second=0, microsecond=0)
+        cached = self._offsets.get(hour)
+        if cached is None:
+            offset = hour.replace(tzinfo=timezone.utc).astimezone(self.tzinfo).utcoffset()
+            minutes = int(offset.total_seconds()) // 60
+            sign = '-' if minutes < 0 else '+'
+            cached = self._offsets[hour] = (offset, f'{sign}{abs(minutes) // 60:02d}{abs(minutes) % 60:02d}')
+
+        offset, suffix = cached
+        return f'{(value + offset).isoformat(" ", "seconds")} {suffix}'
+
+
+format_timestamp = TimestampFormatter('America/Chicago')
+
+_TIMESTAMP_INDEXES = [i for i, key in enumerate(STATUS_HEADERS) if key in TIMESTAMP_COLUMNS]
+
+
+def status_values(rows):
+    """
+    Yields each status row as a list with its timestamps formatted.
+    """
+    for row in rows:
+        row = list(row)
+        for i in _TIMESTAMP_INDEXES:
+            row[i] = format_timestamp(row[i])
+
+        yield row
+
+
+def status_records(rows):
+    return [dict(zip(STATUS_HEADERS, row)) for row in status_values(rows)]
+
+
+def _status_feature(row):
+    properties = dict(zip(STATUS_HEADERS, row))
+    del properties['lon']
+    del properties['lat']
+
+    return {
+        'type': 'Feature',
+        'geometry': {
+            'type': 'Point',
+            'coordinates': [row[LON_INDEX], row[LAT_INDEX]]
+        },
+        'properties': properties
+    }
+
+
+def status_feature_collection(rows):
+    return {'type': 'FeatureCollection', 'features': [_status_feature(row) for row in status_values(rows)]}
+
+
+def status_cluster_collection(rows, zoom, cell_pixels):
+    """
+    Groups nodes into square grid cells roughly `cell_pixels` across at web
+    map zoom level `zoom`. Cells holding a single node come back as regular
+    features; the rest become one cluster feature at the cells' centroid
+    with the node count and a count per status.
+    """
+    size = cell_pixels * 360.0 / (256 * 2 ** zoom)
+    cells = {}
+    features = []
+
+    for row in rows:
+        lon, lat = row[LON_INDEX], row[LAT_INDEX]
+        if lon is None or lat is None:
+            features.extend(_status_feature(value) for value in status_values([row]))
+            continue
+
+        cells.setdefault((math.floor(lon / size), math.floor(lat / size)), []).append(row)
+
+    for cell in cells.values():
+        if len(cell) == 1:
+            features.extend(_status_feature(value) for value in status_values(cell))
+            continue
+
+        statuses = Counter(row[STATUS_INDEX] for row in cell)
+        features.append({
+            'type': 'Feature',
+            'geometry': {
+                'type': 'Point',
+                'coordinates': [
+                    sum(row[LON_INDEX] for row in cell) / len(cell),
+                    sum(row[LAT_INDEX] for row in cell) / len(cell)
+                ]
+            },
+            'properties': {
+                'cluster': True,
+                'point_count': len(cell),
+                'statuses': dict(statuses),
+                'status': statuses.most_common(1)[0][0]
+            }
+        })
+
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def status_tile(rows, z, x, y):
+    """
+    Encodes the status rows that fall in tile z/x/y as a vector tile with a
+    single `nodes` layer of points carrying the same properties as the
+    GeoJSON features.
+    """
+    layer = mvt.Layer('nodes', z, x, y)
+    for row in status_values(rows):
+        lon, lat = row[LON_INDEX], row[LAT_INDEX]
+        if lon is None or lat is None:
+            continue
+
+        properties = dict(zip(STATUS_HEADERS, row))
+        del properties['lon']
+        del properties['lat']
+        layer.add_point(lon, lat, properties)
+
+    return mvt.encode_tile([layer])
+
+
+EXPORT_HEADERS = ['node_id', 'timestamp', 'subsystem', 'sensor', 'parameter', "value_raw", "value_hrf"]
+
+
+def format_hrf(value):
+    """
+    value_hrf as the loader expects the export to write it: the shortest text
+    that reads back as the same float, without a trailing `.0`. Whenever that
+    isn't what the node reported, the loader kept the reported text instead.
+    """
+    if value is None:
+        return ''
+
+    text = repr(value)
+    return text[:-2] if text.endswith('.0') else text
+
+
+def export_values(rows):
+    """
+    Yields export rows with value_hrf as it was reported.
+    """
+    for row in rows:
+        (*values, value_hrf, value_hrf_text) = row
+        values.append(format_hrf(value_hrf) if value_hrf_text is None else value_hrf_text)
+        yield values
+
+NODE_HEADERS = ['node_id', 'vsn', 'lon', 'lat', 'address', 'description']
+
+READING_HEADERS = ['subsystem', 'sensor', 'parameter', 'timestamp', 'value_raw', 'value_hrf']
+
+_READING_TIMESTAMP_INDEX = READING_HEADERS.index('timestamp')
+
+
+def node_detail(node, readings):
+    """
+    A node's details with the latest reading of each of its sensors.
+    """
+    record = dict(zip(NODE_HEADERS, node))
+    record['readings'] = []
+    for row in readings:
+        row = list(row)
+        row[_READING_TIMESTAMP_INDEX] = format_timestamp(row[_READING_TIMESTAMP_INDEX])
+        record['readings'].append(dict(zip(READING_HEADERS, row)))
+
+    return record
+
+
+HISTORY_HEADERS = ['node_id', 'vsn', 'timestamp', 'seconds', 'uptime']
+
+UPTIME_HEADERS = ['node_id', 'vsn', 'seconds', 'uptime']
+
+
+def _rollup_values(seconds, uptime):
+    return {status: round(value) for status, value in sorted(seconds.items())}, round(uptime, 2)
+
+
+def history_records(rows):
+    """
+    Formats status history rows -- one per node per rollup bucket -- with
+    the seconds spent in each status and the percentage of them spent green.
+    """
+    records = []
+    for (node_id, vsn, bucket, seconds, uptime) in rows:
+        records.append(dict(zip(
+            HISTORY_HEADERS, (node_id, vsn, format_timestamp(bucket)) + _rollup_values(seconds, uptime))))
+
+    return records
+
+
+def uptime_records(rows):
+    return [dict(zip(UPTIME_HEADERS, (node_id, vsn) + _rollup_values(seconds, uptime)))
+            for (node_id, vsn, seconds, uptime) in rows]
+
+
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+
+    return json.dumps(obj, separators=(',', ':')).encode('utf8')
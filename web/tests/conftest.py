@@ -0,0 +1,219 @@
+"""
+A scratch Postgres database for the web tests, built from the same init script
+as the postgres container and filled with a handful of nodes in known states,
+plus test clients for both the wsgi and the asyncio app pointed at it.
+
+The server is found through the usual POSTGRES_* variables (or TEST_POSTGRES_*
+to keep them apart); the tests are skipped when there's none to reach, or
+when an app's dependencies (flask, or quart and asyncpg, and pyarrow for both)
+aren't installed. The database is named by TEST_POSTGRES_DB (default
+`node_status_test`) and is dropped and recreated on every run.
+
+    $ POSTGRES_HOST=localhost python -m pytest web/tests
+"""
+
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta
+
+import psycopg2
+import pytest
+
+
+WEB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INIT_SQL = os.path.join(os.path.dirname(WEB_DIR), 'postgres', 'docker-entrypoint-initdb.d', '00-init.sql')
+
+sys.path.insert(0, WEB_DIR)
+
+
+def _setting(name, default):
+    return os.environ.get(f'TEST_{name}', os.environ.get(name, default))
+
+
+PG = {
+    'host': _setting('POSTGRES_HOST', 'localhost'),
+    'port': _setting('POSTGRES_PORT', '5432'),
+    'user': _setting('POSTGRES_USER', 'postgres'),
+    'password': _setting('POSTGRES_PASSWORD', 'postgres'),
+}
+TEST_DB = os.environ.get('TEST_POSTGRES_DB', 'node_status_test')
+
+NOW = datetime.utcnow().replace(microsecond=0)
+TODAY = NOW.replace(hour=0, minute=0, second=0)
+
+# (node_id, project_id, vsn, lon, lat, start, end, observed, booted, rssh) -- one
+# node per status, with every timestamp well clear of the 24 hour cut off
+NODES = [
+    ('001e0610aa01', 'AoT_Alpha', '001', -87.62, 41.88, NOW - timedelta(days=90), None,
+     NOW - timedelta(minutes=20), NOW - timedelta(hours=2), NOW - timedelta(hours=1)),
+    ('001e0610aa02', 'AoT_Alpha', '002', -87.63, 41.89, NOW - timedelta(days=90), None,
+     NOW - timedelta(days=3), NOW - timedelta(hours=2), NOW - timedelta(hours=1)),
+    ('001e0610aa03', 'AoT_Alpha', '003', -87.64, 41.90, NOW - timedelta(days=90), None,
+     NOW - timedelta(days=3), None, NOW - timedelta(hours=1)),
+    ('001e0610aa04', 'AoT_Alpha', '004', -87.65, 41.91, NOW - timedelta(days=90), None,
+     NOW - timedelta(days=3), NOW - timedelta(hours=2), None),
+    ('001e0610aa05', 'AoT_Alpha', '005', -87.66, 41.92, NOW - timedelta(days=90), None,
+     NOW - timedelta(days=3), NOW - timedelta(days=3), NOW - timedelta(days=3)),
+    ('001e0610bb01', 'AoT_Beta', '101', -104.99, 39.74, NOW - timedelta(days=90), NOW - timedelta(days=10),
+     NOW - timedelta(days=11), None, None),
+    ('001e0610bb02', 'AoT_Beta', '102', -104.98, 39.75, NOW - timedelta(days=90), None,
+     NOW - timedelta(minutes=5), None, None),
+]
+
+SENSORS = [
+    ('metsense', 'bmp180', 'temperature'),
+    ('metsense', 'bmp180', 'pressure'),
+    ('metsense', 'htu21d', 'humidity'),
+]
+
+# (value_raw, value_hrf, value_hrf_text) in turn -- including one the export has
+# to take from value_hrf_text to reproduce
+VALUES = [('2343', 23.43, None), ('100232', 1002.32, None), ('4180', 41.8, '41.80'), ('na', None, 'NA')]
+
+
+def _connect(dbname):
+    return psycopg2.connect(dbname=dbname, **PG)
+
+
+def _create_database():
+    conn = _connect('postgres')
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f'DROP DATABASE IF EXISTS {TEST_DB}')
+            cursor.execute(f'CREATE DATABASE {TEST_DB}')
+    finally:
+        conn.close()
+
+    # the init script opens with a psql \c into node_status
+    with open(INIT_SQL) as fh:
+        schema = ''.join(line for line in fh if not line.startswith('\\'))
+
+    conn = _connect(TEST_DB)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(schema)
+            _load_fixture_rows(cursor)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _load_fixture_rows(cursor):
+    for (subsystem, sensor, parameter) in SENSORS:
+        cursor.execute(
+            'INSERT INTO sensors (subsystem, sensor, parameter) VALUES (%s, %s, %s)', (subsystem, sensor, parameter))
+
+    for (node_id, project_id, vsn, lon, lat, start, end, observed, booted, rssh) in NODES:
+        cursor.execute(
+            'INSERT INTO nodes (node_id, vsn, lon, lat, address, description) VALUES (%s, %s, %s, %s, %s, %s)',
+            (node_id, vsn, lon, lat, f'{vsn} Main St', f'node "{vsn}", test'))
+        cursor.execute(
+            'INSERT INTO projects_nodes (node_id, project_id, start_timestamp, end_timestamp) VALUES (%s, %s, %s, %s)',
+            (node_id, project_id, start, end))
+        if booted:
+            cursor.execute(
+                'INSERT INTO boot_events (node_id, timestamp, boot_id, boot_media) VALUES (%s, %s, %s, %s)',
+                (node_id, booted, f'boot-{vsn}', 'sd'))
+        if rssh:
+            cursor.execute(
+                'INSERT INTO rssh_ports (node_id, timestamp, port) VALUES (%s, %s, %s)', (node_id, rssh, '50022'))
+
+        # a reading of each sensor every 5 minutes over the hour up to the latest observation
+        timestamps = [observed - timedelta(minutes=5 * i) for i in range(12)]
+        for i, timestamp in enumerate(timestamps):
+            for sensor_id in range(1, len(SENSORS) + 1):
+                (value_raw, value_hrf, value_hrf_text) = VALUES[(i + sensor_id) % len(VALUES)]
+                cursor.execute(
+                    'INSERT INTO observations (timestamp, node_id, sensor_id, value_raw, value_hrf, value_hrf_text) '
+                    'VALUES (%s, %s, %s, %s, %s, %s)',
+                    (timestamp, node_id, sensor_id, value_raw, value_hrf, value_hrf_text))
+                if i == 0:
+                    cursor.execute(
+                        'INSERT INTO node_latest_values (node_id, sensor_id, timestamp, value_raw, value_hrf) '
+                        'VALUES (%s, %s, %s, %s, %s)', (node_id, sensor_id, timestamp, value_raw, value_hrf))
+
+        cursor.execute(
+            'INSERT INTO node_latest_observation (node_id, latest_observation_timestamp, observations_ingested) '
+            'VALUES (%s, %s, %s)', (node_id, observed, len(timestamps) * len(SENSORS)))
+
+        # two days of rollups, split between green and red
+        for days in (1, 2):
+            day = TODAY - timedelta(days=days)
+            for hour in (0, 1):
+                cursor.execute(
+                    'INSERT INTO status_hourly (bucket, node_id, status, seconds) VALUES (%s, %s, %s, %s), (%s, %s, %s, %s)',
+                    (day + timedelta(hours=hour), node_id, 'green', 2700.0,
+                     day + timedelta(hours=hour), node_id, 'red', 900.0))
+            cursor.execute(
+                'INSERT INTO status_daily (bucket, node_id, status, seconds) VALUES (%s, %s, %s, %s), (%s, %s, %s, %s)',
+                (day, node_id, 'green', 5400.0, day, node_id, 'red', 1800.0))
+
+
+@pytest.fixture(scope='session')
+def database():
+    try:
+        _create_database()
+    except psycopg2.OperationalError as e:
+        pytest.skip(f'no postgres to test against: {e}')
+
+    # the apps read their config from the environment when they're imported.
+    # the tests count on the response caches being on, and on the wsgi app
+    # streaming events like the asyncio app so they serve the same map page.
+    os.environ.update({
+        'STATUS_CACHE_TTL': '300',
+        'WSGI_EVENTS': '1',
+        'POSTGRES_HOST': PG['host'],
+        'POSTGRES_PORT': PG['port'],
+        'POSTGRES_USER': PG['user'],
+        'POSTGRES_PASSWORD': PG['password'],
+        'POSTGRES_DB': TEST_DB,
+    })
+
+    return TEST_DB
+
+
+def _require(*modules):
+    for module in modules:
+        pytest.importorskip(module)
+
+
+@pytest.fixture(scope='session')
+def wsgi_app(database):
+    _require('flask', 'flask_cors', 'pyarrow')
+    import app
+    return app.app
+
+
+class AsyncClient:
+    """
+    Drives the asyncio app's test client from plain (synchronous) tests.
+    """
+
+    def __init__(self, app, loop):
+        self.app = app
+        self.loop = loop
+        self.client = app.test_client()
+
+    def get(self, path, headers=None):
+        return self.loop.run_until_complete(self._get(path, headers))
+
+    async def _get(self, path, headers):
+        response = await self.client.get(path, headers=headers)
+        return response, await response.get_data()
+
+
+@pytest.fixture(scope='session')
+def async_client(database):
+    _require('quart', 'quart_cors', 'asyncpg', 'pyarrow')
+    import async_app
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(async_app.app.startup())
+    try:
+        yield AsyncClient(async_app.app, loop)
+    finally:
+        loop.run_until_complete(async_app.app.shutdown())
+        loop.close()
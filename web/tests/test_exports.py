@@ -0,0 +1,16 @@
+"""
+The asyncio app's columnar exports when the export worker fails.
+"""
+
+import sys
+
+
+def test_failed_worker_is_an_error(async_client, monkeypatch):
+    import async_app
+
+    # fails before writing anything, as on a bad query or a lost database
+    monkeypatch.setattr(async_app, '_EXPORT_WORKER', [
+        sys.executable, '-c', 'import sys; sys.stdin.buffer.read(); sys.exit(1)'])
+
+    (response, _) = async_client.get('/export/AoT_Alpha/observations.arrow')
+    assert response.status_code == 500